@@ -1,3 +1,4 @@
+import os
 import telegram
 from flask import Flask
 from flask_cors import CORS
@@ -11,6 +12,9 @@ from src.application.api import register_api_blueprints
 from config.config_loader import ConfigLoader
 
 from src.application.mqtt.mqtt_handler import DoorMQTTHandler
+from src.application.home_state import HomeStateStore
+from src.application.customer_index import CustomerIndex
+from src.application.mqtt.device_router import DeviceRouter
 
 from pyngrok import ngrok
 from telegram.ext import Application
@@ -128,6 +132,33 @@ class FlaskServer:
             self.app.config["MQTT_CONFIG"] = {
                 "broker": "127.0.0.1",  # i installed Oracle's mosquitto broker on the local machine
                 "port": 1883,
+                "power_events_window": 2.0,  # seconds, power status transitions of a smart home get processed in batches
+                "power_events_max_delay": 10.0,
+                "shadow_ack_timeout": 30,  # seconds, unacknowledged setting publishes get retried after this
+                "shadow_reconcile_interval": 60,
+                "shadow_ttl": 300,  # seconds, after this a setting the broker holds gets published again when asked
+                "payload_content_type": "application/json",  # settings format for devices that never talked to us
+                "passing_by_debounce_window": 1.0,  # seconds, same direction detections of a device closer than this are bounces
+                "passing_by_dedup_ttl": 600,  # seconds a detection is remembered to drop its QoS 1 redeliveries
+                # durable inbox of the received messages (None to disable), one per backend instance
+                "inbox_path": os.getenv("MQTT_INBOX_PATH", "instance/mqtt_inbox.sqlite3"),
+                "catchup_threshold": 200,  # inbox backlog that switches to per smart home catch-up batches
+                "reorder_allowed_lateness": 2.0,  # seconds, passing by detections get processed in device timestamp order
+                # worker pool of the message handlers: power statuses first, fair across customers (0 to disable)
+                "scheduler_workers": 4,
+                "customer_queue_cap": 500,  # queued messages of a customer before its passing by detections get shed
+                "customer_weights": {},  # customer -> share of the workers (1 by default)
+                # "asyncio": paho's socket, reconnections and handlers' work on one event loop instead of threads
+                "engine": os.getenv("MQTT_ENGINE", "threaded"),
+                "engine_max_concurrency": 16,  # DB calls running at the same time with the asyncio engine
+                # the settings go out on a second connection (client id <client_id>-pub) with its own queue
+                "publisher_queue_size": 1000,
+                "publish_ack_timeout": 10,  # seconds, a setting without PUBACK after this counts as not delivered
+                # seconds without messages before a device sending heartbeats is faulted (0: off, for older firmwares)
+                "watchdog_threshold": 0,
+                # set these two to run more backend instances on the same broker, see README_pettracker_1.md
+                "client_id": os.getenv("MQTT_CLIENT_ID"),  # None: derived from the host and the inbox file (stable)
+                "shared_subscription_group": os.getenv("MQTT_SHARED_GROUP"),  # ex. "pettracker-backend"
             }
             # Initialize MQTT handler
             self.mqtt_handler = DoorMQTTHandler(self.app)
@@ -138,11 +169,23 @@ class FlaskServer:
             # Initialize DRFactory
             dr_factory = DRFactory(db_service, schema_registry)
 
+            # Initialize the home state snapshots, kept up to date by the DRFactory writes
+            home_state_store = HomeStateStore(db_service, dr_factory, logger=self.app.logger)
+
+            # Initialize the customer -> smart home index, in front of every MQTT/Telegram lookup of a customer
+            customer_index = CustomerIndex(dr_factory)
+
+            # Initialize the (customer, seq_number) -> (home_id, door_id) routing table of the MQTT devices
+            device_router = DeviceRouter(db_service, dr_factory, customer_index=customer_index)
+
             # Store references
             self.app.config["SCHEMA_REGISTRY"] = schema_registry
             self.app.config["DB_SERVICE"] = db_service
             self.app.config["DT_FACTORY"] = dt_factory
             self.app.config["DR_FACTORY"] = dr_factory
+            self.app.config["HOME_STATE"] = home_state_store
+            self.app.config["CUSTOMER_INDEX"] = customer_index
+            self.app.config["DEVICE_ROUTER"] = device_router
             self.app.config["TELEGRAM_BOT"] = application.bot
             self.app.config["TELEGRAM_APPLICATION"] = application
             self.app.config["MQTT_HANDLER"] = self.mqtt_handler
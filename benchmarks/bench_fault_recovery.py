@@ -0,0 +1,127 @@
+"""
+Benchmark of the FaultRecoveryService on synthetic smart homes, from the size allowed by the Telegram bot
+(MAX_PERSONAL_ROOMS_PER_USER rooms) up to homes way bigger than that.
+
+Compares:
+    - legacy:   the old list/filter based implementation (membership checks over lists, default room by name)
+    - uncached: the set based service, building the home topology at every call
+    - cached:   the set based service over the topology cached by get_home_topology, signature check included (what
+                happens between two topology changes)
+
+Building the topology costs more than the legacy scan itself in homes of realistic size: the uncached path is SLOWER
+than the legacy one up to a few hundred rooms. The cached one pays the signature check of the cache (a pass over the
+DRs, see home_topology.py) at every call: slightly slower than the legacy scan at 20 rooms, faster from a few dozen
+rooms on (it replaced a home state read from MongoDB, which costs more than the whole 20 rooms scan). One run:
+
+       rooms    doors   faults    legacy ms  uncached ms    cached ms
+          20       30        1        0.065        0.239        0.098
+         200      300       12        1.265        2.349        0.883
+        2000     3000      156       82.455       19.437        8.725
+       10000    15000      759     2025.907      142.977       59.314
+
+That's why the MQTT handler always passes the topology cached by get_home_topology (see home_topology.py), the
+uncached path is only there for callers without a smart home id.
+
+Run it from the repository root:
+    python -m benchmarks.bench_fault_recovery
+"""
+import itertools
+import random
+import timeit
+import uuid
+
+from src.services.home_topology import get_home_topology
+from src.services.pettracker_services import FaultRecoveryService
+
+HOME_SIZES = [20, 200, 2000, 10000]  # rooms per home
+DOORS_PER_ROOM = 1.5
+FAULT_RATE = 0.05
+
+
+def build_home(rooms_count: int, seed: int = 42):
+    """Builds the digital replicas of a synthetic smart home: rooms connected by doors, some of them faulted"""
+    rng = random.Random(seed)
+    default_room = {"_id": str(uuid.UUID(int=rng.getrandbits(128))), "type": "room",
+                    "profile": {"name": "Somewhere else"}, "data": {"vacancy_status": True}}
+    rooms = [default_room] + [
+        {"_id": str(uuid.UUID(int=rng.getrandbits(128))), "type": "room",
+         "profile": {"name": f"room {i}"}, "data": {"vacancy_status": True}}
+        for i in range(rooms_count)
+    ]
+
+    doors = []
+    for i in range(int(rooms_count * DOORS_PER_ROOM)):
+        entry_room, exit_room = rng.choice(rooms)["_id"], rng.choice(rooms)["_id"]
+        doors.append({
+            "_id": str(uuid.UUID(int=rng.getrandbits(128))), "type": "door",
+            "profile": {"seq_number": i},
+            "data": {
+                "power_status": i != 0 and rng.random() > FAULT_RATE,  # at least a fault, even in the small homes
+                "entry_side_room_id": entry_room, "exit_side_room_id": exit_room,
+                "override_entry_side_room_id": entry_room, "override_exit_side_room_id": exit_room,
+            }
+        })
+    return default_room["_id"], rooms + doors
+
+
+def legacy_fault_recovery(digital_replicas):
+    """The list/filter based implementation the service had before the home topology"""
+    list_of_faulted_devices = [dr for dr in digital_replicas if dr["type"] == "door" and not dr["data"]["power_status"]]
+    if not list_of_faulted_devices:
+        return None
+
+    default_room_id = [dr for dr in digital_replicas
+                       if dr["type"] == "room" and dr["profile"]["name"] == 'Somewhere else'][0]["_id"]
+
+    faulted_rooms = list(set(itertools.chain.from_iterable(
+        [list(filter(lambda room_id: room_id != default_room_id,
+                     [faulted_device["data"]["override_entry_side_room_id"],
+                      faulted_device["data"]["override_exit_side_room_id"]]))
+         for faulted_device in list_of_faulted_devices]
+    )))
+
+    devices = list(filter(
+        lambda device: (device["_id"] not in [dev["_id"] for dev in list_of_faulted_devices])
+                       and (device["data"]["override_exit_side_room_id"] in faulted_rooms
+                            or device["data"]["override_entry_side_room_id"] in faulted_rooms),
+        filter(lambda dr: dr["type"] == "door", digital_replicas)
+    ))
+
+    return {
+        device["_id"]: {key: default_room_id
+                        for key in ['override_exit_side_room_id', 'override_entry_side_room_id']
+                        if device["data"][key] in faulted_rooms}
+                       | {"power_saving_mode_status": device["data"]["override_exit_side_room_id"] ==
+                                                     device["data"]["override_entry_side_room_id"]}
+        for device in devices
+    }
+
+
+def main():
+    service = FaultRecoveryService()
+    print(f"{'rooms':>8} {'doors':>8} {'faults':>8} {'legacy ms':>12} {'uncached ms':>12} {'cached ms':>12}")
+
+    for rooms_count in HOME_SIZES:
+        default_room_id, digital_replicas = build_home(rooms_count)
+        data = {"digital_replicas": digital_replicas}
+        topology = get_home_topology(f"home-{rooms_count}", digital_replicas, default_room_id)
+        faults = sum(1 for dr in digital_replicas if dr["type"] == "door" and not dr["data"]["power_status"])
+
+        # same suggestions, whatever the implementation
+        expected = legacy_fault_recovery(digital_replicas)
+        assert service.execute(data) == expected
+        assert service.execute(data, default_room_id=default_room_id, topology=topology) == expected
+
+        number = max(1, 2000 // rooms_count)
+        legacy = timeit.timeit(lambda: legacy_fault_recovery(digital_replicas), number=number) / number
+        uncached = timeit.timeit(lambda: service.execute(data, default_room_id=default_room_id), number=number) / number
+        cached = timeit.timeit(
+            lambda: service.execute(data, default_room_id=default_room_id, topology=get_home_topology(
+                f"home-{rooms_count}", digital_replicas, default_room_id)), number=number) / number
+
+        print(f"{rooms_count:>8} {len(digital_replicas) - rooms_count - 1:>8} {faults:>8} "
+              f"{legacy * 1000:>12.3f} {uncached * 1000:>12.3f} {cached * 1000:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark of the MQTT payload formats (see src/application/mqtt/payload_codecs.py) on the messages the devices and
+the server exchange: payload size, decode throughput and decode + schema validation throughput (what parse_envelope
+does for every message).
+
+Compares:
+    - json:     the standard library (how the payloads were decoded before the envelope)
+    - orjson:   the JSON codec in use
+    - cbor:     cbor2, if installed
+    - msgpack:  msgpack, if installed
+
+Run it from the repository root:
+    python -m benchmarks.bench_payload_codecs
+"""
+import json
+import timeit
+
+from src.application.mqtt.mqtt_envelope import PAYLOAD_SCHEMAS
+from src.application.mqtt.payload_codecs import CODECS, CBOR_CONTENT_TYPE, JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE
+
+MESSAGES = {
+    "passingByDetection": {"type": "entry", "value": 1.0, "timestamp": "2024-12-23T18:25:43"},
+    "powerStatus": {"data": False},
+    "denialEntrySetting": {"setting": True, "timestamp": "2024-12-23T18:25:43.511230"},
+}
+NUMBER = 100000
+
+
+def formats():
+    """name -> (loads, dumps) of the formats available in this environment"""
+    available = {"json": (json.loads, lambda obj: json.dumps(obj).encode()),
+                 "orjson": (CODECS[JSON_CONTENT_TYPE].loads, CODECS[JSON_CONTENT_TYPE].dumps)}
+    for name, content_type in [("cbor", CBOR_CONTENT_TYPE), ("msgpack", MSGPACK_CONTENT_TYPE)]:
+        if content_type in CODECS:
+            available[name] = (CODECS[content_type].loads, CODECS[content_type].dumps)
+        else:
+            print(f"{name} not installed, skipped")
+    return available
+
+
+def main():
+    available = formats()
+    print(f"{'topic':>20} {'format':>8} {'bytes':>6} {'decode msg/s':>14} {'decode+validate msg/s':>22}")
+
+    for topic, message in MESSAGES.items():
+        schema = PAYLOAD_SCHEMAS[topic]
+        for name, (loads, dumps) in available.items():
+            payload = dumps(message)
+            assert schema.validate_python(loads(payload)) == schema.validate_python(message)
+
+            decode = timeit.timeit(lambda: loads(payload), number=NUMBER)
+            validate = timeit.timeit(lambda: schema.validate_python(loads(payload)), number=NUMBER)
+
+            print(f"{topic:>20} {name:>8} {len(payload):>6} {NUMBER / decode:>14,.0f} {NUMBER / validate:>22,.0f}")
+
+
+if __name__ == "__main__":
+    main()
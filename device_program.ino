@@ -37,6 +37,7 @@ String topic_denialEntrySetting = String("/denialEntrySetting");
 String topic_denialExitSetting = String("/denialExitSetting");
 String topic_powerStatus = String("/powerStatus");
 String topic_powerSaving = String("/powerSaving");
+String topic_heartbeat = String("/heartbeat");
 
 bool o = false;
 bool i = false;
@@ -60,6 +61,10 @@ String full_topic_denialEntrySetting = (base_topic_plus_device_name_plus_user +
 String full_topic_denialExitSetting = (base_topic_plus_device_name_plus_user + topic_denialExitSetting);
 String full_topic_powerStatus = (base_topic_plus_device_name_plus_user + topic_powerStatus);
 String full_topic_powerSaving = (base_topic_plus_device_name_plus_user + topic_powerSaving);
+String full_topic_heartbeat = (base_topic_plus_device_name_plus_user + topic_heartbeat);
+
+// the server's watchdog considers the device faulted if it doesn't hear from it for a few minutes
+#define HEARTBEAT_INTERVAL_MILLIS 60000
 
 void turn_on_visual_leds_according_to_state() {
   if(powerSaving) {
@@ -744,6 +749,13 @@ void loop() {
   if(!powerSaving)
     check_pet_action();
 
+  // after the sensing: a device stuck somewhere in there stops sending heartbeats too
+  static unsigned long last_heartbeat_clocktime = 0;
+  if((millis() - last_heartbeat_clocktime) > HEARTBEAT_INTERVAL_MILLIS) {
+    last_heartbeat_clocktime = millis();
+    client.publish(full_topic_heartbeat.c_str(), "{}", false); // not retained, it's only a sign of life
+  }
+
 
   client.loop(); // need to call this to check for new MQTT messages
   reconnectWiFi();
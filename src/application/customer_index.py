@@ -0,0 +1,183 @@
+import hashlib
+import math
+import time
+from threading import Lock
+from typing import Dict, Iterable, Optional
+
+from src.virtualization.digital_replica.dr_factory import DRFactory
+
+# Customer index: customer (telegram nickname) -> id of its smart home DR.
+# Every MQTT message and every Telegram update starts by looking for the smart home of a customer, most of the times
+# for the same few customers... and some other times for customers we've never seen (garbage topics, strangers spamming
+# /start to the bot). The index answers both without touching MongoDB:
+#   - positive entries: customer -> smart home id, dropped when a smart home write changes them
+#   - negative entries: customers without a smart home, remembered for a short TTL
+#   - a Bloom filter over all the registered customers, rebuilt periodically (Bloom filters don't support removals,
+#     a deleted customer stays in there until the next rebuild, which is fine since it's just a first filter):
+#     if the customer isn't in there, it surely wasn't registered when the filter got built, and a miss is trusted
+#     (no MongoDB access at all for the strangers). The customers registered through this process get added by our
+#     DRFactory listener right away; the ones registered through another process (another backend instance) reach
+#     the filter at its next periodic rebuild: they get rejected for bloom_rebuild_interval seconds at most.
+
+DEFAULT_NEGATIVE_TTL = 30  # seconds an unknown customer stays unknown without asking MongoDB again
+DEFAULT_BLOOM_REBUILD_INTERVAL = 60  # seconds between two rebuilds of the Bloom filter (one projected scan of the homes)
+DEFAULT_BLOOM_FALSE_POSITIVE_RATE = 0.01
+MIN_BLOOM_CAPACITY = 1024
+
+
+class BloomFilter:
+    """Plain Bloom filter over strings, k indexes out of two hashes (Kirsch-Mitzenmacher double hashing)"""
+
+    def __init__(self, capacity: int, false_positive_rate: float = DEFAULT_BLOOM_FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))  # bits
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str) -> None:
+        for index in self._indexes(item):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(item))
+
+
+class CustomerIndex:
+    """In-memory customer -> smart home id index, see the comment above"""
+
+    def __init__(self, dr_factory: DRFactory,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 bloom_rebuild_interval: float = DEFAULT_BLOOM_REBUILD_INTERVAL):
+        self.dr_factory = dr_factory
+        self.negative_ttl = negative_ttl
+        self.bloom_rebuild_interval = bloom_rebuild_interval
+
+        self._homes: Dict[str, str] = {}  # customer -> smart home id
+        self._unknown: Dict[str, float] = {}  # customer -> expiry of the negative entry
+        self._bloom: Optional[BloomFilter] = None
+        self._bloom_built_at = 0.0
+        self._lock = Lock()  # MQTT, Telegram and HTTP threads all use it
+        self._rebuild_lock = Lock()  # one rebuild at a time, the other threads keep using the old filter meanwhile
+
+        self.rebuild_bloom()
+        # keep the entries up to date with the smart home writes
+        self.dr_factory.add_listener(self.on_dr_event)
+
+    def rebuild_bloom(self) -> None:
+        """Builds the Bloom filter again out of all the registered customers"""
+        try:
+            users = [smart_home_dr["profile"].get("user")
+                     for smart_home_dr in self.dr_factory.query_drs("smart_home", {}, {"profile.user": 1})]
+        except Exception as e:
+            # keep the old one (or none, every lookup goes to MongoDB then)
+            print(f"Failed to rebuild the customers' Bloom filter: {str(e)}")
+            return
+
+        bloom = BloomFilter(max(MIN_BLOOM_CAPACITY, 2 * len(users)))  # room to grow until the next rebuild
+        for user in users:
+            if user:
+                bloom.add(user)
+
+        with self._lock:
+            self._bloom = bloom
+            self._bloom_built_at = time.monotonic()
+
+    def lookup(self, customer: str) -> Optional[str]:
+        """
+        Finds the smart home of a customer
+
+        Args:
+            customer: customer nickname (the telegram one)
+
+        Returns:
+            Optional[str]: id of the customer's smart home DR, None if the customer isn't registered
+        """
+        if not customer:
+            return None
+
+        now = time.monotonic()
+        if now - self._bloom_built_at > self.bloom_rebuild_interval and self._rebuild_lock.acquire(blocking=False):
+            try:
+                self.rebuild_bloom()
+            finally:
+                self._rebuild_lock.release()
+
+        with self._lock:
+            if customer in self._homes:
+                return self._homes[customer]
+            if self._unknown.get(customer, 0) > now:
+                return None
+            if self._bloom is not None and customer not in self._bloom:
+                return None  # surely not registered (as of the last rebuild, see the comment above)
+
+        # maybe registered (or a Bloom false positive): ask MongoDB
+        smart_home_drs = self.dr_factory.query_drs("smart_home", {"profile.user": customer}, {"_id": 1})
+        with self._lock:
+            if smart_home_drs:
+                self._homes[customer] = smart_home_drs[0]["_id"]
+                self._unknown.pop(customer, None)
+                return smart_home_drs[0]["_id"]
+
+            self._remember_unknown(customer, now)
+            return None
+
+    def _remember_unknown(self, customer: str, now: float) -> None:
+        """Negative entry of a customer (lock held)"""
+        self._unknown[customer] = now + self.negative_ttl
+        if len(self._unknown) > 10 * MIN_BLOOM_CAPACITY:
+            # don't let random garbage grow it forever
+            self._unknown = {user: expiry for user, expiry in self._unknown.items() if expiry > now}
+
+    def get_smart_home_dr(self, customer: str) -> Optional[Dict]:
+        """Gets the smart home DR of a customer (by id, no query on the user), None if the customer isn't registered"""
+        smart_home_id = self.lookup(customer)
+        if smart_home_id is None:
+            return None
+
+        smart_home_dr = self.dr_factory.get_dr("smart_home", smart_home_id)
+        if smart_home_dr is None or smart_home_dr["profile"].get("user") != customer:
+            # stale entry (ex. written by another process), forget it and try again with MongoDB
+            self._forget(customers=[customer])
+            smart_home_id = self.lookup(customer)
+            smart_home_dr = self.dr_factory.get_dr("smart_home", smart_home_id) if smart_home_id else None
+        return smart_home_dr
+
+    def _forget(self, customers: Iterable[str] = (), smart_home_id: str = None) -> None:
+        """Drops the positive entries of the given customers and/or pointing to the given smart home"""
+        with self._lock:
+            for customer in customers:
+                self._homes.pop(customer, None)
+            if smart_home_id is not None:
+                for customer in [c for c, home_id in self._homes.items() if home_id == smart_home_id]:
+                    del self._homes[customer]
+
+    def _add(self, customer: str, smart_home_id: str) -> None:
+        with self._lock:
+            self._homes[customer] = smart_home_id
+            self._unknown.pop(customer, None)
+            if self._bloom is not None:
+                self._bloom.add(customer)
+
+    def on_dr_event(self, event: str, dr_type: str, dr_id: str, changes: Optional[Dict]) -> None:
+        """DRFactory listener: keeps the entries up to date with the smart home writes"""
+        if dr_type != "smart_home":
+            return
+
+        if event == "delete":
+            self._forget(smart_home_id=dr_id)
+            return
+
+        user = (changes.get("profile") or {}).get("user")
+        if user is None:
+            return  # the customer of the smart home didn't change
+
+        # new smart home, or smart home given to another customer
+        self._forget(smart_home_id=dr_id)
+        self._add(user, dr_id)
@@ -0,0 +1,283 @@
+from datetime import datetime
+from threading import Lock
+from typing import Dict, List, Optional
+
+from pymongo import ReturnDocument
+
+from database import Database
+from src.virtualization.digital_replica.dr_factory import DRFactory
+
+# The home state is a small denormalized snapshot of a smart home: one document per smart home, holding just the
+# current state of the home and of its rooms and doors (NO HISTORY, NO MEASUREMENTS).
+# It's enough to answer "where's the pet?", "which doors are faulted?", "which rooms are denied?" with a single read,
+# instead of loading the smart home DR plus all its room and door DRs with their whole measurements' lists.
+#
+# {
+#     "_id": smart home DR id,
+#     "user": ..., "chat_id": ..., "pet_name": ..., "default_room_id": ...,
+#     "fault_status": ..., "power_saving_status": ..., "faulted_door_ids": [...],
+#     "pet_room_id": id of the room with vacancy_status == False (None if unknown),
+#     "rooms": {room_id: {"name", "vacancy_status", "denial_status", "last_time_accessed"}},
+#     "doors": {door_id: {"device_name", "seq_number", "power_status", "power_saving_mode_status",
+#                         "entry_side_room_id", "exit_side_room_id",
+#                         "override_entry_side_room_id", "override_exit_side_room_id"}},
+#     "room_ids": [...], "door_ids": [...],  # indexed, to find the home of a room/door
+#     "version": incremented at every change,
+#     "topology_version": incremented at every change of the rooms/doors associations
+# }
+#
+# It's maintained incrementally after the writes that update the DRs: the store listens to the DRFactory writes
+# (see DRFactory.add_listener) and applies the same changes to the snapshot. That's a second write, it can fail after
+# the DR one went through: the snapshots it should have touched get marked dirty (a "dirty" flag on the document, and
+# in memory too in case MongoDB is what failed) and get() rebuilds them out of the DRs at the next read.
+
+HOME_STATES_COLLECTION = "home_states"
+
+# section -> fields copied from the smart home DR into the root of the snapshot
+HOME_STATE_FIELDS = {
+    "profile": ["user", "chat_id", "pet_name", "address"],
+    "data": ["default_room_id", "fault_status", "power_saving_status", "faulted_door_ids"],
+}
+# section -> fields copied from each room/door DR into the snapshot
+ROOM_STATE_FIELDS = {
+    "profile": ["name"],
+    "data": ["vacancy_status", "denial_status", "last_time_accessed"],
+}
+DOOR_STATE_FIELDS = {
+    "profile": ["device_name", "seq_number"],
+    "data": ["power_status", "power_saving_mode_status",
+             "entry_side_room_id", "exit_side_room_id",
+             "override_entry_side_room_id", "override_exit_side_room_id"],
+}
+# a change to any of these changes the topology of the home (which door connects which rooms)
+DOOR_TOPOLOGY_FIELDS = {"entry_side_room_id", "exit_side_room_id",
+                        "override_entry_side_room_id", "override_exit_side_room_id"}
+# a change to any of these changes the rooms/doors of the home, the snapshot gets rebuilt
+HOME_TOPOLOGY_FIELDS = {"list_of_rooms", "list_of_devices"}
+
+
+def _pick_fields(dr: Dict, fields: Dict[str, List[str]]) -> Dict:
+    """Flattens the given section fields of a DR (or of an update_data dict) into a single dictionary"""
+    picked = {}
+    for section, field_names in fields.items():
+        section_data = dr.get(section) or {}
+        for field_name in field_names:
+            if field_name in section_data:
+                picked[field_name] = section_data[field_name]
+    return picked
+
+
+class HomeStateStore:
+    """Keeps a denormalized home_state document per smart home, see the comment above"""
+
+    def __init__(self, db_service: Database, dr_factory: DRFactory, logger=None):
+        self.db_service = db_service
+        self.dr_factory = dr_factory
+        self.logger = logger
+        # DRs whose write didn't make it into the snapshots, see the comment above
+        self._dirty_homes = set()  # smart home ids
+        self._dirty_items = set()  # room/door ids
+        self._dirty_lock = Lock()
+        self._init_home_states_collection()
+        # keep the snapshots up to date with each DR write
+        self.dr_factory.add_listener(self.on_dr_event)
+
+    def _init_home_states_collection(self) -> None:
+        """Initialize the home states collection in MongoDB"""
+        if not self.db_service.is_connected():
+            raise ConnectionError("Database service not connected")
+
+        try:
+            collection = self.db_service.db[HOME_STATES_COLLECTION]
+            collection.create_index("user")
+            collection.create_index("room_ids")
+            collection.create_index("door_ids")
+        except Exception as e:
+            raise Exception(f"Failed to initialize home states collection: {str(e)}")
+
+    @property
+    def collection(self):
+        return self.db_service.db[HOME_STATES_COLLECTION]
+
+    ####################################################################################################################
+    # READS
+
+    def get(self, smart_home_id: str) -> Optional[Dict]:
+        """Gets the home state of a smart home, building it if it's not there yet (or if it missed a write)"""
+        home_state = self.collection.find_one({"_id": smart_home_id})
+        if home_state is None or self._is_dirty(home_state):
+            home_state = self.rebuild(smart_home_id)
+        return home_state
+
+    def get_by_user(self, user: str) -> Optional[Dict]:
+        """Gets the home state of the smart home of a user (telegram nickname), None if the user has no smart home"""
+        home_state = self.collection.find_one({"user": user})
+        if home_state is not None and self._is_dirty(home_state):
+            return self.rebuild(home_state["_id"])
+        if home_state is None:
+            # maybe the smart home was created before the home states existed... look for it and build its snapshot
+            smart_home_drs = self.dr_factory.query_drs("smart_home", {"profile.user": user}, {"_id": 1})
+            if not smart_home_drs:
+                return None
+            home_state = self.rebuild(smart_home_drs[0]["_id"])
+        return home_state
+
+    def _is_dirty(self, home_state: Dict) -> bool:
+        if home_state.get("dirty"):
+            return True
+        with self._dirty_lock:
+            if home_state["_id"] in self._dirty_homes:
+                return True
+            return bool(self._dirty_items) and any(
+                item_id in self._dirty_items
+                for item_id in (home_state.get("room_ids") or []) + (home_state.get("door_ids") or [])
+            )
+
+    ####################################################################################################################
+    # WRITES
+
+    def rebuild(self, smart_home_id: str) -> Optional[Dict]:
+        """(Re)Builds the whole home state of a smart home out of its DRs (without loading their measurements)"""
+        try:
+            smart_home_dr = self.dr_factory.get_dr("smart_home", smart_home_id)
+            if not smart_home_dr:
+                self.collection.delete_one({"_id": smart_home_id})
+                return None
+
+            room_ids = list(smart_home_dr["data"].get("list_of_rooms") or [])
+            door_ids = list(smart_home_dr["data"].get("list_of_devices") or [])
+            # from here on, a write the snapshot misses marks it dirty again
+            with self._dirty_lock:
+                self._dirty_homes.discard(smart_home_id)
+                self._dirty_items.difference_update(room_ids + door_ids)
+            no_history = {"data.measurements": 0}
+
+            rooms = {
+                room_dr["_id"]: _pick_fields(room_dr, ROOM_STATE_FIELDS)
+                for room_dr in self.dr_factory.query_drs("room", {"_id": {"$in": room_ids}}, no_history)
+            }
+            doors = {
+                door_dr["_id"]: _pick_fields(door_dr, DOOR_STATE_FIELDS)
+                for door_dr in self.dr_factory.query_drs("door", {"_id": {"$in": door_ids}}, no_history)
+            }
+
+            # the smart home knows where the pet is, older ones without the pointer need a look at the rooms
+            pet_room_id = smart_home_dr["data"].get("current_room_id")
+            if pet_room_id is None:
+                occupied_rooms = [room_id for room_id, room in rooms.items() if room.get("vacancy_status") is False]
+                pet_room_id = occupied_rooms[0] if len(occupied_rooms) == 1 else None
+
+            return self.collection.find_one_and_update(
+                {"_id": smart_home_id},
+                {
+                    "$set": _pick_fields(smart_home_dr, HOME_STATE_FIELDS) | {
+                        "pet_room_id": pet_room_id,
+                        "rooms": rooms,
+                        "doors": doors,
+                        "room_ids": room_ids,
+                        "door_ids": door_ids,
+                        "dirty": False,
+                        "updated_at": datetime.utcnow(),
+                    },
+                    "$inc": {"version": 1, "topology_version": 1},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except Exception as e:
+            raise Exception(f"Failed to rebuild home state: {str(e)}")
+
+    def on_dr_event(self, event: str, dr_type: str, dr_id: str, changes: Optional[Dict]) -> None:
+        """DRFactory listener: applies a DR write to the home state it belongs to (or marks it dirty, if that fails)"""
+        try:
+            if dr_type == "smart_home":
+                self._on_smart_home_event(event, dr_id, changes)
+            elif dr_type == "room":
+                self._on_item_event(event, dr_id, changes, "rooms", "room_ids", ROOM_STATE_FIELDS)
+            elif dr_type == "door":
+                self._on_item_event(event, dr_id, changes, "doors", "door_ids", DOOR_STATE_FIELDS)
+        except Exception as e:
+            self._log("error", f"Home state not updated after the {event} of {dr_type} {dr_id}, "
+                               f"it will be rebuilt at the next read: {str(e)}")
+            self._mark_dirty(dr_type, dr_id)
+
+    def _mark_dirty(self, dr_type: str, dr_id: str) -> None:
+        with self._dirty_lock:
+            (self._dirty_homes if dr_type == "smart_home" else self._dirty_items).add(dr_id)
+        try:
+            self.collection.update_many(
+                {"$or": [{"_id": dr_id}, {"room_ids": dr_id}, {"door_ids": dr_id}]},
+                {"$set": {"dirty": True}},
+            )
+        except Exception as e:
+            # MongoDB unreachable: the in memory mark is enough for this process
+            self._log("warning", f"Failed to mark the home state of {dr_type} {dr_id} dirty: {str(e)}")
+
+    def _log(self, level: str, message: str) -> None:
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
+
+    def _on_smart_home_event(self, event: str, smart_home_id: str, changes: Optional[Dict]) -> None:
+        if event == "delete":
+            self.collection.delete_one({"_id": smart_home_id})
+            return
+
+        if event == "create" or HOME_TOPOLOGY_FIELDS & set((changes.get("data") or {}).keys()):
+            # new smart home, or rooms/doors added or removed: build it again from scratch
+            self.rebuild(smart_home_id)
+            return
+
+        home_changes = _pick_fields(changes, HOME_STATE_FIELDS)
+        if "current_room_id" in (changes.get("data") or {}):
+            home_changes["pet_room_id"] = changes["data"]["current_room_id"]
+        if home_changes:
+            result = self.collection.update_one(
+                {"_id": smart_home_id},
+                {"$set": home_changes | {"updated_at": datetime.utcnow()}, "$inc": {"version": 1}},
+            )
+            if result.matched_count == 0:
+                self.rebuild(smart_home_id)
+
+    def _on_item_event(self, event: str, item_id: str, changes: Optional[Dict],
+                       items_key: str, ids_key: str, fields: Dict[str, List[str]]) -> None:
+        """Applies the write of a room/door DR to the home states containing it"""
+        if event == "create":
+            return  # rooms and doors belong to a home only once they are added to its lists (see _on_smart_home_event)
+
+        if event == "delete":
+            self.collection.update_many(
+                {ids_key: item_id},
+                {
+                    "$unset": {f"{items_key}.{item_id}": ""},
+                    "$pull": {ids_key: item_id},
+                    "$inc": {"version": 1, "topology_version": 1},
+                },
+            )
+            return
+
+        item_changes = _pick_fields(changes, fields)
+        if not item_changes:
+            return  # ex. just the measurements changed
+
+        now = datetime.utcnow()
+        inc = {"version": 1}
+        if items_key == "doors" and DOOR_TOPOLOGY_FIELDS & item_changes.keys():
+            inc["topology_version"] = 1
+
+        set_fields = {f"{items_key}.{item_id}.{field_name}": value for field_name, value in item_changes.items()}
+        set_fields["updated_at"] = now
+
+        # keep the pet position up to date with the rooms' vacancy statuses
+        if items_key == "rooms" and item_changes.get("vacancy_status") is False:
+            set_fields["pet_room_id"] = item_id
+
+        self.collection.update_many({ids_key: item_id}, {"$set": set_fields, "$inc": inc})
+
+        if items_key == "rooms" and item_changes.get("vacancy_status") is True:
+            # the pet left this room: if it was the pet position, it isn't anymore
+            self.collection.update_many(
+                {ids_key: item_id, "pet_room_id": item_id},
+                {"$set": {"pet_room_id": None}},
+            )
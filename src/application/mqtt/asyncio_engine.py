@@ -0,0 +1,375 @@
+import asyncio
+import heapq
+import itertools
+import random
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Thread, get_ident
+from typing import Callable, Dict, Optional, Tuple, Type
+
+import paho.mqtt.client as mqtt
+
+from src.application.mqtt.work_scheduler import FAULT_PRIORITY, DEFAULT_CUSTOMER_QUEUE_CAP
+
+# Asyncio engine of the DoorMQTTHandler (MQTT_CONFIG "engine": "asyncio"), instead of paho's network thread, the
+# polling reconnection thread and the scheduler's worker pool:
+#   - paho's socket is driven by ONE event loop (add_reader/add_writer on the socket, loop_misc every second for the
+#     keepalives), running in its own thread;
+#   - the reconnections are event driven: a disconnection wakes up the connection supervisor, which reconnects with
+#     exponential backoff and full jitter (instances restarted together don't hammer the broker at the same time);
+#   - the work of each smart home is a coroutine draining the home's priority queue (power statuses first, one event
+#     at a time, in order), started when the home has something to do and gone after idle_timeout of quiet: thousands
+#     of homes cost thousands of small coroutines, not threads. All of them live in a TaskGroup, stopping the engine
+#     cancels and awaits them;
+#   - the DB work (pymongo is synchronous) runs with asyncio.to_thread, at most max_concurrency at a time: the homes
+#     wait for a slot in priority order (fault work first), then in arrival order;
+#   - paho's callbacks (on_message...) run on the loop: what they do before handing the work to a home (the
+#     registration lookups, in MongoDB when not cached) goes to the intake thread with offload(), one callback at a
+#     time in arrival order, so the loop never waits for the DB.
+# submit/join/stop/stats are the same as the WorkScheduler's (see work_scheduler.py), the handler uses either one.
+
+DEFAULT_MAX_CONCURRENCY = 16  # DB calls running at the same time
+DEFAULT_HOME_IDLE_TIMEOUT = 60.0  # seconds before the coroutine of a quiet smart home goes away
+DEFAULT_BACKOFF_BASE = 1.0  # seconds, first reconnection delay (upper bound, see _backoff)
+DEFAULT_BACKOFF_CAP = 60.0  # seconds, longest reconnection delay
+DEFAULT_CONNECT_TIMEOUT = 30.0  # seconds to wait for the CONNACK
+MISC_INTERVAL = 1.0  # seconds between two paho loop_misc calls (keepalive, retries)
+
+
+class _PrioritySlots:
+    """Semaphore whose waiters get the slots by (priority, arrival) order"""
+
+    def __init__(self, slots: int):
+        self._free = slots
+        self._waiters = []  # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+
+    async def acquire(self, priority: int) -> None:
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # got the slot right when cancelled, hand it over
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+
+class AsyncioMQTTEngine:
+    """paho client + smart homes' work on a single asyncio event loop, see the comment above"""
+
+    def __init__(self, client: mqtt.Client, connect: Callable[[], None],
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 customer_queue_cap: int = DEFAULT_CUSTOMER_QUEUE_CAP,
+                 home_idle_timeout: float = DEFAULT_HOME_IDLE_TIMEOUT,
+                 retry_on: Tuple[Type[BaseException], ...] = (),
+                 retry_delay: float = 5,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE,
+                 backoff_cap: float = DEFAULT_BACKOFF_CAP,
+                 on_error: Optional[Callable[[str, Exception], None]] = None,
+                 logger=None):
+        self.client = client
+        self.connect = connect  # blocking connect of the client (raises on failure), runs in a worker thread
+        self.max_concurrency = max_concurrency
+        self.customer_queue_cap = customer_queue_cap
+        self.home_idle_timeout = home_idle_timeout
+        self.retry_on = retry_on
+        self.retry_delay = retry_delay
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.on_error = on_error or (lambda customer, e: print(f"Task of {customer} failed: {str(e)}"))
+        self.logger = logger
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id = None
+        self._socket_fd = None
+        self._thread = None
+        self._sequence = itertools.count()  # arrival order inside a priority
+        self._homes: Dict[str, Dict] = {}  # customer -> {"queue": asyncio.PriorityQueue, "task"} (loop thread only)
+        self._queued: Dict[str, int] = {}  # customer -> tasks submitted and not started, for the caps
+        self._outstanding = 0  # tasks submitted and not over, for join()
+        self._condition = Condition(Lock())
+        self._intake = ThreadPoolExecutor(1, thread_name_prefix="mqtt-intake")  # see offload()
+        self.counters = {"scheduled": 0, "completed": 0, "shed": 0, "retried": 0, "failed": 0, "reconnections": 0}
+
+        # paho callbacks: the handler's ones, plus the events of the connection supervisor
+        self._handler_on_connect = client.on_connect
+        self._handler_on_disconnect = client.on_disconnect
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    # lifecycle #######################################################################################################
+
+    def start(self) -> None:
+        started = Condition()
+        with started:
+            self._thread = Thread(target=self._run, args=(started,), name="mqtt-asyncio")
+            self._thread.daemon = True
+            self._thread.start()
+            started.wait(5.0)
+
+    def _run(self, started: Condition) -> None:
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread_id = get_ident()
+        # the pool of asyncio.to_thread: max_concurrency threads, whatever the number of homes
+        self.loop.set_default_executor(ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="mqtt-db"))
+        asyncio.set_event_loop(self.loop)
+        self._slots = _PrioritySlots(self.max_concurrency)
+        self._stop_requested = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._closing = False
+        try:
+            self.loop.run_until_complete(self._main(started))
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+
+    async def _main(self, started: Condition) -> None:
+        async with asyncio.TaskGroup() as task_group:
+            self._task_group = task_group
+            with started:
+                started.notify_all()  # ready for submit()
+            supervisor = task_group.create_task(self._connection_supervisor())
+            misc = task_group.create_task(self._misc_loop())
+            await self._stop_requested.wait()
+            # structured shutdown: the supervisor, the misc loop and the coroutines of the homes get cancelled
+            # and awaited by the TaskGroup
+            supervisor.cancel()
+            misc.cancel()
+            for home in list(self._homes.values()):
+                home["task"].cancel()
+
+    def disconnect(self, timeout: float = 5.0) -> None:
+        """Closes the MQTT connection for good (no reconnections anymore), the homes' work goes on"""
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        async def close():
+            self._closing = True
+            self.client.disconnect()
+
+        try:
+            asyncio.run_coroutine_threadsafe(close(), self.loop).result(timeout)
+        except Exception as e:
+            self._log("warning", f"MQTT disconnection failed: {e}")
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Runs what's queued (for timeout seconds at most), then stops the loop"""
+        self._intake.shutdown(wait=True)  # what's offloaded may submit more work
+        self.join(timeout)
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stop_requested.set)
+        if self._thread:
+            self._thread.join(timeout=5.0)
+
+    # connection ######################################################################################################
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: uniform between 0 and the exponential bound
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def _connection_supervisor(self) -> None:
+        attempt = 0
+        while not self._closing:
+            self._connected.clear()
+            self._disconnected.clear()
+            try:
+                await asyncio.to_thread(self.connect)  # DNS + TCP connect + CONNECT packet, blocking in paho
+                await asyncio.wait_for(self._wait_connack(), DEFAULT_CONNECT_TIMEOUT)
+            except Exception as e:
+                delay = self._backoff(attempt)
+                attempt += 1
+                self._log("error", f"MQTT connection attempt {attempt} failed ({e}), next one in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            attempt = 0
+            await self._disconnected.wait()  # nothing to do until the broker goes away
+            if not self._closing:
+                self.counters["reconnections"] += 1
+                await asyncio.sleep(self._backoff(0))
+
+    async def _wait_connack(self) -> None:
+        connected = asyncio.ensure_future(self._connected.wait())
+        disconnected = asyncio.ensure_future(self._disconnected.wait())
+        done, pending = await asyncio.wait([connected, disconnected], return_when=asyncio.FIRST_COMPLETED)
+        for future in pending:
+            future.cancel()
+        if not self._connected.is_set():
+            raise ConnectionError("connection refused or closed before the CONNACK")
+
+    async def _misc_loop(self) -> None:
+        while True:
+            await asyncio.sleep(MISC_INTERVAL)
+            self.client.loop_misc()
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if self._handler_on_connect:
+            self._handler_on_connect(client, userdata, flags, rc, properties)
+        self._set_event(self._connected if rc == 0 else self._disconnected)
+
+    def _on_disconnect(self, client, userdata, rc, properties=None):
+        if self._handler_on_disconnect:
+            self._handler_on_disconnect(client, userdata, rc, properties)
+        self._set_event(self._disconnected)
+
+    def _set_event(self, event: asyncio.Event) -> None:
+        self._in_loop(event.set)
+
+    # paho "external loop": the event loop watches paho's socket. The callbacks come from the loop itself (loop_read,
+    # loop_write) or from the thread running connect(): the loop's selector is touched only from the loop's thread.
+    # Sockets are watched by file descriptor: paho closes the socket right after on_socket_close
+    def _in_loop(self, callback, *args):
+        if self._loop_thread_id == get_ident():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._socket_fd = sock.fileno()
+        self._in_loop(self.loop.add_reader, self._socket_fd, self._loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._in_loop(self._remove_socket, self._socket_fd)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, self._socket_fd, self._loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self._remove_writer, self._socket_fd)
+
+    def _remove_socket(self, fd: int):
+        self.loop.remove_reader(fd)
+        self._remove_writer(fd)
+
+    def _remove_writer(self, fd: int):
+        try:
+            self.loop.remove_writer(fd)
+        except OSError:
+            pass  # already closed by paho: the selector dropped it
+
+    def _loop_read(self):
+        self.client.loop_read()  # reads the packets and runs the callbacks (on_message...) right here, in the loop
+
+    def _loop_write(self):
+        self.client.loop_write()
+
+    def offload(self, callback: Callable, *args) -> None:
+        """Runs a blocking part of a paho callback on the intake thread (in arrival order), instead of the loop"""
+        try:
+            self._intake.submit(self._run_offloaded, callback, args)
+        except RuntimeError:
+            self._log("warning", f"Engine stopped, {getattr(callback, '__name__', callback)} dropped")
+
+    def _run_offloaded(self, callback: Callable, args: tuple) -> None:
+        try:
+            callback(*args)
+        except Exception as e:
+            self._log("error", f"Error in {getattr(callback, '__name__', callback)}: {e}")
+
+    # work of the smart homes #########################################################################################
+
+    def submit(self, customer: str, priority: int, task: Callable[[], None],
+               on_done: Optional[Callable[[], None]] = None) -> bool:
+        """Queues a (blocking) task of a customer, from any thread. Returns False if it got shed (queue full,
+        except for the fault work, like the WorkScheduler). on_done gets called once the task is over"""
+        with self._condition:
+            if priority != FAULT_PRIORITY and self._queued.get(customer, 0) >= self.customer_queue_cap:
+                self.counters["shed"] += 1
+                shed = True
+            else:
+                shed = False
+                self._queued[customer] = self._queued.get(customer, 0) + 1
+                self._outstanding += 1
+                self.counters["scheduled"] += 1
+        if shed:
+            if on_done is not None:
+                on_done()
+            return False
+
+        self.loop.call_soon_threadsafe(self._enqueue, customer, (priority, next(self._sequence), task, on_done))
+        return True
+
+    def _enqueue(self, customer: str, item: tuple) -> None:
+        home = self._homes.get(customer)
+        if home is None or home["task"].done():
+            home = self._homes[customer] = {"queue": asyncio.PriorityQueue()}
+            home["task"] = self._task_group.create_task(self._home_worker(customer, home["queue"]))
+        home["queue"].put_nowait(item)
+
+    async def _home_worker(self, customer: str, queue: asyncio.PriorityQueue) -> None:
+        """The coroutine of a smart home: its tasks one at a time, by priority then arrival"""
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), self.home_idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    self._homes.pop(customer, None)
+                    return
+                continue
+            priority, sequence, task, on_done = item
+
+            with self._condition:
+                self._queued[customer] -= 1
+            retry = False
+            await self._slots.acquire(priority)
+            try:
+                await asyncio.to_thread(task)
+                self.counters["completed"] += 1
+            except self.retry_on as e:
+                retry = not self._stop_requested.is_set()
+                self.counters["retried" if retry else "failed"] += 1
+                self.on_error(customer, e)
+            except Exception as e:
+                self.counters["failed"] += 1
+                self.on_error(customer, e)
+            finally:
+                self._slots.release()
+
+            if retry:
+                # same (priority, sequence): back at the head of the home's queue
+                with self._condition:
+                    self._queued[customer] += 1
+                await asyncio.sleep(self.retry_delay)
+                queue.put_nowait(item)
+                continue
+
+            if on_done is not None:
+                try:
+                    on_done()
+                except Exception as e:  # not the TaskGroup's business: it would cancel every other home
+                    self.on_error(customer, e)
+            with self._condition:
+                self._outstanding -= 1
+                self._condition.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Waits (from another thread) until all the submitted tasks are over. Returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._outstanding == 0, timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return dict(self.counters, queued=sum(self._queued.values()), homes=len(self._homes),
+                        running=self._outstanding - sum(self._queued.values()))
+
+    def _log(self, level: str, message: str) -> None:
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
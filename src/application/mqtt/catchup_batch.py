@@ -0,0 +1,62 @@
+from typing import Any, Dict, Optional, Tuple
+
+from src.digital_twin.core import DigitalTwin
+
+# Catch-up mode: when the inbox worker finds a backlog (ex. the persistent MQTT session reconnected after some
+# downtime and the broker delivered all the messages it queued for us), replaying the messages one by one means
+# a smart home DT rebuild and a few DB writes per message.
+# Instead, the worker takes a big batch, groups its messages per smart home (keeping their order), builds each
+# smart home DT once and runs the handlers against it with a HomeWriteBuffer active: the handlers' writes change the
+# in-memory DRs of the DT (so the next event of the batch sees them) and get accumulated, then persisted with one
+# bulk write per DR type when the home's events are over. Back to streaming mode once the backlog is gone.
+
+DEFAULT_CATCHUP_THRESHOLD = 200  # pending messages in the inbox that switch the worker to catch-up mode
+DEFAULT_CATCHUP_BATCH_SIZE = 2000  # messages per catch-up batch
+
+
+class HomeWriteBuffer:
+    """DR writes of a smart home accumulated in memory during a catch-up batch, see the comment above"""
+
+    def __init__(self, smart_home_dt: DigitalTwin, smart_home_dr: dict):
+        self.smart_home_dt = smart_home_dt
+        self.smart_home_dr = smart_home_dr
+        self._sets: Dict[Tuple[str, str], Dict[str, Dict[str, Any]]] = {}  # (dr type, id) -> {section: {field: value}}
+        self._pushes: Dict[Tuple[str, str], Dict[str, Dict[str, list]]] = {}  # (dr type, id) -> {section: {field: items}}
+        self.power_transitions: Dict[str, bool] = {}  # door_id -> last power status, for the coalescer after the flush
+        self.power_envelopes: Dict[str, list] = {}  # door_id -> the messages of those transitions
+
+    def get_dr(self, dr_type: str, dr_id: str) -> Optional[dict]:
+        """The in-memory DR (the one of the DT, already holding the buffered writes)"""
+        if dr_type == "smart_home":
+            return self.smart_home_dr if dr_id == self.smart_home_dr["_id"] else None
+        return self.smart_home_dt.get_digital_replica(dr_id)
+
+    def set(self, dr_type: str, dr_id: str, section: str, fields: Dict[str, Any]) -> None:
+        """Buffers the replacement of some fields (the last value of each field wins), applying it in memory too"""
+        self._sets.setdefault((dr_type, dr_id), {}).setdefault(section, {}).update(fields)
+        dr = self.get_dr(dr_type, dr_id)
+        if dr is not None:
+            dr.setdefault(section, {}).update(fields)
+
+    def push(self, dr_type: str, dr_id: str, section: str, field_name: str, item: Any) -> None:
+        """Buffers an item to append to a List field (ex. a measurement), applying it in memory too"""
+        self._pushes.setdefault((dr_type, dr_id), {}).setdefault(section, {}).setdefault(field_name, []).append(item)
+        dr = self.get_dr(dr_type, dr_id)
+        if dr is not None:
+            dr.setdefault(section, {}).setdefault(field_name, []).append(item)
+
+    def flush(self, dr_factory) -> int:
+        """Persists the buffered writes, one bulk write per DR type. Returns the number of DRs written"""
+        updates: Dict[str, Dict[str, Dict]] = {}
+        for (dr_type, dr_id), sections in self._sets.items():
+            updates.setdefault(dr_type, {}).setdefault(dr_id, {})["set"] = sections
+        for (dr_type, dr_id), sections in self._pushes.items():
+            updates.setdefault(dr_type, {}).setdefault(dr_id, {})["push"] = sections
+
+        written = 0
+        for dr_type, dr_updates in updates.items():
+            written += dr_factory.bulk_update_drs(dr_type, dr_updates)
+
+        self._sets.clear()
+        self._pushes.clear()
+        return written
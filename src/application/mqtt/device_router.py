@@ -0,0 +1,191 @@
+import time
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from database import Database
+from src.application.customer_index import CustomerIndex
+from src.virtualization.digital_replica.dr_factory import DRFactory
+
+# Device routing table: every MQTT message names its device through the topic, pettracker/<customer>/NodeMCU@<seq>/...
+# The routing table maps (customer, seq_number) to the (home_id, door_id) of the device, so that we can tell right away
+# if the publisher is registered (and where to route its message) without building the whole smart home DT.
+#
+# Routes live in the device_routes collection (compound unique index on customer + seq_number) and in an in-memory map
+# in front of it. A route gets resolved through the DRs the first time it's needed, and dropped whenever a write to
+# the DRs may change it (device moved to another home, home deleted, ...).
+# Devices that aren't registered get a short negative entry: a NodeMCU publishing before its registration (or a
+# spammer) doesn't cost a MongoDB round trip per message.
+# Every invalidation bumps a generation counter: a lookup that started before an invalidation doesn't put its (maybe
+# stale) result back in the map, nor in the collection.
+
+DEVICE_ROUTES_COLLECTION = "device_routes"
+DEFAULT_ROUTES_TTL = 60  # seconds an in-memory route is trusted before reading it again from the collection
+DEFAULT_NEGATIVE_TTL = 10  # seconds an unregistered device stays unregistered without asking MongoDB again
+MAX_NEGATIVE_ENTRIES = 10000
+
+
+class DeviceRouter:
+    """Routing table from (customer, seq_number) to (home_id, door_id), see the comment above"""
+
+    def __init__(self, db_service: Database, dr_factory: DRFactory, ttl: float = DEFAULT_ROUTES_TTL,
+                 customer_index: CustomerIndex = None, negative_ttl: float = DEFAULT_NEGATIVE_TTL):
+        self.db_service = db_service
+        self.dr_factory = dr_factory
+        self.customer_index = customer_index
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._routes: Dict[Tuple[str, int], Tuple[str, str, float]] = {}  # (customer, seq) -> (home_id, door_id, expiry)
+        self._unrouted: Dict[Tuple[str, int], float] = {}  # (customer, seq) -> expiry of the negative entry
+        self._generation = 0  # bumped by every invalidation, see the comment above
+        self._lock = Lock()  # MQTT, Telegram and HTTP threads all write DRs
+        self._init_device_routes_collection()
+        # drop the routes that DR writes may invalidate
+        self.dr_factory.add_listener(self.on_dr_event)
+
+    def _init_device_routes_collection(self) -> None:
+        """Initialize the device routes collection in MongoDB"""
+        if not self.db_service.is_connected():
+            raise ConnectionError("Database service not connected")
+
+        try:
+            collection = self.db_service.db[DEVICE_ROUTES_COLLECTION]
+            collection.create_index([("customer", 1), ("seq_number", 1)], unique=True)
+            collection.create_index("home_id")
+            collection.create_index("door_id")
+        except Exception as e:
+            raise Exception(f"Failed to initialize device routes collection: {str(e)}")
+
+    @property
+    def collection(self):
+        return self.db_service.db[DEVICE_ROUTES_COLLECTION]
+
+    def resolve(self, customer: str, seq_number: int) -> Optional[Tuple[str, str]]:
+        """
+        Resolves the device of an MQTT topic
+
+        Args:
+            customer: customer nickname of the topic
+            seq_number: sequential number of the device (NodeMCU@<seq_number>)
+
+        Returns:
+            Optional[Tuple[str, str]]: (home_id, door_id) of the device, None if the customer doesn't own such a device
+        """
+        key = (customer, seq_number)
+
+        # 1. in memory, O(1)
+        now = time.monotonic()
+        with self._lock:
+            route = self._routes.get(key)
+            if route is None and self._unrouted.get(key, 0) > now:
+                return None  # not registered a few seconds ago
+            generation = self._generation
+        if route is not None and route[2] > now:
+            return route[0], route[1]
+
+        # 2. routing table, single indexed lookup
+        route_doc = self.collection.find_one({"customer": customer, "seq_number": seq_number})
+        if route_doc is None:
+            # 3. never routed before: resolve it through the DRs and save it
+            route_doc = self._resolve_through_drs(customer, seq_number, generation)
+
+        with self._lock:
+            if self._generation != generation:
+                # invalidated while we were looking: the answer may be stale, don't cache it
+                return (route_doc["home_id"], route_doc["door_id"]) if route_doc is not None else None
+            if route_doc is None:
+                self._unrouted[key] = now + self.negative_ttl
+                if len(self._unrouted) > MAX_NEGATIVE_ENTRIES:
+                    # don't let random garbage grow it forever
+                    self._unrouted = {k: expiry for k, expiry in self._unrouted.items() if expiry > now}
+                return None
+            self._unrouted.pop(key, None)
+            self._routes[key] = (route_doc["home_id"], route_doc["door_id"], time.monotonic() + self.ttl)
+        return route_doc["home_id"], route_doc["door_id"]
+
+    def _resolve_through_drs(self, customer: str, seq_number: int, generation: int) -> Optional[Dict]:
+        """Finds the door DR of the device through the smart home of the customer, saving the route if found (and if
+        no invalidation happened since generation)"""
+        if self.customer_index is not None:
+            smart_home_dr = self.customer_index.get_smart_home_dr(customer)
+        else:
+            smart_home_drs = self.dr_factory.query_drs("smart_home", {"profile.user": customer},
+                                                       {"_id": 1, "data.list_of_devices": 1})
+            smart_home_dr = smart_home_drs[0] if smart_home_drs else None
+        if smart_home_dr is None:
+            return None
+
+        # the doors of the smart home with that sequential number (doors associated before the home_id back reference
+        # existed are found through the smart home's list of devices)
+        doors = self.dr_factory.query_drs(
+            "door",
+            {
+                "profile.seq_number": seq_number,
+                "$or": [
+                    {"data.home_id": smart_home_dr["_id"]},
+                    {"_id": {"$in": smart_home_dr["data"].get("list_of_devices") or []}},
+                ],
+            },
+            {"_id": 1}
+        )
+        if len(doors) != 1:
+            return None  # not registered... or registered twice, which would be ambiguous anyway
+
+        route_doc = {
+            "customer": customer,
+            "seq_number": seq_number,
+            "home_id": smart_home_dr["_id"],
+            "door_id": doors[0]["_id"],
+        }
+        try:
+            self.collection.insert_one(dict(route_doc))
+        except DuplicateKeyError:
+            pass  # someone else resolved it in the meantime
+        else:
+            with self._lock:
+                stale = self._generation != generation
+            if stale:
+                # an invalidation ran while we were reading the DRs, its delete_many may have come before our insert
+                self.collection.delete_one({"customer": customer, "seq_number": seq_number,
+                                            "door_id": route_doc["door_id"]})
+        return route_doc
+
+    def invalidate(self, home_id: str = None, door_id: str = None) -> None:
+        """Drops the routes leading to a smart home and/or to a door"""
+        filters = []
+        if home_id is not None:
+            filters.append({"home_id": home_id})
+        if door_id is not None:
+            filters.append({"door_id": door_id})
+        if not filters:
+            return
+
+        with self._lock:
+            self._generation += 1  # before the delete, lookups in flight must not write their routes back
+        self.collection.delete_many({"$or": filters})
+        with self._lock:
+            self._generation += 1
+            self._unrouted.clear()  # a device may have just been registered to that home
+            for key, (route_home_id, route_door_id, _) in list(self._routes.items()):
+                if route_home_id == home_id or route_door_id == door_id:
+                    del self._routes[key]
+
+    def on_dr_event(self, event: str, dr_type: str, dr_id: str, changes: Optional[Dict]) -> None:
+        """DRFactory listener: drops the routes that the DR write may have changed"""
+        if event == "create":
+            if dr_type == "door":
+                with self._lock:
+                    self._unrouted.clear()  # a new device, maybe one we've been rejecting
+            return  # new DRs aren't routed yet
+
+        if dr_type == "smart_home":
+            changed = event == "delete" or "user" in (changes.get("profile") or {}) \
+                      or "list_of_devices" in (changes.get("data") or {})
+            if changed:
+                self.invalidate(home_id=dr_id)
+        elif dr_type == "door":
+            changed = event == "delete" or "seq_number" in (changes.get("profile") or {}) \
+                      or "home_id" in (changes.get("data") or {})
+            if changed:
+                self.invalidate(door_id=dr_id)
@@ -0,0 +1,138 @@
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+# Device shadow: for each device and each setting topic the server publishes to (denial settings and power saving),
+# the last state we asked for (desired) and the last state we know the broker holds for the device (reported).
+# The settings are retained QoS 1 messages, so the broker's retained message IS what the device gets when it
+# (re)connects: the state is "reported" when the broker acknowledges our publish (PUBACK), or when we see the retained
+# message coming back to us (the server is subscribed to pettracker/#, ex. right after a reconnection).
+#
+# A publish is needed only if the new setting differs from the desired one, or if the desired one was never
+# acknowledged. Entries whose desired state isn't acknowledged after a while get republished by reconcile().
+# The reported state is trusted for ttl seconds only: other backend instances (or anybody else) may publish settings
+# to the same devices, and with a shared subscription we don't even see their echoes. After that the setting gets
+# published again (retained, so republishing the same value is harmless) and idle entries get dropped.
+# Each device's entries remember the (home_id, door_id) route of the device when known, so that they can be dropped
+# when the door gets deleted, moved to another home or renumbered (forget_door/forget_home, see the handler's DR
+# listener): a new device with the same seq number mustn't inherit a shadow saying its settings are already there.
+
+SHADOW_TOPICS = ("denialEntrySetting", "denialExitSetting", "powerSaving")
+DEFAULT_ACK_TIMEOUT = 30  # seconds to wait for a PUBACK before considering a publish lost
+DEFAULT_SHADOW_TTL = 300  # seconds a reported state is trusted
+
+DeviceKey = Tuple[str, str, int]  # (user, device name, sequential number)
+
+
+class DeviceShadow:
+    """Desired/reported state of the devices' settings, see the comment above"""
+
+    def __init__(self, ack_timeout: float = DEFAULT_ACK_TIMEOUT, ttl: float = DEFAULT_SHADOW_TTL):
+        self.ack_timeout = ack_timeout
+        self.ttl = ttl
+        # (device key, topic) -> {"desired", "reported", "reported_at", "mid", "sent_at"}
+        self._entries: Dict[Tuple[DeviceKey, str], Dict] = {}
+        self._mids: Dict[int, Tuple[DeviceKey, str, bool]] = {}  # in flight publishes, mid -> (key, topic, setting)
+        self._early_acks = set()  # PUBACKs that arrived before the publish got registered with sent()
+        self._routes: Dict[DeviceKey, Tuple[Optional[str], Optional[str]]] = {}  # device key -> (home_id, door_id)
+        self._lock = Lock()
+
+    def needs_publish(self, key: DeviceKey, topic: str, setting: bool) -> bool:
+        """True if the setting has to be published: it's a real change, or the last publish wasn't acknowledged"""
+        with self._lock:
+            entry = self._entries.get((key, topic))
+        if entry is None or entry["desired"] != setting:
+            return True
+        if entry["reported"] == setting:
+            # the broker already holds it... unless somebody else published something else in the meantime
+            return time.monotonic() - entry["reported_at"] > self.ttl
+        # same setting, not acknowledged yet: wait for the PUBACK, republish only if it's late
+        return entry["mid"] is None or time.monotonic() - entry["sent_at"] > self.ack_timeout
+
+    def sent(self, key: DeviceKey, topic: str, setting: bool, mid: Optional[int],
+             route: Optional[Tuple[str, str]] = None) -> None:
+        """Records a publish of a setting, mid being its id (the ticket of the MQTTPublisher's future).
+        route: (home_id, door_id) of the device, if known"""
+        with self._lock:
+            if route is not None:
+                self._routes[key] = route
+            entry = self._entries.setdefault((key, topic), self._new_entry())
+            entry.update(desired=setting, mid=mid, sent_at=time.monotonic())
+            if mid is not None:
+                if mid in self._early_acks:
+                    self._early_acks.discard(mid)
+                    entry.update(reported=setting, reported_at=time.monotonic(), mid=None)
+                else:
+                    self._mids[mid] = (key, topic, setting)
+
+    def acknowledged(self, mid: int) -> None:
+        """PUBACK of a publish: the broker holds the setting now"""
+        with self._lock:
+            in_flight = self._mids.pop(mid, None)
+            if in_flight is None:
+                self._early_acks.add(mid)
+                if len(self._early_acks) > 1024:
+                    self._early_acks.clear()  # mids of publishes that weren't settings (or got reused), forget them
+                return
+            key, topic, setting = in_flight
+            entry = self._entries.get((key, topic))
+            if entry is None:
+                return  # forgotten in the meantime
+            entry.update(reported=setting, reported_at=time.monotonic())
+            if entry["mid"] == mid:
+                entry["mid"] = None
+
+    def reported(self, key: DeviceKey, topic: str, setting: bool) -> None:
+        """The setting came back to us from the broker (our own publish, or the retained message after a reconnection)"""
+        with self._lock:
+            entry = self._entries.setdefault((key, topic), self._new_entry())
+            entry.update(reported=setting, reported_at=time.monotonic())
+
+    def drifted(self) -> List[Tuple[DeviceKey, str, bool]]:
+        """Settings whose desired state isn't what the broker holds, and that aren't waiting for a (not yet late) PUBACK.
+        Drops the entries in sync and idle for longer than the ttl, while it's at it"""
+        now = time.monotonic()
+        with self._lock:
+            for entry_key in [entry_key for entry_key, entry in self._entries.items()
+                              if entry["desired"] == entry["reported"] and entry["mid"] is None
+                              and now - max(entry["reported_at"], entry["sent_at"]) > self.ttl]:
+                del self._entries[entry_key]
+            devices = {key for key, _ in self._entries}
+            for key in [key for key in self._routes if key not in devices]:
+                del self._routes[key]
+
+            return [
+                (key, topic, entry["desired"])
+                for (key, topic), entry in self._entries.items()
+                if entry["desired"] is not None and entry["desired"] != entry["reported"]
+                and (entry["mid"] is None or now - entry["sent_at"] > self.ack_timeout)
+            ]
+
+    @staticmethod
+    def _new_entry() -> Dict:
+        return {"desired": None, "reported": None, "reported_at": 0, "mid": None, "sent_at": 0}
+
+    def forget(self, key: DeviceKey) -> None:
+        """Drops the shadow of a device (ex. the device got removed from its smart home)"""
+        with self._lock:
+            self._forget(key)
+
+    def forget_door(self, door_id: str) -> None:
+        """Drops the shadow of the device of a door DR"""
+        with self._lock:
+            for key in [key for key, (_, route_door_id) in self._routes.items() if route_door_id == door_id]:
+                self._forget(key)
+
+    def forget_home(self, home_id: str) -> None:
+        """Drops the shadow of the devices of a smart home"""
+        with self._lock:
+            for key in [key for key, (route_home_id, _) in self._routes.items() if route_home_id == home_id]:
+                self._forget(key)
+
+    def _forget(self, key: DeviceKey) -> None:
+        # lock held
+        self._routes.pop(key, None)
+        for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == key]:
+            entry = self._entries.pop(entry_key)
+            if entry["mid"] is not None:
+                self._mids.pop(entry["mid"], None)
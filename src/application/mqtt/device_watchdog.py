@@ -0,0 +1,184 @@
+import math
+import time
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+# Silent device watchdog. The faults get detected when a device (or the broker, with its LWT) publishes
+# powerStatus=false: a NodeMCU whose program got stuck but whose TCP session is still up never does.
+# The devices publish a heartbeat (see device_program.ino) besides their normal messages: every message of a device,
+# whatever the topic, is a sign of life. A device not heard of for threshold seconds is considered faulted: the
+# watchdog calls on_silent(device key, seconds of silence), the handler turns it into a synthetic powerStatus=false
+# (and into a synthetic powerStatus=true as soon as the device is heard again).
+# Off by default (threshold 0): the devices with an older firmware, without the heartbeat, are quiet whenever the pet
+# is. And even when on, a device gets watched only after its first heartbeat: its other messages keep it alive, but
+# don't start the watch. With a shared subscription group every instance gets 1/N of a device's messages (heartbeats
+# included, round robin), its last seen times are N times sparser: the threshold has to be way above N heartbeat
+# intervals, or the instances fault devices that are alive (see README_pettracker_1.md).
+#
+# The deadlines live in a hierarchical timing wheel, and the heartbeats don't even touch it: a heartbeat only writes
+# the device's last seen time (O(1), 100k devices are 100k dict entries). When a device's deadline expires the
+# watchdog compares it with the last seen time: the device is either silent (on_silent) or gets its deadline moved
+# to last seen + threshold. So each device costs one wheel operation per threshold, not one per message.
+
+DEFAULT_SILENCE_THRESHOLD = 0  # seconds without messages before a device is considered faulted, 0: no watchdog
+DEFAULT_TICK = 1.0  # seconds, resolution of the wheel
+DEFAULT_WHEEL_SIZE = 64  # slots per level
+DEFAULT_WHEEL_LEVELS = 3  # 64^3 ticks = ~73 hours before the top level has to clamp the deadlines
+
+
+class HierarchicalTimingWheel:
+    """Timers in levels of wheels: level 0 has one slot per tick, each slot of level L covers wheel_size^L ticks.
+    schedule and cancel are O(1), advance costs O(1) per tick plus the timers it expires or cascades down a level.
+    Timers further than the whole wheel wait in the top level, and get placed again when it cascades"""
+
+    def __init__(self, tick: float = DEFAULT_TICK, wheel_size: int = DEFAULT_WHEEL_SIZE,
+                 levels: int = DEFAULT_WHEEL_LEVELS, now: Optional[float] = None):
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.levels = levels
+        self._wheels: List[List[Dict[Hashable, Tuple[int, Any]]]] = [
+            [{} for _ in range(wheel_size)] for _ in range(levels)
+        ]  # level -> slot -> {key: (deadline tick, payload)}
+        self._where: Dict[Hashable, Tuple[int, int]] = {}  # key -> (level, slot)
+        self._current = int((time.monotonic() if now is None else now) / tick)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def schedule(self, key: Hashable, deadline: float, payload: Any = None) -> None:
+        """(Re)schedules the timer of key at deadline (same clock as advance)"""
+        self.cancel(key)
+        self._place(key, math.ceil(deadline / self.tick), payload)
+
+    def cancel(self, key: Hashable) -> None:
+        where = self._where.pop(key, None)
+        if where is not None:
+            level, slot = where
+            del self._wheels[level][slot][key]
+
+    def _place(self, key: Hashable, deadline_tick: int, payload: Any) -> None:
+        delta = max(deadline_tick - self._current, 1)  # already due: next tick
+        tick = self._current + delta
+        for level in range(self.levels):
+            if delta < self.wheel_size ** (level + 1) or level == self.levels - 1:
+                if level == self.levels - 1 and delta >= self.wheel_size ** self.levels:
+                    tick = self._current + self.wheel_size ** self.levels - 1  # too far: wait in the last slot
+                slot = (tick // self.wheel_size ** level) % self.wheel_size
+                self._wheels[level][slot][key] = (deadline_tick, payload)
+                self._where[key] = (level, slot)
+                return
+
+    def advance(self, now: float) -> List[Tuple[Hashable, Any]]:
+        """Moves the wheel to now, returns the (key, payload) of the expired timers"""
+        expired = []
+        target = int(now / self.tick)
+        while self._current < target:
+            self._current += 1
+            # higher levels first: what they cascade into the current slot of a lower level gets handled right away
+            for level in range(self.levels - 1, 0, -1):
+                span = self.wheel_size ** level
+                if self._current % span == 0:
+                    self._cascade(level, (self._current // span) % self.wheel_size, expired)
+            self._cascade(0, self._current % self.wheel_size, expired)
+        return expired
+
+    def _cascade(self, level: int, slot: int, expired: List[Tuple[Hashable, Any]]) -> None:
+        timers = self._wheels[level][slot]
+        if not timers:
+            return
+        self._wheels[level][slot] = {}
+        for key, (deadline_tick, payload) in timers.items():
+            del self._where[key]
+            if deadline_tick <= self._current:
+                expired.append((key, payload))
+            else:
+                self._place(key, deadline_tick, payload)
+
+
+class DeviceWatchdog:
+    """Last seen time of the devices + their silence deadlines in a timing wheel, see the comment above"""
+
+    def __init__(self, on_silent: Callable[[Hashable, float], None],
+                 threshold: float = DEFAULT_SILENCE_THRESHOLD,
+                 tick: float = DEFAULT_TICK):
+        self.on_silent = on_silent
+        self.threshold = threshold
+        self.tick = tick
+        self._wheel = HierarchicalTimingWheel(tick)
+        self._last_seen: Dict[Hashable, float] = {}  # device key -> monotonic time of its last message
+        self._silent: Set[Hashable] = set()  # devices reported to on_silent and not heard since
+        self._lock = Lock()
+        self._stopping = Event()
+        self._thread = None
+        self.counters = {"silent": 0, "back": 0}
+
+    def start(self) -> None:
+        self._thread = Thread(target=self._run, name="device-watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=1.0)
+
+    def is_tracked(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._last_seen
+
+    def heartbeat(self, key: Hashable, start_watching: bool = True) -> bool:
+        """A message of the device. Returns True if the device had been reported silent (it's back).
+        start_watching False: only refreshes a device already watched (a message that isn't a heartbeat)"""
+        now = time.monotonic()
+        with self._lock:
+            if not start_watching and key not in self._last_seen:
+                return False
+            self._last_seen[key] = now
+            if key not in self._wheel:
+                self._wheel.schedule(key, now + self.threshold)
+            if key in self._silent:
+                self._silent.discard(key)
+                self.counters["back"] += 1
+                return True
+        return False
+
+    def forget(self, key: Hashable) -> None:
+        """Stops watching a device (ex. it declared itself offline: there's no silence to detect)"""
+        with self._lock:
+            self._last_seen.pop(key, None)
+            self._silent.discard(key)
+            self._wheel.cancel(key)
+
+    def check(self, now: Optional[float] = None) -> None:
+        """Advances the wheel, reporting the devices silent for longer than the threshold"""
+        now = time.monotonic() if now is None else now
+        silent = []
+        with self._lock:
+            for key, _ in self._wheel.advance(now):
+                last_seen = self._last_seen.get(key)
+                if last_seen is None:
+                    continue
+                if last_seen + self.threshold > now:
+                    self._wheel.schedule(key, last_seen + self.threshold)  # heard in the meantime
+                else:
+                    self._silent.add(key)  # no deadline anymore, until the next heartbeat
+                    self.counters["silent"] += 1
+                    silent.append((key, now - last_seen))
+
+        for key, silence in silent:
+            try:
+                self.on_silent(key, silence)
+            except Exception as e:
+                print(f"Failed to report the silent device {key}: {str(e)}")
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.tick):
+            self.check()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters, tracked=len(self._last_seen), scheduled=len(self._wheel),
+                        currently_silent=len(self._silent))
@@ -0,0 +1,186 @@
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Literal, Optional, Tuple
+
+from paho.mqtt.client import MQTTMessage
+from pydantic import StrictBool, StringConstraints, TypeAdapter, ValidationError
+from typing_extensions import Annotated, TypedDict
+
+from src.application.mqtt.payload_codecs import JSON_CONTENT_TYPE, UnsupportedContentType, get_codec, \
+    split_topic_suffix
+
+# Every MQTT message gets parsed ONCE, right when it's received: topic split and payload decoded and validated.
+# The result (an MQTTEnvelope) is what _on_message, the registration checks and the topic handlers work with,
+# instead of splitting msg.topic and json.loads-ing msg.payload again in each of them.
+#
+# Topic structure: pettracker/customernick/NodeMCU@1/someTopic[.format], payload format: see payload_codecs.py
+
+
+# PAYLOAD SCHEMAS (what the NodeMCU program and the server itself publish, see device_program.ino)
+
+class PassingByDetectionPayload(TypedDict):
+    type: Literal["entry", "exit"]
+    value: float
+    timestamp: Annotated[str, StringConstraints(min_length=1)]
+
+
+class PowerStatusPayload(TypedDict):
+    data: StrictBool  # a real JSON boolean, 1 and "true" aren't power statuses
+
+
+class SettingPayload(TypedDict):
+    setting: StrictBool
+
+
+# topic -> compiled validator of its payload. Topics not in here (unknown ones) keep a None payload.
+PAYLOAD_SCHEMAS: Dict[str, TypeAdapter] = {
+    "passingByDetection": TypeAdapter(PassingByDetectionPayload),
+    "powerStatus": TypeAdapter(PowerStatusPayload),
+    "denialEntrySetting": TypeAdapter(SettingPayload),
+    "denialExitSetting": TypeAdapter(SettingPayload),
+    "powerSaving": TypeAdapter(SettingPayload),
+}
+
+
+# EVENT TIME: the time a passing by detection happened according to the device (its payload's timestamp), in
+# naive UTC like every other datetime of the DRs. Devices without a synced clock (or with a broken one) can't be
+# trusted: timestamps too far in the future or in the past fall back to the time the server received the message.
+# So do the timestamps without a time of day (ex. '23 December 2024'): midnight would stamp every measurement and
+# last_time_accessed of the day at 00:00, and make the whole day's events ties for the reorder buffer.
+MAX_CLOCK_SKEW = timedelta(minutes=5)  # a device clock ahead of ours by more than this is wrong
+# the oldest event a redelivery can bring us: QoS 1 messages queued by the broker for the session (one hour of session
+# expiry, see mqtt_handler.py) plus some device side retries. The inbox keeps the original reception time, so a
+# replay from there isn't older than that either. Older: an unsynced clock (ex. 1970, or yesterday's), not a redelivery
+MAX_EVENT_AGE = timedelta(hours=2)
+DEVICE_TIMESTAMP_FORMATS = ["%d %B %Y %H:%M:%S"]  # besides ISO 8601 and unix time, ex. '23 December 2024 15:30:00'
+_TIME_OF_DAY = re.compile(r"\d{1,2}:\d{2}")  # ISO 8601 timestamps with (at least) hours and minutes
+_SECONDS = re.compile(r"\d{1,2}:\d{2}:\d{2}")  # an ISO 8601 (or formatted) timestamp down to the second
+
+
+def parse_device_timestamp(timestamp: str, received_at: datetime) -> Tuple[datetime, bool]:
+    """Event time of a device timestamp (ISO 8601, unix time in seconds or milliseconds, or one of the
+    DEVICE_TIMESTAMP_FORMATS), received_at if it can't be parsed (a date alone included) or trusted. The flag tells whether the event time is
+    the device's own, with at least one second precision (then it identifies the detection, see
+    passing_by_deduplicator.py)"""
+    event_time = None
+    precise = False
+    try:
+        unix_time = float(timestamp)
+        if unix_time > 1e11:
+            unix_time /= 1000  # milliseconds
+        event_time = datetime.fromtimestamp(unix_time, timezone.utc).replace(tzinfo=None)
+        precise = True
+    except (ValueError, OverflowError, OSError):
+        pass
+
+    if event_time is None:
+        try:
+            if not _TIME_OF_DAY.search(timestamp):
+                raise ValueError("date without a time of day")
+            event_time = datetime.fromisoformat(timestamp)
+            if event_time.tzinfo is not None:
+                event_time = event_time.astimezone(timezone.utc).replace(tzinfo=None)
+            precise = bool(_SECONDS.search(timestamp))  # not just a date, or hours and minutes
+        except ValueError:
+            pass
+
+    for timestamp_format in DEVICE_TIMESTAMP_FORMATS if event_time is None else []:
+        try:
+            event_time = datetime.strptime(timestamp, timestamp_format)
+            precise = "%S" in timestamp_format
+            break
+        except ValueError:
+            pass
+
+    if event_time is None or not (received_at - MAX_EVENT_AGE <= event_time <= received_at + MAX_CLOCK_SKEW):
+        return received_at, False
+    return min(event_time, received_at), precise  # a bit ahead of us: it can't have happened after we received it
+
+
+class MalformedMessage(ValueError):
+    """The topic or the payload of an MQTT message doesn't respect the expected format"""
+
+
+class MQTTEnvelope:
+    """An MQTT message with its topic already split and its payload already decoded and validated"""
+
+    __slots__ = ("root", "customer", "device_name", "seq_number", "topic", "payload", "raw_topic", "raw_payload",
+                 "content_type", "content_type_in_topic", "received_at", "event_time", "precise_event_time",
+                 "inbox_id")
+
+    def __init__(self, root: str, customer: str, device_name: str, seq_number: int, topic: str,
+                 payload: Optional[Dict[str, Any]], raw_topic: str, raw_payload: bytes,
+                 content_type: str = JSON_CONTENT_TYPE, content_type_in_topic: bool = False,
+                 received_at: Optional[datetime] = None, event_time: Optional[datetime] = None,
+                 precise_event_time: bool = False):
+        self.root = root
+        self.customer = customer
+        self.device_name = device_name  # normally "NodeMCU"
+        self.seq_number = seq_number
+        self.topic = topic
+        self.payload = payload
+        self.raw_topic = raw_topic  # kept for the logs
+        self.raw_payload = raw_payload
+        self.content_type = content_type
+        self.content_type_in_topic = content_type_in_topic  # format given by the topic suffix, not by a v5 property
+        self.received_at = received_at or datetime.utcnow()
+        self.event_time = event_time or self.received_at  # see parse_device_timestamp
+        self.precise_event_time = precise_event_time  # event_time is the device's own, down to the second
+        self.inbox_id = None  # id of the message in the MQTT inbox, when it came from there
+
+    @property
+    def device_key(self):
+        """(customer, device name, seq number), the key of the device in the device shadow"""
+        return self.customer, self.device_name, self.seq_number
+
+    def __repr__(self):
+        return f"MQTTEnvelope({self.raw_topic}, {self.payload})"
+
+
+def parse_topic(raw_topic: str):
+    """Splits pettracker/customernick/NodeMCU@1/someTopic into (root, customer, device name, seq number, topic),
+    the topic keeps its format suffix if it has one"""
+    parts = raw_topic.split('/')
+    if len(parts) != 4:
+        raise MalformedMessage(f"Unexpected topic structure: {raw_topic}")
+    root, customer, device, topic = parts
+
+    device_name, separator, seq_number = device.partition('@')
+    if not separator or not seq_number.isdigit():
+        raise MalformedMessage(f"Unexpected device in topic: {raw_topic}")
+
+    return root, customer, device_name, int(seq_number), topic
+
+
+def parse_envelope(msg: MQTTMessage, received_at: Optional[datetime] = None) -> MQTTEnvelope:
+    """Parses an MQTT message, raises MalformedMessage if its topic or payload are not what we expect.
+    received_at: when the message got received (naive UTC), now if not given"""
+    raw_topic = msg.topic
+    root, customer, device_name, seq_number, topic = parse_topic(raw_topic)
+
+    # payload format: v5 Content Type property first, then topic suffix, then JSON
+    topic, suffix_content_type = split_topic_suffix(topic)
+    properties = getattr(msg, "properties", None)
+    property_content_type = getattr(properties, "ContentType", None) if properties is not None else None
+    content_type = property_content_type or suffix_content_type or JSON_CONTENT_TYPE
+
+    payload = None
+    schema = PAYLOAD_SCHEMAS.get(topic)
+    if schema is not None:
+        try:
+            payload = schema.validate_python(get_codec(content_type).loads(msg.payload))
+        except UnsupportedContentType as e:
+            raise MalformedMessage(f"Can't decode the payload of {raw_topic}: {str(e)}")
+        except ValidationError as e:
+            raise MalformedMessage(f"Payload of {raw_topic} does not respect the {topic} format: "
+                                   f"{e.errors(include_url=False)}")
+        except Exception as e:  # each decoder has its own exceptions
+            raise MalformedMessage(f"Payload of {raw_topic} is not valid {content_type}: {str(e)}")
+
+    received_at = received_at or datetime.utcnow()
+    event_time, precise_event_time = parse_device_timestamp(payload["timestamp"], received_at) \
+        if topic == "passingByDetection" else (None, False)
+
+    return MQTTEnvelope(root, customer, device_name, seq_number, topic, payload, raw_topic, msg.payload,
+                        content_type, property_content_type is None and suffix_content_type is not None,
+                        received_at, event_time, precise_event_time)
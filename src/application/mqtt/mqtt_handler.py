@@ -1,31 +1,63 @@
 import asyncio
+import hashlib
 import traceback
 from inspect import trace
-from typing import Optional
+from typing import Dict, List, Optional
 
 import telegram.ext
 from exceptiongroup import catch
 from flask import current_app
 import paho.mqtt.client as mqtt
 from datetime import datetime
-import json
+import os
+import socket
 import time
-from threading import Thread, Event
+import uuid
+from threading import Thread, Event, Lock, local
+from collections import Counter
+from concurrent.futures import Future
 
 from paho.mqtt.client import MQTTMessage
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from pymongo import timeout
+from pymongo.errors import ConnectionFailure
 
 from src.digital_twin.core import DigitalTwin
-
-
-def _get_message_attributes(msg: MQTTMessage) -> (str, str, str, int, str):
-    # returns root of topic, customer nick, nodeMCU name (normally "nodeMCU"), device seq_number (int) and topic
-    root, customer, nodeMCU_seqNumber, topic = msg.topic.split('/')
-
-    # Get NodeMCU seq number
-    device_name, seqNumber = nodeMCU_seqNumber.split('@')
-
-    return root, customer, device_name, int(seqNumber), topic
+from src.services.home_topology import get_home_topology
+from src.application.mqtt.mqtt_envelope import MQTTEnvelope, MalformedMessage, parse_envelope, parse_topic
+from src.application.mqtt.payload_codecs import JSON_CONTENT_TYPE, KNOWN_SUFFIXES, get_codec, split_topic_suffix
+from src.application.mqtt.device_watchdog import DeviceWatchdog, DEFAULT_SILENCE_THRESHOLD
+from src.application.mqtt.passing_by_deduplicator import PassingByDeduplicator, DEFAULT_DEBOUNCE_WINDOW, \
+    DEFAULT_DEDUP_TTL
+from src.application.mqtt.mqtt_inbox import MQTTInbox, InboxMessage, DEFAULT_INBOX_BATCH_SIZE, \
+    DEFAULT_INBOX_POLL_INTERVAL
+from src.application.mqtt.catchup_batch import HomeWriteBuffer, DEFAULT_CATCHUP_THRESHOLD, \
+    DEFAULT_CATCHUP_BATCH_SIZE
+from src.application.mqtt.reorder_buffer import EventReorderBuffer, DEFAULT_ALLOWED_LATENESS
+from src.application.mqtt.mqtt_publisher import MQTTPublisher, PublishError, count_delivered, \
+    DEFAULT_OUTBOUND_QUEUE_SIZE, DEFAULT_PUBLISH_ACK_TIMEOUT
+from src.application.mqtt.asyncio_engine import AsyncioMQTTEngine, DEFAULT_MAX_CONCURRENCY
+from src.application.mqtt.work_scheduler import WorkScheduler, TOPIC_PRIORITIES, FAULT_PRIORITY, ROUTINE_PRIORITY, \
+    DEFAULT_SCHEDULER_WORKERS, DEFAULT_CUSTOMER_CONCURRENCY, DEFAULT_CUSTOMER_QUEUE_CAP
+from src.application.mqtt.device_shadow import DeviceShadow, SHADOW_TOPICS, DEFAULT_ACK_TIMEOUT, DEFAULT_SHADOW_TTL
+from src.application.mqtt.power_event_coalescer import PowerEventCoalescer, DEFAULT_POWER_EVENTS_WINDOW, \
+    DEFAULT_POWER_EVENTS_MAX_DELAY
+
+
+DEFAULT_RECONCILE_INTERVAL = 60  # seconds between two device shadow reconciliation passes
+INBOX_RETRY_DELAY = 5  # seconds the inbox worker waits before retrying a message that failed because of MongoDB
+DEFAULT_SESSION_EXPIRY = 3600  # seconds the broker keeps the session of a configured client id after a disconnection
+
+
+def _generate_client_id() -> str:
+    # unique for each backend process, even on the same host: two clients with the same id kick each other off the broker
+    return f"pettracker-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def _stable_client_id(inbox_path: str) -> str:
+    # same at every restart of an instance, different for the instances of a host (each one has its own inbox file)
+    return f"pettracker-{socket.gethostname()}-{hashlib.sha1(os.path.abspath(inbox_path).encode()).hexdigest()[:8]}"
 
 
 def calculateSecondsOfDifference(t1: datetime, t2: datetime) -> float:
@@ -43,47 +75,39 @@ def sendBotNotification(chat_id, message):
 
 
 def get_smart_home_dt_and_dr_from_customer_username(customer) -> Optional[tuple[str, DigitalTwin, dict]]:
-    # get the smart home DR associated to the customer
-    smart_home_drs = current_app.config['DR_FACTORY'].query_drs("smart_home", {"profile.user": customer})
-    if not smart_home_drs:
+    # get the smart home DR associated to the customer (the customer index knows its id, unknown customers don't even
+    # reach the database)
+    smart_home_dr = current_app.config['CUSTOMER_INDEX'].get_smart_home_dr(customer)
+    if not smart_home_dr:
         current_app.logger.error(
             f"Smart home not found for customer {customer}")
         return None
-    smart_home_dr = smart_home_drs[0]
 
-    # create the smart home DT or get the old one from the database...
-    dt_id = current_app.config['DT_FACTORY'].create_dt(
+    # create the smart home DT or get the old one from the database, SYNCRONIZING ITS DIGITAL REPLICAS WITH THE SMART HOME
+    # DR REPRESENTATION: the room and door DRs of the smart home, plus all the services the DT would have.
+    # The DT gets written only if its references changed since the last time, most of the times this is just a read!
+    smart_home_dt_data = current_app.config['DT_FACTORY'].ensure_dt(
         name="smart_home__" + customer,
+        digital_replicas=(
+            [{"type": "room", "id": room_id} for room_id in smart_home_dr['data']['list_of_rooms']] +
+            [{"type": "door", "id": door_id} for door_id in smart_home_dr['data']['list_of_devices']]
+        ),
+        services=["FaultRecoveryService", "RetrievePetPositionService", "FindFaultsService", "RoomAnalyticsService"],
         description="Digital Twin for smart home management"
     )
-
-    # wipe out the old smart home DT digital replicas (SYNCRONIZE DIGITAL REPLICAS WITH SMART HOME DR REPRESENTATION)
-    current_app.config['DT_FACTORY'].reset_services(dt_id)
-    current_app.config['DT_FACTORY'].reset_digital_replicas(dt_id)
-
-    # add the room and door DRs to the smart home DT, synchronizing it with the DR database
-    for room_id in smart_home_dr['data']['list_of_rooms']:
-        current_app.config['DT_FACTORY'].add_digital_replica(dt_id, "room", room_id)
-    for door_id in smart_home_dr['data']['list_of_devices']:
-        current_app.config['DT_FACTORY'].add_digital_replica(dt_id, "door", door_id)
-
-    # add all the services the DT would have
-    current_app.config['DT_FACTORY'].add_service(dt_id, "FaultRecoveryService")
-    current_app.config['DT_FACTORY'].add_service(dt_id, "RetrievePetPositionService")
-    current_app.config['DT_FACTORY'].add_service(dt_id, "FindFaultsService")
-    current_app.config['DT_FACTORY'].add_service(dt_id, "RoomAnalyticsService")
+    dt_id = smart_home_dt_data["_id"]
 
     # get its instance: it's important because launching this code will retrieve all the door_dr and room_dr
     # data from the database, and we'll be able to access them comfortably through the DT instance's digital_replicas property;
     # IN OTHER WORDS: NO NEED TO CALL get_dr() FOR EACH room_id and door_id IN HERE!!!!
-    smart_home_dt: DigitalTwin = current_app.config['DT_FACTORY'].get_dt_instance(dt_id)
+    smart_home_dt: DigitalTwin = current_app.config['DT_FACTORY'].create_dt_from_data(smart_home_dt_data)
     return dt_id, smart_home_dt, smart_home_dr
 
 
 class DoorMQTTHandler:
     def __init__(self, app):
         self.app = app
-        self.client = mqtt.Client(client_id="1", clean_session=False)
+        self._setup_client()
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
@@ -91,6 +115,31 @@ class DoorMQTTHandler:
         self.connected = False
         self.stopping = Event()
         self.reconnect_thread = None
+        self.reconciliation_thread = None
+        self.inbox_thread = None
+
+    def _setup_client(self):
+        """Creates the paho client: MQTT v5 (needed for the shared subscriptions) and a unique client id"""
+        config = self.app.config.get("MQTT_CONFIG", {})
+        # with a stable client id the broker keeps our session (subscriptions and queued QoS 1 messages) across a
+        # restart: the configured one, or else one derived from the host and the inbox file. Without an inbox there's
+        # nothing stable to derive it from, and a random id would leave an orphan session behind at every restart
+        inbox_path = config.get("inbox_path")
+        self.client_id = config.get("client_id") or (_stable_client_id(inbox_path) if inbox_path
+                                                     else _generate_client_id())
+        self.persistent_session = bool(config.get("client_id") or inbox_path)
+        if not self.persistent_session:
+            self.app.logger.warning(f"MQTT client id {self.client_id} changes at every start, the QoS 1 messages "
+                                    f"published while the backend is down will be lost (set client_id or inbox_path)")
+        self.session_expiry = config.get("session_expiry", DEFAULT_SESSION_EXPIRY)
+        # $share/<group>/pettracker/#: the broker delivers each message to ONE of the backend instances of the group,
+        # so the ingestion can be spread over several processes/hosts. None to get every message (single instance)
+        self.shared_subscription_group = config.get("shared_subscription_group")
+        if self.shared_subscription_group:
+            self.app.logger.warning(f"Shared subscription group {self.shared_subscription_group}: the events of a smart "
+                                    f"home get split across the instances of the group, their order and serialization "
+                                    f"is per instance only (see README_pettracker_1.md)")
+        self.client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5)
 
     def _setup_mqtt(self):
         """Setup MQTT client with configuration from app"""
@@ -103,16 +152,117 @@ class DoorMQTTHandler:
             "passingByDetection": self.passingByDetection_Handler,
             "powerStatus": self.powerStatus_Handler
         }
+        # power status transitions get processed in per smart home batches (0 to process each one right away)
+        power_events_window = config.get("power_events_window", DEFAULT_POWER_EVENTS_WINDOW)
+        self.power_event_coalescer = PowerEventCoalescer(
+            self._on_power_status_batch,
+            window=power_events_window,
+            max_delay=config.get("power_events_max_delay", DEFAULT_POWER_EVENTS_MAX_DELAY)
+        ) if power_events_window > 0 else None
+        # desired/reported state of the settings published to the devices, see device_shadow.py
+        self.device_shadow = DeviceShadow(ack_timeout=config.get("shadow_ack_timeout", DEFAULT_ACK_TIMEOUT),
+                                          ttl=config.get("shadow_ttl", DEFAULT_SHADOW_TTL))
+        self.shadow_reconcile_interval = config.get("shadow_reconcile_interval", DEFAULT_RECONCILE_INTERVAL)
+        # payload format of the settings sent to a device we haven't heard from yet; afterwards, each device gets
+        # answered in the format (and with the content type convention) it used last, see payload_codecs.py
+        self.default_content_type = get_codec(config.get("payload_content_type", JSON_CONTENT_TYPE)).content_type
+        self.device_content_types = {}  # (user, device name, seq number) -> (content type, given by topic suffix?)
+        # (device key, setting topic) -> the topic variant (plain or suffixed) its retained setting was published on
+        self._setting_topic_variants = {}
+        # sensor bounces and QoS 1 redeliveries of the passing by detections stop here, see passing_by_deduplicator.py
+        self.passing_by_deduplicator = PassingByDeduplicator(
+            debounce_window=config.get("passing_by_debounce_window", DEFAULT_DEBOUNCE_WINDOW),
+            dedup_ttl=config.get("passing_by_dedup_ttl", DEFAULT_DEDUP_TTL)
+        )
+        # durable inbox of the received messages, drained by the inbox worker (see mqtt_inbox.py).
+        # No inbox_path: messages get processed right away in paho's network thread
+        inbox_path = config.get("inbox_path")
+        self.inbox = MQTTInbox(inbox_path, batch_size=config.get("inbox_batch_size", DEFAULT_INBOX_BATCH_SIZE)) \
+            if inbox_path else None
+        # backlog in the inbox that switches the worker to catch-up batches (see catchup_batch.py)
+        self.catchup_threshold = config.get("catchup_threshold", DEFAULT_CATCHUP_THRESHOLD)
+        self.catchup_batch_size = config.get("catchup_batch_size", DEFAULT_CATCHUP_BATCH_SIZE)
+        self._batch_state = local()  # the HomeWriteBuffer of the catch-up batch running in this thread, if any
+        # passing by detections get processed in event time (device timestamp) order, see reorder_buffer.py
+        # (0 to process them as they come, they still get stamped with their event time)
+        allowed_lateness = config.get("reorder_allowed_lateness", DEFAULT_ALLOWED_LATENESS)
+        self.reorder_buffer = EventReorderBuffer(self._on_reordered_events, allowed_lateness) \
+            if allowed_lateness > 0 else None
+        # the work that needs the smart home DT runs on a pool of workers: power statuses before passing by detections,
+        # fair across customers (customer_weights: customer -> weight, 1 by default), see work_scheduler.py.
+        # 0 workers: processed in the thread that received the message
+        scheduler_workers = config.get("scheduler_workers", DEFAULT_SCHEDULER_WORKERS)
+        self.scheduler = WorkScheduler(
+            workers=scheduler_workers,
+            customer_concurrency=config.get("customer_concurrency", DEFAULT_CUSTOMER_CONCURRENCY),
+            customer_queue_cap=config.get("customer_queue_cap", DEFAULT_CUSTOMER_QUEUE_CAP),
+            weights=config.get("customer_weights"),
+            retry_on=(ConnectionFailure,),  # MongoDB unreachable: the task waits and gets retried
+            retry_delay=INBOX_RETRY_DELAY,
+            on_error=lambda customer, e: self.app.logger.error(f"Error processing the messages of user {customer}: {e}")
+        ) if scheduler_workers > 0 else None
+        # "asyncio": paho's socket, the reconnections and the handlers' work on a single event loop (see
+        # asyncio_engine.py), the engine takes the place of the scheduler. "threaded": paho's network thread + scheduler
+        self.engine = None
+        if config.get("engine", "threaded") == "asyncio":
+            self.engine = AsyncioMQTTEngine(
+                self.client, self._connect_client,
+                max_concurrency=config.get("engine_max_concurrency", DEFAULT_MAX_CONCURRENCY),
+                customer_queue_cap=config.get("customer_queue_cap", DEFAULT_CUSTOMER_QUEUE_CAP),
+                retry_on=(ConnectionFailure,),
+                retry_delay=INBOX_RETRY_DELAY,
+                on_error=lambda customer, e: self.app.logger.error(f"Error processing the messages of user {customer}: {e}"),
+                logger=self.app.logger
+            )
+            self.scheduler = self.engine  # same submit/join/stop interface
+        # inbox messages handed to the reorder buffer or to the scheduler and not processed yet: the inbox checkpoint
+        # can't go past them
+        self._pending_inbox_ids = Counter()  # inbox id -> holders (reorder buffer, scheduler, coalescer)
+        self._pending_inbox_lock = Lock()
+        # the settings go out on a second connection, with its own outbound queue, see mqtt_publisher.py
+        self.publish_ack_timeout = config.get("publish_ack_timeout", DEFAULT_PUBLISH_ACK_TIMEOUT)
+        # devices not heard of for watchdog_threshold seconds get a synthetic power fault, see device_watchdog.py
+        # (0, the default, to disable: devices without the heartbeat of device_program.ino are quiet whenever the pet is)
+        watchdog_threshold = config.get("watchdog_threshold", DEFAULT_SILENCE_THRESHOLD)
+        if watchdog_threshold > 0 and self.shared_subscription_group:
+            self.app.logger.warning(f"Device watchdog with shared subscription group {self.shared_subscription_group}: "
+                                    f"each instance sees only part of the heartbeats, keep watchdog_threshold "
+                                    f"({watchdog_threshold}s) well above the number of instances times the heartbeat "
+                                    f"interval")
+        self.device_watchdog = DeviceWatchdog(self._on_device_silent, threshold=watchdog_threshold) \
+            if watchdog_threshold > 0 else None
+        self.publisher = MQTTPublisher(self.broker, self.port, f"{self.client_id}-pub",
+                                       queue_size=config.get("publisher_queue_size", DEFAULT_OUTBOUND_QUEUE_SIZE),
+                                       ack_timeout=self.publish_ack_timeout,
+                                       logger=self.app.logger)
 
     def start(self):
         """Start MQTT client in non-blocking way"""
         try:
             self.app.logger.info("Starting MQTT client")
-            self.client.loop_start()
-            self._connect()
-            self.reconnect_thread = Thread(target=self._reconnection_loop)
-            self.reconnect_thread.daemon = True
-            self.reconnect_thread.start()
+            if "DR_FACTORY" in self.app.config:
+                # created after us, see app.py
+                self.app.config["DR_FACTORY"].add_listener(self.on_dr_event)
+            self.publisher.start()
+            if self.engine is not None:
+                self.engine.start()  # connects (and reconnects) by itself, and runs the handlers' work
+            else:
+                self.client.loop_start()
+                self._connect()
+                self.reconnect_thread = Thread(target=self._reconnection_loop)
+                self.reconnect_thread.daemon = True
+                self.reconnect_thread.start()
+                if self.scheduler is not None:
+                    self.scheduler.start()
+            self.reconciliation_thread = Thread(target=self._reconciliation_loop)
+            self.reconciliation_thread.daemon = True
+            self.reconciliation_thread.start()
+            if self.device_watchdog is not None:
+                self.device_watchdog.start()
+            if self.inbox is not None:
+                self.inbox_thread = Thread(target=self._inbox_worker)
+                self.inbox_thread.daemon = True
+                self.inbox_thread.start()
             self.app.logger.info("MQTT handler started")
         except Exception as e:
             self.app.logger.error(f"Error starting MQTT handler: {e}")
@@ -120,22 +270,47 @@ class DoorMQTTHandler:
     def stop(self):
         """Stop MQTT client"""
         self.stopping.set()
+        if self.device_watchdog is not None:
+            self.device_watchdog.stop()
         if self.reconnect_thread:
             self.reconnect_thread.join(timeout=1.0)
-        self.client.loop_stop()
-        if self.connected:
-            self.client.disconnect()
+        if self.engine is not None:
+            self.engine.disconnect()  # the engine keeps running the queued work until engine.stop() below
+        else:
+            self.client.loop_stop()
+            if self.connected:
+                self.client.disconnect()
+        if self.inbox_thread:
+            self.inbox_thread.join(timeout=10.0)  # let it finish (and checkpoint) its current batch
+        if self.reorder_buffer is not None:
+            self.reorder_buffer.flush()  # the detections held for reordering
+        if self.scheduler is not None:
+            self.scheduler.join(timeout=10.0)  # the scheduled messages can still feed the coalescer
+        if self.power_event_coalescer is not None:
+            self.power_event_coalescer.flush()  # don't lose the pending power status transitions
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.publisher.stop()  # after everything that can publish a setting
+        self.app.logger.info(f"MQTT publisher stats: {self.publisher.stats()}")
+        if self.inbox is not None and not (self.inbox_thread and self.inbox_thread.is_alive()):
+            self.inbox.close()
         self.app.logger.info("MQTT handler stopped")
 
     def _connect(self):
         """Attempt to connect to the broker"""
         try:
-            self.client.connect(self.broker, self.port, 60)
-            self.app.logger.info(f"Attempting connection to {self.broker}:{self.port}")
+            self._connect_client()
         except Exception as e:
             self.app.logger.error(f"Connection attempt failed: {e}")
             self.connected = False
 
+    def _connect_client(self):
+        """Connects the client to the broker, raises on failure"""
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.session_expiry if self.persistent_session else 0
+        self.app.logger.info(f"Attempting connection to {self.broker}:{self.port}")
+        self.client.connect(self.broker, self.port, 60, clean_start=not self.persistent_session, properties=properties)
+
     def _reconnection_loop(self):
         """Background thread that handles reconnection"""
         while not self.stopping.is_set():
@@ -147,49 +322,97 @@ class DoorMQTTHandler:
                     self.app.logger.error(f"Reconnection attempt failed: {e}")
             time.sleep(5)
 
-    def _on_connect(self, client, userdata, flags, rc):
+    def _subscription_topic(self) -> str:
+        if self.shared_subscription_group:
+            return f"$share/{self.shared_subscription_group}/{self.base_topic}#"
+        return self.base_topic + "#"
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
         """Handle connection to broker"""
         if rc == 0:
             self.connected = True
-            self.app.logger.info("Connected to MQTT broker")
+            self.app.logger.info(f"Connected to MQTT broker as {self.client_id}")
 
-            self.client.subscribe(self.base_topic + "#", 1)
-            self.app.logger.info("MQTT handler subscribed to topics")
+            self.client.subscribe(self._subscription_topic(), 1)
+            self.app.logger.info(f"MQTT handler subscribed to {self._subscription_topic()}")
         else:
             self.connected = False
             self.app.logger.error(f"Failed to connect to MQTT broker with code: {rc}")
 
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self, client, userdata, rc, properties=None):
         """Handle disconnection from broker"""
         self.connected = False
         if rc != 0:
             self.app.logger.warning(f"Unexpected disconnection from MQTT broker: {rc}")
 
     def _on_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        """Handle incoming messages: into the inbox, the inbox worker will process them (or right away without one)"""
+        if msg.topic.rsplit("/", 1)[-1].startswith("heartbeat"):
+            self._off_the_loop(self._on_heartbeat, msg)  # nothing to persist or process, it only feeds the watchdog
+            return
+
+        if self.inbox is not None:
+            try:
+                properties = getattr(msg, "properties", None)
+                self.inbox.append(msg.topic, msg.payload, getattr(properties, "ContentType", None))
+                return  # returning is what makes paho acknowledge the message
+            except Exception as e:
+                self.app.logger.error(f"Failed to write the MQTT message to the inbox, processing it right away: {e}")
+
+        self._off_the_loop(self._process_message_without_inbox, msg)
+
+    def _off_the_loop(self, callback, *args):
+        """With the asyncio engine paho's callbacks run on the event loop: what may wait for MongoDB (the registration
+        lookups) goes to the engine's intake thread. Right here with paho's network thread"""
+        if self.engine is not None:
+            self.engine.offload(callback, *args)
+        else:
+            callback(*args)
+
+    def _process_message_without_inbox(self, msg: mqtt.MQTTMessage):
+        try:
+            self._process_message(msg)
+        except ConnectionFailure as e:
+            # no inbox to retry it from...
+            self.app.logger.error(f"Error processing MQTT message, database unreachable: {e}")
+
+    def _process_message(self, msg: mqtt.MQTTMessage, redelivery: bool = False, received_at: datetime = None,
+                         inbox_id: int = None):
+        """Processes a received message. Raises ConnectionFailure if MongoDB is unreachable (the message can be
+        retried), every other error gets logged.
+        redelivery is True when the message is being retried after one of those failures.
+        inbox_id: id of the message in the inbox, if it came from there"""
         with self.app.app_context():
-            """Handle incoming messages"""
             dt_id = None
 
             try:
+                envelope = self._accept_message(msg, redelivery, received_at)
+                if envelope is None:
+                    return
+                envelope.inbox_id = inbox_id
 
-                _, customer, _, seqNumber, topic = _get_message_attributes(msg)
-                self.app.logger.info(f"Received message on topic: {msg.topic}")
-                # right now, we are at virtualization layer. We need to first provide DR state replication
-                # Parse topic structure: pettracker/customernick/NodeMCU@1/someTopic
+                if envelope.topic == "passingByDetection" and self.reorder_buffer is not None:
+                    # processed once the watermark of its smart home passes it, see _on_reordered_events
+                    self._hold_inbox_ids([envelope])
+                    self.reorder_buffer.submit(envelope.customer, envelope.event_time, envelope)
+                    return
 
-                # todo: add controls on customernick and nodemcu seqnumber registration + digital signature check
-                result = self._check_if_user_is_registered_through_MQTTmessage(msg)
+                if self.scheduler is not None:
+                    self._schedule_home_events(envelope.customer, [envelope])
+                    return
+
+                result = self._check_if_user_is_registered_through_MQTTmessage(envelope)
 
                 if result:
                     dt_id, smart_home_dt, smart_home_dr = result
-                    if topic in self.messageHandlers.keys():
-                        self.app.logger.info(f"Passing message to handler {topic}")
-                        self.messageHandlers[topic](msg, smart_home_dt, smart_home_dr)
-                    else:
-                        self.app.logger.error(f"Unknown topic: {topic}")
+                    self._dispatch(envelope, smart_home_dt, smart_home_dr)
                 else:
-                    raise Exception(f"User {customer} isn't registered in our systems...")
+                    raise Exception(f"User {envelope.customer} isn't registered in our systems...")
 
+            except MalformedMessage as e:
+                self.app.logger.error(f"Malformed MQTT message: {e}")
+            except ConnectionFailure:
+                raise
             except Exception as e:
                 self.app.logger.error(f"Error processing MQTT message: {e}")
             # finally:
@@ -200,6 +423,325 @@ class DoorMQTTHandler:
             #     except Exception as e:
             #         current_app.logger.error(e)
 
+    def _accept_message(self, msg: mqtt.MQTTMessage, redelivery: bool = False,
+                        received_at: datetime = None) -> Optional[MQTTEnvelope]:
+        """Everything that comes before the smart home DT: parsing, our own settings' echoes, the registration checks
+        and the duplicates. Returns the envelope of a device message to process, None if there's nothing else to do.
+        Raises MalformedMessage, or Exception for unregistered customers/devices"""
+        self.app.logger.info(f"Received message on topic: {msg.topic}")
+        # right now, we are at virtualization layer. We need to first provide DR state replication
+        if not msg.payload:
+            # a retained message getting cleared (a setting moved to another topic variant, see _publish_setting)
+            return None
+        # Parse topic structure: pettracker/customernick/NodeMCU@1/someTopic, and the payload, once and for all
+        envelope = parse_envelope(msg, received_at)
+        customer, seqNumber, topic = envelope.customer, envelope.seq_number, envelope.topic
+
+        if topic in SHADOW_TOPICS:
+            # one of our own settings, not a device message
+            self._on_setting_echo(envelope)
+            return None
+
+        # todo: add controls on customernick and nodemcu seqnumber registration + digital signature check
+        # first, the customer index: garbage topics and unknown customers stop here, without any DB access
+        if self.app.config["CUSTOMER_INDEX"].lookup(customer) is None:
+            raise Exception(f"User {customer} isn't registered in our systems...")
+        # then, the device routing table (in memory most of the times): if the customer doesn't own the
+        # device, there's no need to build the whole smart home DT
+        if self.app.config["DEVICE_ROUTER"].resolve(customer, seqNumber) is None:
+            raise Exception(f"The device with sequential number {seqNumber} isn't registered to user {customer}")
+        self.device_content_types[envelope.device_key] = (envelope.content_type, envelope.content_type_in_topic)
+
+        # (after the registration checks: garbage topics mustn't fill the deduplicator's tables. A message retried by
+        # the inbox worker already went through it). Without a precise device timestamp, the debounce goes by the
+        # reception time (kept by the inbox across replays) and there's no idempotency key
+        if topic == "passingByDetection" and not redelivery and not self.passing_by_deduplicator.accept(
+                envelope.device_key, envelope.payload["type"],
+                envelope.event_time if envelope.precise_event_time else envelope.received_at,
+                envelope.payload["timestamp"] if envelope.precise_event_time else None):
+            self.app.logger.info(f"Duplicate or bouncing passing by detection dropped: {envelope} "
+                                 f"({self.passing_by_deduplicator.stats()})")
+            return None
+
+        # any message is a sign of life of the device (of a device already watched: only the heartbeats start the watch,
+        # the devices with an older firmware don't send them)
+        if self.device_watchdog is not None:
+            if topic == "powerStatus" and not envelope.payload["data"]:
+                self.device_watchdog.forget(envelope.device_key)  # offline by its own account, no silence to detect
+            elif self.device_watchdog.heartbeat(envelope.device_key, start_watching=False) and topic != "powerStatus":
+                self._raise_synthetic_power_status(envelope.device_key, True)  # reported silent, it's back
+
+        return envelope
+
+    def _on_heartbeat(self, msg: mqtt.MQTTMessage):
+        """Heartbeat of a device (see device_program.ino): only the registration checks and the watchdog"""
+        if self.device_watchdog is None:
+            return
+        try:
+            root, customer, device_name, seq_number, topic = parse_topic(msg.topic)
+        except MalformedMessage as e:
+            self.app.logger.error(f"Malformed MQTT message: {e}")
+            return
+        if split_topic_suffix(topic)[0] != "heartbeat":
+            return
+        device_key = (customer, device_name, seq_number)
+
+        if not self.device_watchdog.is_tracked(device_key):
+            # first sign of life since we started: is it one of our devices?
+            with self.app.app_context():
+                if self.app.config["CUSTOMER_INDEX"].lookup(customer) is None or \
+                        self.app.config["DEVICE_ROUTER"].resolve(customer, seq_number) is None:
+                    return
+        if self.device_watchdog.heartbeat(device_key):
+            self._raise_synthetic_power_status(device_key, True)
+
+    def _on_device_silent(self, device_key: tuple, silence: float):
+        """DeviceWatchdog callback: the device has been silent for too long, it's faulted"""
+        customer, device_name, seq_number = device_key
+        self.app.logger.warning(f"{device_name}@{seq_number} of user {customer} silent for {silence:.0f}s, "
+                                f"raising a power fault")
+        self._raise_synthetic_power_status(device_key, False)
+
+    def _raise_synthetic_power_status(self, device_key: tuple, power_status: bool):
+        """A powerStatus message the device didn't send, processed like the ones it sends (powerStatus_Handler,
+        coalescer and all)"""
+        customer, device_name, seq_number = device_key
+        raw_topic = f"{self.base_topic}{customer}/{device_name}@{seq_number}/powerStatus"
+        payload = {"data": power_status}
+        envelope = MQTTEnvelope(self.base_topic.rstrip("/"), customer, device_name, seq_number, "powerStatus",
+                                payload, raw_topic, get_codec(JSON_CONTENT_TYPE).dumps(payload))
+
+        if self.scheduler is not None:
+            self._schedule_home_events(customer, [envelope])
+            return
+        try:
+            self._run_home_events(customer, [envelope])()
+        except Exception as e:
+            self.app.logger.error(f"Error processing the synthetic power status of user {customer}: {e}")
+
+    def _on_reordered_events(self, customer: str, envelopes: List[MQTTEnvelope]):
+        """EventReorderBuffer callback: the passing by detections of a smart home, in event time order
+        (their inbox ids are held already, see _process_message)"""
+        if self.scheduler is not None:
+            self._schedule_home_events(customer, envelopes, hold=False)
+            return
+
+        if self._run_with_retries(self._run_home_events(customer, envelopes),
+                                  f"the passing by detections of user {customer}"):
+            self._release_inbox_ids(envelopes)
+
+    def _run_with_retries(self, task, what: str) -> bool:
+        """Runs a task right away (no scheduler to do it): a ConnectionFailure gets retried every INBOX_RETRY_DELAY
+        seconds, other errors get logged. Returns False if the task gave up because we're stopping: the messages
+        it was processing must stay held, the inbox replays them at the next start"""
+        while True:
+            try:
+                task()
+                return True
+            except ConnectionFailure as e:
+                self.app.logger.warning(f"Database unreachable processing {what}, retrying in {INBOX_RETRY_DELAY}s: {e}")
+                if self.stopping.wait(INBOX_RETRY_DELAY):
+                    return False
+            except Exception as e:
+                self.app.logger.error(f"Error processing {what}: {e}")
+                return True
+
+    def _run_home_events(self, customer: str, envelopes: List[MQTTEnvelope]):
+        """A task that dispatches some events of a smart home, in the given order, against its DT (built once).
+        The task raises ConnectionFailure if MongoDB is unreachable: running it again resumes from the event that
+        failed, the ones before it don't get processed twice"""
+        remaining = list(envelopes)
+
+        def task():
+            with self.app.app_context():
+                result = self._check_if_user_is_registered_through_MQTTmessage(remaining[0])
+                if not result:
+                    raise Exception(f"User {customer} isn't registered in our systems...")
+                dt_id, smart_home_dt, smart_home_dr = result
+                while remaining:
+                    self._dispatch(remaining[0], smart_home_dt, smart_home_dr)
+                    remaining.pop(0)
+
+        return task
+
+    def _schedule_home_events(self, customer: str, envelopes: List[MQTTEnvelope], hold: bool = True):
+        """Hands some events of a smart home to the scheduler, with the priority of their topic. Their inbox ids get
+        held until the task is over (hold=False: the caller held them already)"""
+        if hold:
+            self._hold_inbox_ids(envelopes)
+        priority = TOPIC_PRIORITIES.get(envelopes[0].topic, ROUTINE_PRIORITY)
+        if not self.scheduler.submit(customer, priority, self._run_home_events(customer, envelopes),
+                                     on_done=lambda: self._release_inbox_ids(envelopes)):
+            self.app.logger.warning(f"Queue of user {customer} full, {len(envelopes)} {envelopes[0].topic} "
+                                    f"messages dropped ({self.scheduler.stats()})")
+
+    def _hold_inbox_ids(self, envelopes: List[MQTTEnvelope]):
+        with self._pending_inbox_lock:
+            self._pending_inbox_ids.update(envelope.inbox_id for envelope in envelopes if envelope.inbox_id is not None)
+
+    def _release_inbox_ids(self, envelopes: List[MQTTEnvelope]):
+        with self._pending_inbox_lock:
+            self._pending_inbox_ids.subtract(envelope.inbox_id for envelope in envelopes
+                                             if envelope.inbox_id is not None)
+            for inbox_id in [inbox_id for inbox_id, holders in self._pending_inbox_ids.items() if holders <= 0]:
+                del self._pending_inbox_ids[inbox_id]
+
+    def _checkpoint_id(self, processed_id: int) -> int:
+        """Where the inbox checkpoint can go: up to processed_id, but not past a message that's still pending"""
+        with self._pending_inbox_lock:
+            if not self._pending_inbox_ids:
+                return processed_id
+            return min(min(self._pending_inbox_ids) - 1, processed_id)
+
+    def _dispatch(self, envelope: MQTTEnvelope, smart_home_dt: DigitalTwin, smart_home_dr: dict):
+        if envelope.topic in self.messageHandlers.keys():
+            self.app.logger.info(f"Passing message to handler {envelope.topic}")
+            self.messageHandlers[envelope.topic](envelope, smart_home_dt, smart_home_dr)
+        else:
+            self.app.logger.error(f"Unknown topic: {envelope.topic}")
+
+    def _inbox_worker(self):
+        """Background thread that drains the inbox in batches, moving the checkpoint forward after each one.
+        A message that fails because MongoDB is unreachable stops the batch: it gets retried (and the ones after it
+        wait) until the database comes back, so nothing gets lost and the arrival order is kept.
+        With a backlog, the worker switches to catch-up batches (see catchup_batch.py) until it's gone."""
+        last_id = self.inbox.last_checkpoint()
+        checkpoint_id = last_id
+        retry_up_to_id = 0  # messages up to this one already went through processing once
+        catching_up = False
+        # customer -> last inbox id of its events already persisted by a catch-up batch that failed later on (another
+        # home): the retry of the batch must not apply them again, see _process_catchup_batch
+        flushed_homes: Dict[str, int] = {}
+        self.app.logger.info(f"Inbox worker started, {self.inbox.backlog(last_id)} messages to process")
+
+        while not self.stopping.is_set():
+            # messages still pending in the reorder buffer/scheduler hold the checkpoint back, until they're done
+            if self._checkpoint_id(last_id) > checkpoint_id:
+                checkpoint_id = self._checkpoint_id(last_id)
+                self.inbox.checkpoint(checkpoint_id)
+
+            self.inbox.new_messages.clear()
+            backlog = self.inbox.backlog(last_id)
+            # a failed catch-up batch gets retried as a catch-up batch, whatever the backlog: only that mode knows which
+            # of its homes were already persisted (flushed_homes)
+            if (backlog >= self.catchup_threshold) != catching_up and not flushed_homes:
+                catching_up = not catching_up
+                self.app.logger.info(f"Inbox backlog of {backlog} messages, "
+                                     f"{'switching to catch-up batches' if catching_up else 'back to streaming'}")
+
+            batch = self.inbox.read_batch(last_id, self.catchup_batch_size if catching_up else None)
+            if not batch:
+                self.inbox.new_messages.wait(DEFAULT_INBOX_POLL_INTERVAL)
+                continue
+
+            processed_id = last_id
+            try:
+                if catching_up:
+                    if self.scheduler is not None:
+                        self.scheduler.join()  # the scheduled events of a smart home come before its catch-up ones
+                    self._process_catchup_batch(batch, retry_up_to_id, flushed_homes)
+                    processed_id = batch[-1].id
+                    flushed_homes.clear()
+                else:
+                    for message in batch:
+                        self._process_message(self._message_from_inbox(message),
+                                              redelivery=message.id <= retry_up_to_id,
+                                              received_at=datetime.utcfromtimestamp(message.received_at),
+                                              inbox_id=message.id)
+                        processed_id = message.id
+            except ConnectionFailure as e:
+                retry_up_to_id = max(retry_up_to_id, batch[-1].id if catching_up else processed_id + 1)
+                self.app.logger.warning(f"Database unreachable, messages after {processed_id} will be retried: {e}")
+
+            last_id = max(last_id, processed_id)
+            if self._checkpoint_id(last_id) > checkpoint_id:
+                checkpoint_id = self._checkpoint_id(last_id)
+                self.inbox.checkpoint(checkpoint_id)
+            if retry_up_to_id > last_id:
+                self.stopping.wait(INBOX_RETRY_DELAY)
+
+    def _process_catchup_batch(self, batch: List[InboxMessage], retry_up_to_id: int = 0,
+                               flushed_homes: Dict[str, int] = None):
+        """Processes a catch-up batch: the messages grouped per smart home, one DT per home, the writes of each home
+        persisted in bulk (see catchup_batch.py). Raises ConnectionFailure if MongoDB is unreachable.
+        flushed_homes: customer -> last inbox id of its events already persisted. The homes persisted before a
+        ConnectionFailure get recorded in there, and their events up to that id get skipped when the batch is retried
+        (the measurements are appended, applying them twice would duplicate them). The checkpoint can't move past them
+        meanwhile, the homes after the failed one are still to be processed. A failure in the middle of the flush of
+        a home (between the bulk writes of two DR types) still replays the DR types of that home already written, and
+        so does a restart while the retry is pending (flushed_homes lives in memory only)"""
+        flushed_homes = {} if flushed_homes is None else flushed_homes
+        started_at = time.monotonic()
+        with self.app.app_context():
+            # 1. what doesn't need the smart home DT, message by message (in arrival order)
+            envelopes_per_customer = {}  # customer -> its envelopes in arrival order (dicts keep insertion order)
+            for message in batch:
+                try:
+                    envelope = self._accept_message(self._message_from_inbox(message),
+                                                    redelivery=message.id <= retry_up_to_id,
+                                                    received_at=datetime.utcfromtimestamp(message.received_at))
+                    if envelope is not None and message.id > flushed_homes.get(envelope.customer, 0):
+                        envelope.inbox_id = message.id
+                        envelopes_per_customer.setdefault(envelope.customer, []).append(envelope)
+                except MalformedMessage as e:
+                    self.app.logger.error(f"Malformed MQTT message: {e}")
+                except ConnectionFailure:
+                    raise
+                except Exception as e:
+                    self.app.logger.error(f"Error processing MQTT message: {e}")
+
+            # 2. then the events of each smart home, against a single DT, with the writes buffered
+            written = 0
+            for customer, envelopes in envelopes_per_customer.items():
+                try:
+                    written += self._apply_home_events(envelopes)
+                except ConnectionFailure:
+                    raise
+                except Exception as e:
+                    self.app.logger.error(f"Error processing the catch-up events of user {customer}: {e}")
+                # done with this home (persisted, or dropped like in streaming mode)
+                flushed_homes[customer] = envelopes[-1].inbox_id
+
+        self.app.logger.info(f"Catch-up batch of {len(batch)} messages, {len(envelopes_per_customer)} smart homes, "
+                             f"{written} DRs written in {time.monotonic() - started_at:.2f}s")
+
+    def _apply_home_events(self, envelopes: List[MQTTEnvelope]) -> int:
+        """Runs the events of a smart home against its DT, with a HomeWriteBuffer active. Returns the DRs written"""
+        result = self._check_if_user_is_registered_through_MQTTmessage(envelopes[0])
+        if not result:
+            raise Exception(f"User {envelopes[0].customer} isn't registered in our systems...")
+        dt_id, smart_home_dt, smart_home_dr = result
+
+        buffer = HomeWriteBuffer(smart_home_dt, smart_home_dr)
+        self._batch_state.buffer = buffer
+        try:
+            # the batch is the reorder window: event time order (stable, power statuses have their reception time)
+            for envelope in sorted(envelopes, key=lambda envelope: envelope.event_time):
+                self._dispatch(envelope, smart_home_dt, smart_home_dr)
+        finally:
+            self._batch_state.buffer = None
+
+        written = buffer.flush(self.app.config["DR_FACTORY"])
+
+        for door_id, new_status in buffer.power_transitions.items():
+            envelopes = buffer.power_envelopes.get(door_id, [])
+            self._hold_inbox_ids(envelopes)  # until the coalescer processed them, see _on_power_status_batch
+            self.power_event_coalescer.submit(smart_home_dr["profile"]["user"], door_id, new_status, envelopes)
+        return written
+
+    @staticmethod
+    def _message_from_inbox(message: InboxMessage) -> MQTTMessage:
+        msg = MQTTMessage(topic=message.topic.encode())
+        msg.payload = message.payload
+        if message.content_type:
+            msg.properties = Properties(PacketTypes.PUBLISH)
+            msg.properties.ContentType = message.content_type
+        return msg
+
+    def _write_buffer(self) -> Optional[HomeWriteBuffer]:
+        """The HomeWriteBuffer of the catch-up batch running in this thread, None when streaming"""
+        return getattr(self._batch_state, "buffer", None)
+
     @property
     def is_connected(self):
         """Check if client is currently connected"""
@@ -209,7 +751,7 @@ class DoorMQTTHandler:
     ####################################################################################################################
     # DR STATE REPLICATION AND MQTT HANDLERS
 
-    def _check_if_user_is_registered_through_MQTTmessage(self, msg: MQTTMessage) -> Optional[tuple[str, DigitalTwin, dict]]:
+    def _check_if_user_is_registered_through_MQTTmessage(self, envelope: MQTTEnvelope) -> Optional[tuple[str, DigitalTwin, dict]]:
         """ Check if user mentioned in the MQTT message's topic is registered.
          If yes, returns a Digital Twin representing the associated smart home DT,
          and the smart home DR.
@@ -217,7 +759,7 @@ class DoorMQTTHandler:
          """
 
         # 2b. # todo: add controls on customernick and nodemcu seqnumber registration + digital signature check (for the DEMO they are not needed)
-        _, customer, _, seqNumber, topic = _get_message_attributes(msg)
+        customer = envelope.customer
 
         ####################################################################################################
         ####################################################################################################
@@ -229,13 +771,26 @@ class DoorMQTTHandler:
 
         return get_smart_home_dt_and_dr_from_customer_username(customer)
 
-    def _check_if_device_is_registered_under_user(self, msg: MQTTMessage, smart_home_dt: DigitalTwin) -> Optional[dict]:
+    def _check_if_device_is_registered_under_user(self, envelope: MQTTEnvelope, smart_home_dt: DigitalTwin,
+                                                  smart_home_dr: dict = None) -> Optional[dict]:
         """
         Checks if the device that published the MQTT message is registered under smart home dt.
         If it is returns the DR dict pertaining to the device.
         If it isn't returns None.
         """
-        _, _, _, seqNumber, _ = _get_message_attributes(msg)
+        customer, seqNumber = envelope.customer, envelope.seq_number
+
+        # the device routing table gives us the id of the device's door DR (usually without even touching the DB),
+        # then we pick the DR object from the smart home DT without scanning its replicas.
+        route = self.app.config["DEVICE_ROUTER"].resolve(customer, seqNumber)
+        if route is not None:
+            home_id, door_id = route
+            if smart_home_dr is None or home_id == smart_home_dr["_id"]:
+                door = smart_home_dt.get_digital_replica(door_id)
+                if door is not None:
+                    return door
+
+        # route missing or stale: look for it among the DT's doors
         # get the door DR associated to the device that sent the current MQTT message, to use it later...
         # search it in the list of doors, obtained from the list of all smart_home_dt's digital replicas...
         doors = list(filter(lambda dr: dr["type"] == "door", smart_home_dt.digital_replicas))
@@ -245,7 +800,6 @@ class DoorMQTTHandler:
                 f"This user does not possess any devices.")
             return None
 
-        print(doors)
         # todo check for univocity
         door = list(filter(lambda dr: dr["profile"]["seq_number"] == seqNumber, doors))
 
@@ -259,29 +813,28 @@ class DoorMQTTHandler:
         return door
 
     # check figure 1.3 of analysis document.
-    def passingByDetection_Handler(self, msg: mqtt.MQTTMessage, smart_home_dt: DigitalTwin,
+    def passingByDetection_Handler(self, envelope: MQTTEnvelope, smart_home_dt: DigitalTwin,
                                    smart_home_dr: dict) -> bool:
 
-        # Parse passingBy message type
         try:
+            # already decoded and validated by parse_envelope (see mqtt_envelope.py): a json object like
+            # {type: "entry", value: 1.0, timestamp: '23 December 2024 15:30:00'} (a date alone, like '23 December 2024',
+            # gets the reception time as event time, see parse_device_timestamp)
+            msg_payload = envelope.payload
 
-            msg_payload = json.loads(
-                msg.payload.decode())  # it should be a json object like {type: "entry", value: 1.0, timestamp: '23 December 2024'}
-
-            # 1. annotate date and time of retrieval
-            now = datetime.utcnow()
+            # 1. annotate date and time of the detection (the device's timestamp, see parse_device_timestamp)
+            now = envelope.event_time
 
             with (self.app.app_context()):
                 # we are ready to add the measurements and synchronize room states...
                 # check if the device that published the message is already registered...
-                door = self._check_if_device_is_registered_under_user(msg, smart_home_dt)
+                door = self._check_if_device_is_registered_under_user(envelope, smart_home_dt, smart_home_dr)
 
                 if door is None:
                     raise Exception(f"The device isn't registered to user {smart_home_dr['profile']['user']}")
 
-                # 2a. check if msg_payload is a valid measurement
-                if msg_payload["type"] in ["entry", "exit"] and msg_payload["value"] == 1.0 and msg_payload[
-                    "timestamp"]:
+                # 2a. check if msg_payload is a valid measurement (type and timestamp are checked by the schema already)
+                if msg_payload["value"] == 1.0:
 
                     ####################################################################################################
                     ####################################################################################################
@@ -316,7 +869,8 @@ class DoorMQTTHandler:
                     # 4. is the entry possible inside the current state?
                     # 4a. get the room currently occupied by the pet (use the smart home DT services to gather it)
                     real_exited_room_id = smart_home_dt.execute_service(
-                        "RetrievePetPositionService")  # this variable contains the exited' room according to the internal status of the pet tracking app...
+                        "RetrievePetPositionService",
+                        current_room_id=smart_home_dr["data"].get("current_room_id"))  # this variable contains the exited' room according to the internal status of the pet tracking app...
 
                     if not real_exited_room_id:
                         self.app.logger.error("No room was occupied before this other room! Impossible.")
@@ -330,11 +884,20 @@ class DoorMQTTHandler:
                         # current_app.config["TELEGRAM_APPLICATION"].loop.create_task(sendBotNotification(smart_home_dr["profile"]["chat_id"],
                         #                     "There was a fault in your pet tracker... pet position mismatch. Are you sure you set rooms' associations correctly?")
                         #             )
+                        # the mismatch may come from our own bookkeeping too: double check the pointer against the
+                        # rooms' vacancy statuses (full scan, but just in this rare case)
+                        try:
+                            smart_home_dt.execute_service("RetrievePetPositionService",
+                                                          current_room_id=real_exited_room_id,
+                                                          check_consistency=True)
+                        except Exception as e:
+                            self.app.logger.error(f"Pet position consistency check failed: {e}")
+
                         message = "There was a fault in your pet tracker... pet position mismatch. Are you sure you set rooms' associations correctly?"
                         chat_id = smart_home_dr["profile"]["chat_id"]
                         sendBotNotification(chat_id, message)
                         # and toggle the room vacancy status for that room...
-                        self._update_vacancy_status(now, real_exited_room_id, True)
+                        self._update_vacancy_status(now, real_exited_room_id, True, smart_home_dr)
 
                     ####################################################################################################
                     # 5. update the room vacancy statuses (update the two room DRs with the new vacancy status)
@@ -345,9 +908,9 @@ class DoorMQTTHandler:
                     # we would just be adding a wrong measurement since the room vacancy status can't be False (only 1 room can have it True at any time)!
                     if real_exited_room_id == exited_room_id:
                         # that's why we do it only if there was no fault.
-                        self._update_vacancy_status(now, exited_room_id, True)
+                        self._update_vacancy_status(now, exited_room_id, True, smart_home_dr)
 
-                    self._update_vacancy_status(now, entered_room_id, False)  # this one gets ALWAYS updated.
+                    self._update_vacancy_status(now, entered_room_id, False, smart_home_dr)  # this one gets ALWAYS updated.
 
                     # 6c. And don't forget to add the measurement to the door!
                     self._add_new_door_measurement(now, msg_payload["type"], door["_id"])
@@ -383,32 +946,30 @@ class DoorMQTTHandler:
                         # )
                     return True
                 else:
-                    self.app.logger.error(f"MQTT passing json does not respect right format: {msg.payload}")
+                    self.app.logger.error(f"MQTT passing json does not respect right format: {envelope.raw_payload}")
                     return False
 
-        except json.JSONDecodeError:
-            self.app.logger.error(f"MQTT passing by detection json decode fail: {msg.payload}")
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the message can be retried
         except Exception:
-            self.app.logger.error(f"Generic processing MQTT payload (in passingByDetection handler): {msg.payload}")
+            self.app.logger.error(f"Generic processing MQTT payload (in passingByDetection handler): {envelope.raw_payload}")
 
         return False
 
-    def powerStatus_Handler(self, msg: MQTTMessage, smart_home_dt: DigitalTwin, smart_home_dr: dict) -> bool:
-        now = datetime.utcnow()
+    def powerStatus_Handler(self, envelope: MQTTEnvelope, smart_home_dt: DigitalTwin, smart_home_dr: dict) -> bool:
         try:
 
-            msg_payload = json.loads(
-                msg.payload.decode())  # it should be a json object like {type: "entry", value: 1.0, timestamp: '23 December 2024'}
+            msg_payload = envelope.payload  # already validated by parse_envelope: a json object like {data: true}
 
             # 1. is the device already registered?
             # check if the device that published the message is already registered...
-            door = self._check_if_device_is_registered_under_user(msg, smart_home_dt)
+            door = self._check_if_device_is_registered_under_user(envelope, smart_home_dt, smart_home_dr)
 
             if door is None:
                 raise Exception(f"The device isn't registered to user {smart_home_dr['profile']['user']}")
 
             # 2. What is the content of the powerStatus message?
-            if msg_payload["data"] in [True, False]:
+            if isinstance(msg_payload["data"], bool):
 
                 # 3. update the door DR status, in the smart_home_dt object and in the database...
                 new_status = msg_payload["data"]
@@ -417,194 +978,224 @@ class DoorMQTTHandler:
                 # we modify it
                 door["data"]["power_status"] = new_status
 
-                # for the database part...
-                self._update_power_status(door["_id"], new_status)
-
-                # now that we are done with the state replication stuff, we deal with application logic.
-                if msg_payload["data"]:
-                    # >>>>>>>>>>>>> Figure 1.13 <<<<<<<<<<<<<<
-
-                    # are all devices now functional?
-                    # execute the FindFaults Service to discover it!
-                    list_of_faulted_devices = smart_home_dt.execute_service(
-                        "FindFaultsService")
-
-                    if len(list_of_faulted_devices) == 0:  # yes, all devices are now functional
-                        # clear fault status for smart home dr...
-                        smart_home_dr["data"]["fault_status"] = False
-                        self._update_fault_status(smart_home_dr["_id"], False)
-
-                        # recopy normal room assignments on top of override ones, for all devices...
-                        self._overwrite_override_room_assignments_after_faults_get_cleared(smart_home_dt)
-
-                        # reapply denial statuses for all devices
-                        self._reapply_denial_statuses(smart_home_dt, smart_home_dr)
+                # for the database part... (together with the set of faulted devices of the smart home)
+                self._update_power_status(door["_id"], new_status, smart_home_dt, smart_home_dr)
+
+                # now that we are done with the state replication stuff, we deal with application logic...
+                # ...once per batch of transitions: when the power goes down, all the devices of the home go offline
+                # together, we don't want to recover, republish and notify once per device (see power_event_coalescer.py)
+                if self.power_event_coalescer is not None:
+                    buffer = self._write_buffer()
+                    if buffer is not None:
+                        # catch-up batch: the coalescer reads the smart home from the DB, it gets the transitions
+                        # once the batch's writes are persisted
+                        buffer.power_transitions[door["_id"]] = new_status
+                        buffer.power_envelopes.setdefault(door["_id"], []).append(envelope)
+                        return True
+                    # the message's inbox id stays held until its batch is processed (see _on_power_status_batch)
+                    self._hold_inbox_ids([envelope])
+                    self.power_event_coalescer.submit(smart_home_dr["profile"]["user"], door["_id"], new_status,
+                                                      [envelope])
+                    return True
 
-                        #is power saving mode active?
-                        if smart_home_dr["data"]["power_saving_status"]:
+                return self._process_power_status_batch(smart_home_dt, smart_home_dr, {door["_id"]: new_status})
 
-                            message = f'Device number {door["profile"]["seq_number"]} returned online 🟢.\n ALL FAULTS CLEARED ✅, returned to pre fault room assignments.\n Tracking is still disabled because of global power saving mode 🔋.'
-                            chat_id = smart_home_dr["profile"]["chat_id"]
-                            sendBotNotification(chat_id, message)
-                            # current_app.config["TELEGRAM_APPLICATION"].create_task(
-                            #     sendBotNotification(smart_home_dr["profile"]["chat_id"],
-                            #                     message))
-                        else:
-                            # get the list of devices with power saving ON that do NOT have the same room assignments on both sides...
-                            # and reactivate em!
-                            self._wake_up_devices_with_different_room_assignments(smart_home_dt, smart_home_dr)
+            return False
 
-                            message = f'Device number {door["profile"]["seq_number"]} returned online 🟢.\n ALL FAULTS CLEARED ✅, returned to pre fault room assignments.\n Tracking reactivated 🎯.'
-                            chat_id = smart_home_dr["profile"]["chat_id"]
-                            sendBotNotification(chat_id, message)
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the message can be retried
+        except Exception as e:
+            print(traceback.print_tb(e.__traceback__))
+            self.app.logger.error(f"Generic processing MQTT payload (in powerStatus handler): {envelope.raw_payload}")
 
-                            # current_app.config["TELEGRAM_APPLICATION"].loop.create_task(
-                            #     sendBotNotification(smart_home_dr["profile"]["chat_id"],f'Device number {door["profile"]["seq_number"]} returned online 🟢.\n ALL FAULTS CLEARED ✅, returned to pre fault room assignments.\n Tracking reactivated 🎯.'
-                            #                         ))
+        return False
 
-                        return True
-                    else:  # no, there are still faults...
-                        message = f'Device number {door["profile"]["seq_number"]} returned online 🟢.\n SOME FAULTS STILL PRESENT 😓, override room assignments still active.\n Tracking of the device is still disabled because of override room associations 🔋.'
-                        chat_id = smart_home_dr["profile"]["chat_id"]
-                        sendBotNotification(chat_id, message)
+    def _on_power_status_batch(self, customer: str, transitions: dict, envelopes: List[MQTTEnvelope]):
+        """PowerEventCoalescer callback, runs in the coalescer's timer thread (or, with a scheduler, in one of its
+        workers, as fault work): loads the smart home DT again (the state replication of the batch's messages is already
+        in the DB) and processes the batch. The messages' inbox ids got held when they were submitted: they're released
+        once the batch is processed, if MongoDB is unreachable the batch gets retried (or replayed from the inbox)"""
+        def task():
+            self._process_power_status_transitions(customer, transitions)
 
-                        # current_app.config["TELEGRAM_APPLICATION"].loop.create_task(
-                        #     sendBotNotification(smart_home_dr["profile"]["chat_id"],
-                        #                     f'Device number {door["profile"]["seq_number"]} returned online 🟢.\n SOME FAULTS STILL PRESENT 😓, override room assignments still active.\n Tracking of the device is still disabled because of override room associations 🔋.')
-                        # )
-                        return False
-                else:  # some device went down!
-                    # >>>>>>>>>>>>>>>>> Figure 1.10 <<<<<<<<<<<<<<<<<<<
-                    # send notification to the user...
-                    message = f'Device number {door["profile"]["seq_number"]} has gone offline 🔴.\n Room assignments have been overridden to account for it.\n'
-                    chat_id = smart_home_dr["profile"]["chat_id"]
-                    sendBotNotification(chat_id, message)
-
-                    # current_app.config["TELEGRAM_APPLICATION"].loop.create_task(
-                    #     sendBotNotification(smart_home_dr["profile"]["chat_id"],f'Device number {door["profile"]["seq_number"]} has gone offline 🔴.\n Room assignments have been overridden to account for it.\n'
-                    #
-                    #                     ))
-                    # switch to fault-override denial statuses and room assignments,
-                    # by updating the smart_home fault_status.
-                    smart_home_dr["data"]["fault_status"] = True
-                    self._update_fault_status(smart_home_dr["_id"], True)
-
-                    # retrieve the changes to be made to the door DRs of this faulted smart_home.
-                    suggested_changes = smart_home_dt.execute_service("FaultRecoveryService")
-
-                    if suggested_changes is not None and suggested_changes != {}:
-                        print(suggested_changes)
-                        # apply them.
-                        for device_id, changes in suggested_changes.items():
-
-                            print("Suggested changes: ")
-                            print(device_id)
-                            print(changes)
-
-                            #get the DR python object from the smart_home_dt, to update its variables locally, later
-                            door_changed_dr = list(
-                                filter(lambda door_dr: door_dr["_id"] == device_id,
-                                       filter(lambda digital_replica: digital_replica["type"] == "door",
-                                              smart_home_dt.digital_replicas)
-                                       )
-                            )[0]
-                            # the service returns a suggested change even for the power saving mode.
-                            # Pop it, to not include it in the database update.
-                            suggested_power_saving_mode_change = changes.pop("power_saving_mode_status")
-
-                            # check if the global power saving mode is active. If it isn't, then you can apply the change.
-                            corrected_power_saving_mode_change = suggested_power_saving_mode_change \
-                                if not smart_home_dr["data"]["power_saving_status"] \
-                                else door_changed_dr["data"]["power_saving_mode_status"]
-
-                            # apply suggested room association changes in the database
-                            self.app.config['DR_FACTORY'].update_dr(
-                                "door",
-                                device_id,
-                                {
-                                    "data": changes | {"power_saving_mode_status": corrected_power_saving_mode_change}
-                                }
-                            )
-
-                            # apply suggested changes in the DRs local python objects.
-                            door_changed_dr["data"]["override_entry_side_room_id"] = changes["override_entry_side_room_id"]
-                            door_changed_dr["data"]["override_exit_side_room_id"] = changes["override_exit_side_room_id"]
-                            door_changed_dr["data"]["power_saving_mode_status"] = corrected_power_saving_mode_change
-
-                    # reapply denial statuses...
-                    self._reapply_denial_statuses(smart_home_dt, smart_home_dr)
-
-                    # apply suggested power saving mode status...
-                    self._reapply_power_saving_mode_status(smart_home_dt, smart_home_dr)
-
-                    # check if the pet position was inside one on the rooms associated with the faulted device...
-                    real_pet_position_room_id = smart_home_dt.execute_service("RetrievePetPositionService")
-                    # check door DR, shouldn't be changed yet since the service ignores the faulted devices...
-                    need_to_update_pet_position = (door["data"][
-                                                       "override_entry_side_room_id"] == real_pet_position_room_id) \
-                                                  or \
-                                                  (door["data"][
-                                                       "override_exit_side_room_id"] == real_pet_position_room_id)
-                    if need_to_update_pet_position:
-                        # update the pet position to the somewhere else room. Update the database statistics too...
-                        self._update_vacancy_status(now, real_pet_position_room_id,
-                                                    True)  # this one gets ALWAYS updated.
-                        self._update_vacancy_status(now, smart_home_dr["data"]["default_room_id"],
-                                                    False)  # this one gets ALWAYS updated.
-
-                    # for NodeMCU@SeqNumber,
-                    # set override room association for both sides to the "Somewhere else" room,
-                    # set denial setting accordingly (false to both sides, the default room denial setting is always false)
-                    # AND activate power saving
-                    door["data"]["override_entry_side_room_id"] = smart_home_dr["data"]["default_room_id"]
-                    door["data"]["override_exit_side_room_id"] = smart_home_dr["data"]["default_room_id"]
-                    door["data"]["power_saving_mode_status"] = True
-                    self.publish_denial_setting(smart_home_dr["profile"]["user"],
-                                                door["profile"]["seq_number"],
-                                                False,
-                                                "entry")
-                    self.publish_denial_setting(smart_home_dr["profile"]["user"],
-                                                door["profile"]["seq_number"],
-                                                False,
-                                                "exit")
+        if self.scheduler is not None:
+            self.scheduler.submit(customer, FAULT_PRIORITY, task, on_done=lambda: self._release_inbox_ids(envelopes))
+            return
+        if self._run_with_retries(task, f"the power status transitions of user {customer}"):
+            self._release_inbox_ids(envelopes)
 
-                    self.publish_power_saving_mode(smart_home_dr["profile"]["user"],
-                                                   door["profile"]["seq_number"],
-                                                   door["data"]["power_saving_mode_status"])
+    def _process_power_status_transitions(self, customer: str, transitions: dict):
+        with self.app.app_context():
+            result = get_smart_home_dt_and_dr_from_customer_username(customer)
+            if not result:
+                self.app.logger.error(f"Smart home of {customer} gone before processing its power status transitions")
+                return
+            _, smart_home_dt, smart_home_dr = result
+            self._process_power_status_batch(smart_home_dt, smart_home_dr, transitions)
+
+    def _process_power_status_batch(self, smart_home_dt: DigitalTwin, smart_home_dr: dict, transitions: dict) -> bool:
+        """Application logic of the power status transitions of the devices of a smart home (figures 1.10 and 1.13),
+        once for the whole batch: a single fault recovery over the final set of faulted devices, a single publish of
+        the final settings of each device and a single notification.
+
+        transitions: door_id -> the last power status received for it
+        Returns True if all the faults got cleared."""
+        now = datetime.utcnow()
+        chat_id = smart_home_dr["profile"]["chat_id"]
+
+        doors = [smart_home_dt.get_digital_replica(door_id) for door_id in transitions]
+        went_offline = [door for door in doors if door is not None and not transitions[door["_id"]]]
+        came_online = [door for door in doors if door is not None and transitions[door["_id"]]]
+
+        def device_numbers(door_drs):
+            return ", ".join(str(door["profile"]["seq_number"]) for door in door_drs)
+
+        online_message = f'Device number {device_numbers(came_online)} returned online 🟢.\n' if came_online else ''
+
+        if went_offline:  # some device went down!
+            # >>>>>>>>>>>>>>>>> Figure 1.10 <<<<<<<<<<<<<<<<<<<
+            # switch to fault-override denial statuses and room assignments,
+            # by updating the smart_home fault_status.
+            smart_home_dr["data"]["fault_status"] = True
+            self._update_fault_status(smart_home_dr["_id"], True)
+
+            # retrieve the changes to be made to the door DRs of this faulted smart_home.
+            # the door <-> room graph of the home gets built only when its room associations change
+            topology = get_home_topology(
+                smart_home_dr["_id"],
+                smart_home_dt.digital_replicas,
+                smart_home_dr["data"].get("default_room_id")
+            )
+            suggested_changes = smart_home_dt.execute_service(
+                "FaultRecoveryService",
+                default_room_id=smart_home_dr["data"].get("default_room_id"),
+                topology=topology
+            )
 
-                    # save the changes in the DB too
+            if suggested_changes is not None and suggested_changes != {}:
+                # apply them.
+                for device_id, changes in suggested_changes.items():
+                    #get the DR python object from the smart_home_dt, to update its variables locally, later
+                    door_changed_dr = smart_home_dt.get_digital_replica(device_id)
+                    # the service returns a suggested change even for the power saving mode.
+                    # Pop it, to not include it in the database update.
+                    suggested_power_saving_mode_change = changes.pop("power_saving_mode_status")
+
+                    # check if the global power saving mode is active. If it isn't, then you can apply the change.
+                    corrected_power_saving_mode_change = suggested_power_saving_mode_change \
+                        if not smart_home_dr["data"]["power_saving_status"] \
+                        else door_changed_dr["data"]["power_saving_mode_status"]
+
+                    # apply suggested room association changes in the database
                     self.app.config['DR_FACTORY'].update_dr(
                         "door",
-                        door["_id"],
+                        device_id,
                         {
-                            "data": {
-                                "override_entry_side_room_id": door["data"]["override_entry_side_room_id"],
-                                "override_exit_side_room_id": door["data"]["override_exit_side_room_id"],
-                                "power_saving_mode_status": door["data"]["power_saving_mode_status"]
-                            }
-                        }
+                            "data": changes | {"power_saving_mode_status": corrected_power_saving_mode_change}
+                        },
+                        trusted=True  # we build our updates out of already validated DRs, let MongoDB's validator check them
                     )
 
-                    # oh, and btw, no need to retrieve the list of faulted devices and apply settings to each of them...
-                    # The previous have already been accounted for in past calls to this method.
+                    # apply suggested changes in the DRs local python objects.
+                    # (only the override sides leading to a faulted room are in the changes)
+                    door_changed_dr["data"].update(changes)
+                    door_changed_dr["data"]["power_saving_mode_status"] = corrected_power_saving_mode_change
+
+            # check if the pet position was inside one on the rooms associated with the faulted devices...
+            real_pet_position_room_id = smart_home_dt.execute_service(
+                "RetrievePetPositionService", current_room_id=smart_home_dr["data"].get("current_room_id"))
+            # check the door DRs, they shouldn't be changed yet since the service ignores the faulted devices...
+            need_to_update_pet_position = any(
+                real_pet_position_room_id in (door["data"]["override_entry_side_room_id"],
+                                              door["data"]["override_exit_side_room_id"])
+                for door in went_offline
+            )
+            if need_to_update_pet_position and real_pet_position_room_id != smart_home_dr["data"]["default_room_id"]:
+                # update the pet position to the somewhere else room. Update the database statistics too...
+                self._update_vacancy_status(now, real_pet_position_room_id,
+                                            True, smart_home_dr)  # this one gets ALWAYS updated.
+                self._update_vacancy_status(now, smart_home_dr["data"]["default_room_id"],
+                                            False, smart_home_dr)  # this one gets ALWAYS updated.
+
+            # for each NodeMCU@SeqNumber gone offline,
+            # set override room association for both sides to the "Somewhere else" room,
+            # (so the denial setting will be false to both sides, the default room denial setting is always false)
+            # AND activate power saving
+            for door in went_offline:
+                door["data"]["override_entry_side_room_id"] = smart_home_dr["data"]["default_room_id"]
+                door["data"]["override_exit_side_room_id"] = smart_home_dr["data"]["default_room_id"]
+                door["data"]["power_saving_mode_status"] = True
+
+                # save the changes in the DB too
+                self.app.config['DR_FACTORY'].update_dr(
+                    "door",
+                    door["_id"],
+                    {
+                        "data": {
+                            "override_entry_side_room_id": door["data"]["override_entry_side_room_id"],
+                            "override_exit_side_room_id": door["data"]["override_exit_side_room_id"],
+                            "power_saving_mode_status": door["data"]["power_saving_mode_status"]
+                        }
+                    },
+                    trusted=True
+                )
 
+            # now that every DR is in its final state, publish the denial statuses and power saving modes of each
+            # device, once.
+            self._reapply_denial_statuses(smart_home_dt, smart_home_dr)
+            self._reapply_power_saving_mode_status(smart_home_dt, smart_home_dr)
 
+            # send a single notification to the user...
+            message = f'Device number {device_numbers(went_offline)} has gone offline 🔴.\n Room assignments have been overridden to account for it.\n' \
+                      + online_message
+            sendBotNotification(chat_id, message)
             return False
 
-        except Exception as e:
-            print(traceback.print_tb(e.__traceback__))
-            self.app.logger.error(f"Generic processing MQTT payload (in powerStatus handler): {msg.payload}")
+        if not came_online:
+            return False
 
-        return False
+        # >>>>>>>>>>>>> Figure 1.13 <<<<<<<<<<<<<<
+        # are all devices now functional?
+        # the smart home keeps the set of its faulted devices, no need to look at all the doors!
+        if len(smart_home_dr["data"].get("faulted_door_ids") or []) == 0:  # yes, all devices are now functional
+            # clear fault status for smart home dr...
+            smart_home_dr["data"]["fault_status"] = False
+            self._update_fault_status(smart_home_dr["_id"], False)
+
+            # recopy normal room assignments on top of override ones, for all devices...
+            self._overwrite_override_room_assignments_after_faults_get_cleared(smart_home_dt)
+
+            # reapply denial statuses for all devices
+            self._reapply_denial_statuses(smart_home_dt, smart_home_dr)
+
+            #is power saving mode active?
+            if smart_home_dr["data"]["power_saving_status"]:
+                message = online_message + ' ALL FAULTS CLEARED ✅, returned to pre fault room assignments.\n Tracking is still disabled because of global power saving mode 🔋.'
+            else:
+                # get the list of devices with power saving ON that do NOT have the same room assignments on both sides...
+                # and reactivate em!
+                # (no waiting for the PUBACKs here, nobody reads the count)
+                self._wake_up_devices_with_different_room_assignments(smart_home_dt, smart_home_dr, wait_for_acks=False)
+                message = online_message + ' ALL FAULTS CLEARED ✅, returned to pre fault room assignments.\n Tracking reactivated 🎯.'
+
+            sendBotNotification(chat_id, message)
+            return True
+        else:  # no, there are still faults...
+            message = online_message + ' SOME FAULTS STILL PRESENT 😓, override room assignments still active.\n Tracking of the device is still disabled because of override room associations 🔋.'
+            sendBotNotification(chat_id, message)
+            return False
 
-    def _wake_up_devices_with_different_room_assignments(self, smart_home_dt: DigitalTwin, smart_home_dr: dict) -> int:
-        changed_count = 0
+    def _wake_up_devices_with_different_room_assignments(self, smart_home_dt: DigitalTwin, smart_home_dr: dict,
+                                                         wait_for_acks: bool = True) -> int:
+        """Returns the number of devices that got the setting (PUBACK of the broker), or the number of publishes
+        without wait_for_acks"""
+        deliveries = []
         for digital_replica in smart_home_dt.digital_replicas:
             if digital_replica["type"] == "door":
                 if digital_replica["data"]["entry_side_room_id"] != digital_replica["data"]["exit_side_room_id"]:
-                    self.publish_power_saving_mode(smart_home_dr["profile"]["user"],
-                                                   digital_replica["profile"]["seq_number"],
-                                                   False)
+                    deliveries.append(self.publish_power_saving_mode(smart_home_dr["profile"]["user"],
+                                                                     digital_replica["profile"]["seq_number"],
+                                                                     False))
 
                     self.app.config['DR_FACTORY'].update_dr(
                         "door",
@@ -613,19 +1204,24 @@ class DoorMQTTHandler:
                             "data": {
                                 "power_saving_mode_status": False
                             }
-                        }
+                        },
+                        trusted=True
                     )
-                    changed_count += 1
-        return changed_count
-
-    def _put_to_sleep_online_devices(self, smart_home_dt: DigitalTwin, smart_home_dr: dict) -> int:
-        changed_count = 0
+        if not wait_for_acks:
+            return len(deliveries)
+        return count_delivered(deliveries, self.publish_ack_timeout)
+
+    def _put_to_sleep_online_devices(self, smart_home_dt: DigitalTwin, smart_home_dr: dict,
+                                     wait_for_acks: bool = True) -> int:
+        """Returns the number of devices that got the setting (PUBACK of the broker), or the number of publishes
+        without wait_for_acks"""
+        deliveries = []
         for digital_replica in smart_home_dt.digital_replicas:
             if digital_replica["type"] == "door":
                 if not digital_replica["data"]["power_saving_mode_status"]:
-                    self.publish_power_saving_mode(smart_home_dr["profile"]["user"],
-                                                   digital_replica["profile"]["seq_number"],
-                                                   True)
+                    deliveries.append(self.publish_power_saving_mode(smart_home_dr["profile"]["user"],
+                                                                     digital_replica["profile"]["seq_number"],
+                                                                     True))
 
                     self.app.config['DR_FACTORY'].update_dr(
                         "door",
@@ -634,10 +1230,12 @@ class DoorMQTTHandler:
                             "data": {
                                 "power_saving_mode_status": True
                             }
-                        }
+                        },
+                        trusted=True
                     )
-                    changed_count += 1
-        return changed_count
+        if not wait_for_acks:
+            return len(deliveries)
+        return count_delivered(deliveries, self.publish_ack_timeout)
 
     def _overwrite_override_room_assignments_after_faults_get_cleared(self, smart_home_dt: DigitalTwin):
         # for each door replica in the DT...
@@ -655,7 +1253,8 @@ class DoorMQTTHandler:
                             "override_entry_side_room_id": digital_replica["data"]["entry_side_room_id"],
                             "override_exit_side_room_id": digital_replica["data"]["exit_side_room_id"]
                         }
-                    }
+                    },
+                    trusted=True
                 )
 
                 self.app.logger.info(
@@ -707,6 +1306,87 @@ class DoorMQTTHandler:
                                             exit_side_room["data"]["denial_status"],
                                             "exit")
 
+    def _denial_updates_for_rooms(self, smart_home_dt: DigitalTwin, smart_home_dr: dict, changed_room_ids) -> dict:
+        """Minimal device-side updates after the denial statuses of some rooms changed: only the sides of the doors
+        leading to those rooms (found through the room -> doors reverse index of the home topology), with the denial
+        status taken from the DT's room DRs (no DB round trips).
+
+        Returns door_id -> {side ("entry"/"exit"): denial setting}"""
+        topology = get_home_topology(
+            smart_home_dr["_id"],
+            smart_home_dt.digital_replicas,
+            smart_home_dr["data"].get("default_room_id")
+        )
+        # during a fault the devices use their override room associations
+        override = bool(smart_home_dr["data"]["fault_status"])
+        edges = topology.override_edges if override else topology.edges
+
+        changed_room_ids = set(changed_room_ids)
+        affected_door_ids = set().union(*(topology.doors_of(room_id, override) for room_id in changed_room_ids))
+
+        updates = {}
+        for door_id in affected_door_ids:
+            entry_side_room_id, exit_side_room_id = edges[door_id]
+            for side, room_id in (("entry", entry_side_room_id), ("exit", exit_side_room_id)):
+                if room_id in changed_room_ids:
+                    room = smart_home_dt.get_digital_replica(room_id)
+                    updates.setdefault(door_id, {})[side] = bool(room["data"]["denial_status"])
+        return updates
+
+    def update_rooms_denial_statuses(self, smart_home_dt: DigitalTwin, smart_home_dr: dict, denial_statuses: dict) -> dict:
+        """Changes the denial statuses of one or more rooms of a smart home, then propagates them to the devices in a
+        single pass, publishing only the settings of the door sides leading to the changed rooms.
+
+        denial_statuses: room_id -> new denial status. The rooms must belong to the smart home DT.
+        Returns the device-side updates that got published (see _denial_updates_for_rooms)."""
+        now = datetime.utcnow()
+        changed_room_ids = []
+
+        for room_id, denial_status in denial_statuses.items():
+            room = smart_home_dt.get_digital_replica(room_id)
+            if room is None or room["type"] != "room":
+                raise ValueError(f"Room {room_id} doesn't belong to smart home {smart_home_dr['_id']}")
+            if room_id == smart_home_dr["data"].get("default_room_id") and denial_status:
+                raise ValueError("The denial status of the default room is locked to False")
+            if room["data"]["denial_status"] == denial_status:
+                continue  # nothing to change, nothing to publish
+
+            # add a new measurement to the room dr: new denial setting
+            # get the latest setting change timestamp... if there is no measurements, let the creation time be it.
+            measurements = room["data"].setdefault("measurements", [])
+            time_since_last_denial_setting = max(measurements, key=lambda k: k["timestamp"])["timestamp"] \
+                if len(measurements) > 0 else room["metadata"]["created_at"]
+            measurements.append({
+                "type": "denial_status_change",
+                "value": calculateSecondsOfDifference(time_since_last_denial_setting, now),
+                "timestamp": now
+            })
+            room["data"]["denial_status"] = denial_status
+
+            # Update room in database
+            self.app.config['DR_FACTORY'].update_dr(
+                "room",
+                room_id,
+                {
+                    "data": {
+                        "denial_status": denial_status,
+                        "measurements": measurements  # updates the measurements list
+                    }
+                }
+            )
+            changed_room_ids.append(room_id)
+
+        # a single propagation pass for all the changed rooms
+        updates = self._denial_updates_for_rooms(smart_home_dt, smart_home_dr, changed_room_ids)
+        for door_id, sides in updates.items():
+            door = smart_home_dt.get_digital_replica(door_id)
+            for side, setting in sides.items():
+                self.publish_denial_setting(smart_home_dr["profile"]["user"],
+                                            door["profile"]["seq_number"],
+                                            setting,
+                                            side)
+        return updates
+
     def _reapply_power_saving_mode_status(self, smart_home_dt: DigitalTwin, smart_home_dr: dict):
 
         # applying the power saving mode statuses to a device just needs the publish of an MQTT message.
@@ -736,13 +1416,14 @@ class DoorMQTTHandler:
                 "data": {
                     "fault_status": fault_status  # updates the vacancy status
                 }
-            }
+            },
+            trusted=True
         )
 
         self.app.logger.info(
             f"Smart home {smart_home_id} fault status updated to {fault_status}")
 
-    def _update_vacancy_status(self, now: datetime, room_id: str, vacancy_status: bool):
+    def _update_vacancy_status(self, now: datetime, room_id: str, vacancy_status: bool, smart_home_dr: dict = None):
         if vacancy_status:
             # if the vacancy status is to be set to true, then we need to add a new room measurement too...
             self._add_new_room_measurement(now, room_id)
@@ -750,6 +1431,73 @@ class DoorMQTTHandler:
             # else we just need to update the vacancy status to false and update its last accessed time.
             self._update_last_access(now, room_id)
 
+        if smart_home_dr is not None:
+            self._update_current_room_pointer(room_id, vacancy_status, smart_home_dr)
+
+    def _update_current_room_pointer(self, room_id: str, vacancy_status: bool, smart_home_dr: dict):
+        """
+        keeps the smart home's current_room_id pointer in sync with a vacancy flip, through a compare-and-set:
+        the pet leaving room_id clears the pointer only if it still points to room_id,
+        the pet entering room_id sets the pointer only if nobody else already set it in the meantime.
+        Best effort: the pointer (smart home DR) and the vacancy status (room DR) live in different collections, there's
+        no atomic write of both. When the compare-and-set fails the pointer gets re-read and reconciled (see below),
+        a pointer still disagreeing with the rooms gets caught by the consistency check of the passing by handler
+        (RetrievePetPositionService with check_consistency=True).
+        Updates the smart_home_dr python object too, so that the next flip sees the new value.
+        """
+        dr_factory = self.app.config['DR_FACTORY']
+        current_room_id = smart_home_dr["data"].get("current_room_id")
+        new_room_id = None if vacancy_status else room_id
+
+        if vacancy_status and current_room_id != room_id:
+            return  # the pet left a room that wasn't its position according to the pointer, nothing to clear
+
+        buffer = self._write_buffer()
+        if buffer is not None:
+            # catch-up batch: only the last position of the batch gets written
+            buffer.set("smart_home", smart_home_dr["_id"], "data", {"current_room_id": new_room_id})
+            return
+
+        if dr_factory.conditional_update_dr(
+                "smart_home",
+                smart_home_dr["_id"],
+                {"data.current_room_id": current_room_id},
+                {"data": {"current_room_id": new_room_id}}
+        ):
+            smart_home_dr["data"]["current_room_id"] = new_room_id
+            return
+
+        # someone else moved the pointer in the meantime, what does it say now?
+        stored_dr = dr_factory.get_dr("smart_home", smart_home_dr["_id"])
+        stored_room_id = (stored_dr or {}).get("data", {}).get("current_room_id")
+        smart_home_dr["data"]["current_room_id"] = stored_room_id
+
+        if vacancy_status or stored_room_id == room_id:
+            # leaving: the pointer doesn't point to room_id anymore, it isn't ours to clear
+            self.app.logger.info(f"Current room pointer of smart home {smart_home_dr['_id']} changed concurrently "
+                                 f"to {stored_room_id}, left as it is")
+            return
+
+        # entering: take the pointer over only from a room the pet isn't in anymore
+        if stored_room_id is not None:
+            stored_rooms = dr_factory.query_drs("room", {"_id": stored_room_id}, {"data.measurements": 0})
+            if stored_rooms and stored_rooms[0]["data"].get("vacancy_status") is False:
+                self.app.logger.warning(
+                    f"Current room pointer of smart home {smart_home_dr['_id']} moved concurrently to "
+                    f"{stored_room_id}, still occupied while the pet entered {room_id}: left to the consistency check")
+                return
+
+        if dr_factory.conditional_update_dr(
+                "smart_home",
+                smart_home_dr["_id"],
+                {"data.current_room_id": stored_room_id},
+                {"data": {"current_room_id": room_id}}
+        ):
+            smart_home_dr["data"]["current_room_id"] = room_id
+        else:
+            self.app.logger.warning(f"Current room pointer of smart home {smart_home_dr['_id']} keeps changing "
+                                    f"concurrently, {room_id} not set: left to the consistency check")
+
     def _update_last_access(self, now: datetime, entered_room_id: str):
         """
         updates the last accessed time of a room and sets the vacancy status to false.
@@ -759,6 +1507,11 @@ class DoorMQTTHandler:
            now: str - a datetime, best if it is the timestamp of the reception of the MQTT passing by message.
            exited_room_id: str - the id of the entered' room DR
            """
+        buffer = self._write_buffer()
+        if buffer is not None and buffer.get_dr("room", entered_room_id) is not None:
+            buffer.set("room", entered_room_id, "data", {"vacancy_status": False, "last_time_accessed": now})
+            return
+
         entered_room_dr = self.app.config["DR_FACTORY"].get_dr("room", entered_room_id)
 
         if entered_room_dr:
@@ -771,7 +1524,8 @@ class DoorMQTTHandler:
                         "vacancy_status": False,  # updates the vacancy status
                         "last_time_accessed": now  # updates the measurements list
                     }
-                }
+                },
+                trusted=True
             )
             self.app.logger.info(
                 f"Room {entered_room_id} vacancy status updated to False")
@@ -790,6 +1544,19 @@ class DoorMQTTHandler:
            now: str - a datetime, best if it is the timestamp of the reception of the MQTT passing by message.
            exited_room_id: str - the id of the exited' room DR
            """
+        buffer = self._write_buffer()
+        if buffer is not None and buffer.get_dr("room", exited_room_id) is not None:
+            # catch-up batch: the DT's room DR holds the last access of the batch's previous events
+            exited_room_data = buffer.get_dr("room", exited_room_id)["data"]
+            buffer.push("room", exited_room_id, "data", "measurements", {
+                "type": "pet_access",
+                "value": calculateSecondsOfDifference(exited_room_data["last_time_accessed"], now)
+                if "last_time_accessed" in exited_room_data else 0.0,
+                "timestamp": now
+            })
+            buffer.set("room", exited_room_id, "data", {"vacancy_status": True})
+            return
+
         exited_room_dr = self.app.config["DR_FACTORY"].get_dr("room", exited_room_id)
 
         if exited_room_dr:
@@ -820,7 +1587,8 @@ class DoorMQTTHandler:
                         "vacancy_status": True,  # updates the vacancy status
                         "measurements": exited_room_dr['data']['measurements']  # updates the measurements list
                     }
-                }
+                },
+                trusted=True
             )
             self.app.logger.info(
                 f"Room {exited_room_id} vacancy status updated to True")
@@ -840,6 +1608,11 @@ class DoorMQTTHandler:
            now: str - a datetime, best if it is the timestamp of the reception of the MQTT passing by message.
            exited_room_id: str - the id of the exited' room DR
            """
+        buffer = self._write_buffer()
+        if buffer is not None and buffer.get_dr("door", door_id) is not None:
+            buffer.push("door", door_id, "data", "measurements", {"type": type, "value": 1.0, "timestamp": now})
+            return
+
         door_dr = self.app.config["DR_FACTORY"].get_dr("door", door_id)
 
         # Create measurement for room (includes the time the pet stayed in that room till now)
@@ -866,7 +1639,8 @@ class DoorMQTTHandler:
                     "data": {
                         "measurements": door_dr['data']['measurements']  # updates the measurements list
                     }
-                }
+                },
+                trusted=True
             )
             self.app.logger.info(
                 f"Door {door_dr} measurement added")
@@ -874,7 +1648,24 @@ class DoorMQTTHandler:
             self.app.logger.error(
                 f"Door {door_dr} not found in database while trying to add measurement")
 
-    def _update_power_status(self, door_id: str, new_power_status: bool):
+    def _update_power_status(self, door_id: str, new_power_status: bool,
+                             smart_home_dt: DigitalTwin = None, smart_home_dr: dict = None) -> Optional[list]:
+        """Updates the power status of a door DR and, if the smart home is given, its set of faulted devices.
+        Returns the ids of the smart home's faulted devices after the update (None if no smart home was given)"""
+        buffer = self._write_buffer()
+        if buffer is not None and smart_home_dr is not None:
+            # catch-up batch: the net power statuses and faulted set get written once, at the end of the batch
+            buffer.set("door", door_id, "data", {"power_status": new_power_status})
+            faulted_door_ids = [
+                dr["_id"] for dr in smart_home_dt.digital_replicas
+                if dr["type"] == "door" and not dr["data"]["power_status"]
+            ] if smart_home_dr["data"].get("faulted_door_ids") is None else list(smart_home_dr["data"]["faulted_door_ids"])
+            if not new_power_status and door_id not in faulted_door_ids:
+                faulted_door_ids.append(door_id)
+            elif new_power_status and door_id in faulted_door_ids:
+                faulted_door_ids.remove(door_id)
+            buffer.set("smart_home", smart_home_dr["_id"], "data", {"faulted_door_ids": faulted_door_ids})
+            return faulted_door_ids
 
         # Update door dr in database
         self.app.config['DR_FACTORY'].update_dr(
@@ -884,51 +1675,148 @@ class DoorMQTTHandler:
                 "data": {
                     "power_status": new_power_status,  # updates the vacancy status
                 }
-            }
+            },
+            trusted=True
         )
 
         self.app.logger.info(
             f"Room {door_id} vacancy status updated to {new_power_status}")
 
+        if smart_home_dr is None:
+            return None
+
+        if smart_home_dr["data"].get("faulted_door_ids") is None:
+            # smart homes created before the faulted set existed: build it once out of the DT's doors
+            faulted_door_ids = [
+                dr["_id"] for dr in smart_home_dt.digital_replicas
+                if dr["type"] == "door" and not dr["data"]["power_status"]
+            ]
+            self.app.config['DR_FACTORY'].update_dr(
+                "smart_home",
+                smart_home_dr["_id"],
+                {"data": {"faulted_door_ids": faulted_door_ids}},
+                trusted=True
+            )
+        else:
+            # a single atomic $addToSet/$pull, concurrent power events of other devices can't get lost
+            faulted_door_ids = self.app.config['DR_FACTORY'].update_dr_set_member(
+                "smart_home", smart_home_dr["_id"], "data", "faulted_door_ids", door_id, not new_power_status
+            )
+
+        smart_home_dr["data"]["faulted_door_ids"] = faulted_door_ids
+        return faulted_door_ids
+
     ####################################################################################################################
     # MQTT-ONLY RESPONSIBILITY METHODS
 
-    def publish_power_saving_mode(self, user: str, device_seq_number: int, setting: bool, device_name: str = 'NodeMCU'):
-        """Publish a power saving mode state change"""
-        print("bho")
-        if not self.connected:
-            self.app.logger.error("Not connected to MQTT broker")
-            return
+    def publish_power_saving_mode(self, user: str, device_seq_number: int, setting: bool, device_name: str = 'NodeMCU',
+                                  force: bool = False) -> Future:
+        """Publish a power saving mode state change (only if it's a change, see device_shadow.py).
+        Returns the future of the delivery (see mqtt_publisher.py)"""
+        return self._publish_setting(user, device_name, device_seq_number, "powerSaving", setting, force)
 
-        print("bho")
-        # todo: check power_status of smart home DR... if the new setting is the same, forget about it.
-        topic = f"{self.base_topic}{user}/{device_name}@{device_seq_number}/powerSaving"
+    def publish_denial_setting(self, user: str, device_seq_number: int, setting: bool, side: str,
+                               device_name: str = 'NodeMCU', force: bool = False) -> Future:
+        """Publish a denial setting state change (only if it's a change, see device_shadow.py).
+        Returns the future of the delivery (see mqtt_publisher.py)"""
+        if side not in ['entry', 'exit']:
+            self.app.logger.error(f"Side {side} is not supported")
+            return self._failed_publish(PublishError(f"Side {side} is not supported"))
+
+        return self._publish_setting(user, device_name, device_seq_number,
+                              'denialEntrySetting' if side == 'entry' else 'denialExitSetting', setting, force)
+
+    def _publish_setting(self, user: str, device_name: str, device_seq_number: int, setting_topic: str, setting: bool,
+                         force: bool = False) -> Future:
+        """Queues a retained QoS 1 setting for a device on the publisher, unless the device shadow says the broker
+        already holds it (the returned future is already resolved, then)"""
+        key = (user, device_name, device_seq_number)
+        if not force and not self.device_shadow.needs_publish(key, setting_topic, setting):
+            self.app.logger.debug(
+                f"{setting_topic} {setting} for {device_name}@{device_seq_number} of user {user} unchanged, not published")
+            already_there = Future()
+            already_there.set_result(0.0)
+            return already_there
+
+        # same payload format the device uses: topic suffix for the MQTT 3.1.1 devices, Content Type property otherwise
+        content_type, content_type_in_topic = self.device_content_types.get(key, (self.default_content_type, False))
+        codec = get_codec(content_type)
+        plain_topic = f"{self.base_topic}{user}/{device_name}@{device_seq_number}/{setting_topic}"
+        topic = plain_topic
+        properties = None
+        if content_type_in_topic:
+            topic += "." + codec.suffix
+        elif content_type != JSON_CONTENT_TYPE:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = content_type
         payload = {"setting": setting, "timestamp": datetime.utcnow().isoformat()}
-        # todo: apply setting all DRs
+
+        if self._setting_topic_variants.get((key, setting_topic)) != topic:
+            # first publish of this setting since we started, or the device switched format convention: the broker may
+            # still hold a retained setting on another variant of the topic (plain or with another suffix), an old
+            # state that would contradict this one. Clear them (an empty retained message deletes the retained one)
+            for variant in [plain_topic] + [f"{plain_topic}.{suffix}" for suffix in KNOWN_SUFFIXES]:
+                if variant != topic:
+                    self.publisher.publish(variant, b"", qos=1, retain=True, command=f"{setting_topic} clear")
+            self._setting_topic_variants[(key, setting_topic)] = topic
 
         try:
-            self.client.publish(topic, json.dumps(payload), qos=1, retain=True)
-            self.app.logger.info(
-                f"Published power saving mode setting {setting} for {device_name}@{device_seq_number} on behalf of user {user}")
+            future = self.publisher.publish(topic, codec.dumps(payload), qos=1, retain=True, properties=properties,
+                                            command=setting_topic)
         except Exception as e:
-            self.app.logger.error(f"Error publishing power saving mode state: {e}")
+            self.app.logger.error(f"Error publishing {setting_topic}: {e}")
+            return self._failed_publish(e)
 
-    def publish_denial_setting(self, user: str, device_seq_number: int, setting: bool, side: str,
-                               device_name: str = 'NodeMCU'):
-        """Publish a power saving mode state change"""
-        if not self.connected:
-            self.app.logger.error("Not connected to MQTT broker")
-            return
-        elif side not in ['entry', 'exit']:
-            self.app.logger.error(f"Side {side} is not supported")
-            return
-
-        topic = f"{self.base_topic}{user}/{device_name}@{device_seq_number}/{'denialEntrySetting' if side == 'entry' else 'denialExitSetting'}"
-        payload = {"setting": setting, "timestamp": datetime.utcnow().isoformat()}
+        self.device_shadow.sent(key, setting_topic, setting, future.ticket, self._device_route(user, device_seq_number))
+        future.add_done_callback(self._on_publish)
+        self.app.logger.info(
+            f"Queued {setting_topic} {setting} for {device_name}@{device_seq_number} on behalf of user {user}")
+        return future
 
+    def _device_route(self, user: str, device_seq_number: int):
+        """(home_id, door_id) of a device for the device shadow, None if unknown (the routing table is in memory most
+        of the times)"""
         try:
-            self.app.logger.info(
-                f"Published denial setting {setting} for {device_name}@{device_seq_number} on behalf of user {user}")
-            self.client.publish(topic, json.dumps(payload), qos=1, retain=True)
+            return self.app.config["DEVICE_ROUTER"].resolve(user, device_seq_number)
         except Exception as e:
-            self.app.logger.error(f"Error publishing LED state: {e}")
+            self.app.logger.warning(f"Can't resolve the route of {user}'s device {device_seq_number}: {e}")
+            return None
+
+    def on_dr_event(self, event: str, dr_type: str, dr_id: str, changes: Optional[dict]) -> None:
+        """DRFactory listener: drops the device shadow of the devices deleted, renumbered or moved to another home"""
+        if event == "create":
+            return
+        if dr_type == "door":
+            if event == "delete" or "seq_number" in (changes.get("profile") or {}) \
+                    or "home_id" in (changes.get("data") or {}):
+                self.device_shadow.forget_door(dr_id)
+        elif dr_type == "smart_home":
+            if event == "delete" or "user" in (changes.get("profile") or {}) \
+                    or "list_of_devices" in (changes.get("data") or {}):
+                self.device_shadow.forget_home(dr_id)  # at worst, the settings of the others get published once more
+
+    def _on_publish(self, future: Future):
+        """PUBACK of a setting (or its failure): on success, the broker holds the retained setting now"""
+        if future.exception() is None:
+            self.device_shadow.acknowledged(future.ticket)
+
+    @staticmethod
+    def _failed_publish(error: Exception) -> Future:
+        future = Future()
+        future.set_exception(error)
+        return future
+
+    def _on_setting_echo(self, envelope: MQTTEnvelope):
+        """A setting topic came back to us (we're subscribed to the whole base topic): that's what the broker holds"""
+        self.device_shadow.reported(envelope.device_key, envelope.topic, envelope.payload["setting"])
+
+    def _reconciliation_loop(self):
+        """Background thread that republishes the settings the broker didn't acknowledge (lost publishes, broker
+        restarted without persistence...)"""
+        while not self.stopping.wait(self.shadow_reconcile_interval):
+            if not self.publisher.connected.is_set():
+                continue
+            for (user, device_name, device_seq_number), setting_topic, setting in self.device_shadow.drifted():
+                self.app.logger.warning(
+                    f"{setting_topic} of {device_name}@{device_seq_number} of user {user} drifted, republishing {setting}")
+                self._publish_setting(user, device_name, device_seq_number, setting_topic, setting, force=True)
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import time
+from threading import Event, Lock
+from typing import List, NamedTuple, Optional
+
+# Durable local inbox of the incoming MQTT messages (a SQLite database in WAL mode, used as an append-only log).
+#
+# _on_message only appends the message to the inbox and returns: paho sends the PUBACK of a QoS 1 message when
+# on_message returns, so the broker forgets a message only once it's on our disk. A worker thread drains the inbox
+# in batches (in arrival order) and moves a checkpoint forward after each batch: a restart resumes from the last
+# checkpoint, a slow MongoDB slows down the worker, not the ingestion.
+#
+# Messages get processed AT LEAST once: the ones processed after the last checkpoint get processed again after a
+# crash (the passing by deduplicator drops the detections among them, the power statuses are idempotent).
+
+DEFAULT_INBOX_BATCH_SIZE = 100
+DEFAULT_INBOX_POLL_INTERVAL = 1.0  # seconds the worker sleeps when the inbox is empty and nobody wakes it up
+
+
+class InboxMessage(NamedTuple):
+    id: int
+    topic: str
+    payload: bytes
+    content_type: Optional[str]  # MQTT v5 Content Type property of the message, if it had one
+    received_at: float  # unix time
+
+
+class MQTTInbox:
+    """Append-only SQLite WAL log of the received MQTT messages, with a checkpoint of the processed ones"""
+
+    def __init__(self, path: str, batch_size: int = DEFAULT_INBOX_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # one connection shared by paho's network thread (appends) and the worker (reads, checkpoints)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = Lock()
+        self.new_messages = Event()  # set at every append, so the worker doesn't have to poll
+
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # NORMAL: a commit survives a crash of the process, a power loss may lose the last few ones
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"  # AUTOINCREMENT: ids never get reused after a deletion
+                " topic TEXT NOT NULL,"
+                " payload BLOB NOT NULL,"
+                " content_type TEXT,"
+                " received_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+            )
+
+    def append(self, topic: str, payload: bytes, content_type: Optional[str] = None) -> int:
+        """Writes a received message to the inbox, returns its id"""
+        with self._lock:
+            cursor = self._connection.execute(
+                "INSERT INTO messages (topic, payload, content_type, received_at) VALUES (?, ?, ?, ?)",
+                (topic, bytes(payload), content_type, time.time())
+            )
+        self.new_messages.set()
+        return cursor.lastrowid
+
+    def last_checkpoint(self, name: str = "worker") -> int:
+        """Id of the last processed message (0 if none)"""
+        with self._lock:
+            row = self._connection.execute("SELECT last_id FROM checkpoints WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def read_batch(self, after_id: int, limit: Optional[int] = None) -> List[InboxMessage]:
+        """The oldest messages after after_id, in arrival order"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, topic, payload, content_type, received_at FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit or self.batch_size)
+            ).fetchall()
+        return [InboxMessage(*row) for row in rows]
+
+    def checkpoint(self, last_id: int, name: str = "worker") -> None:
+        """Marks all the messages up to last_id as processed, and drops them from the log"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "INSERT INTO checkpoints (name, last_id) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                    (name, last_id)
+                )
+                self._connection.execute("DELETE FROM messages WHERE id <= ?", (last_id,))
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def backlog(self, after_id: int) -> int:
+        """Number of messages waiting to be processed"""
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM messages WHERE id > ?", (after_id,)).fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,265 @@
+import bisect
+import itertools
+import queue
+import time
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional
+
+import paho.mqtt.client as mqtt
+
+# Publisher of the commands to the devices (the settings: denial and power saving), on its OWN MQTT connection.
+# The subscriber client's network thread is the one receiving the devices' messages: publishing from there (or from
+# the handlers while it waits for the PUBACKs) would put the device fan-out in the way of the ingestion.
+#
+# publish() only puts the message in a bounded outbound queue and returns a PublishFuture: a sender thread hands the
+# queued messages to paho, the PUBACK of the broker resolves the future with the latency of the command (from the
+# enqueue to the PUBACK), a full queue, a paho error or a PUBACK that never comes (ack_timeout) fail it with a
+# PublishError. Callers that care about the delivery (ex. "power saving mode changed in N devices") wait on the
+# futures, the others just fire and forget.
+# paho's mids wrap at 65535, a PUBACK must never resolve the wrong future: the mids of the publishes failed for lack of
+# PUBACK are kept as tombstones (their late PUBACK gets dropped, until paho reuses the mid), and a PUBACK arriving
+# before the sender registered its mid is remembered for EARLY_ACK_WINDOW seconds only. Stopping the publisher fails
+# the futures still queued or waiting for their PUBACK.
+# Each command (the setting topic) has a latency histogram, see stats().
+
+DEFAULT_OUTBOUND_QUEUE_SIZE = 1000
+DEFAULT_PUBLISH_ACK_TIMEOUT = 10  # seconds before an unacknowledged publish is considered failed
+EARLY_ACK_WINDOW = 5.0  # seconds a PUBACK of an unknown mid waits for the sender to register it
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds, upper bounds
+
+
+class PublishError(Exception):
+    """A command didn't reach the broker (queue full, paho error, no PUBACK in time)"""
+
+
+class PublishFuture(Future):
+    """Future of a queued publish, resolved with its latency (seconds) when the broker acknowledges it"""
+
+    def __init__(self, ticket: int, command: str):
+        super().__init__()
+        self.ticket = ticket  # our own id of the publish (paho's mid is known only once it's sent)
+        self.command = command
+        self.enqueued_at = time.monotonic()
+
+
+class LatencyHistogram:
+    """Bucket histogram of latencies (counts per bucket, not cumulative), with approximate percentiles"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one: over the last bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Upper bound of the bucket holding the p-th percentile (None without observations, inf over the buckets)"""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99),
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["inf"], self.counts)),
+        }
+
+
+class MQTTPublisher:
+    """Dedicated MQTT connection with an outbound queue and PUBACK tracking, see the comment above"""
+
+    def __init__(self, broker: str, port: int, client_id: str,
+                 queue_size: int = DEFAULT_OUTBOUND_QUEUE_SIZE,
+                 ack_timeout: float = DEFAULT_PUBLISH_ACK_TIMEOUT,
+                 logger=None):
+        self.broker = broker
+        self.port = port
+        self.client_id = client_id
+        self.ack_timeout = ack_timeout
+        self.logger = logger
+
+        self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)  # paho's loop reconnects by itself
+
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=queue_size)
+        self._tickets = itertools.count(1)
+        self._in_flight: Dict[int, PublishFuture] = {}  # paho mid -> future waiting for its PUBACK
+        self._early_acks: Dict[int, float] = {}  # mid -> when its PUBACK arrived, before the sender registered it
+        self._expired_mids = set()  # mids of the publishes failed for lack of PUBACK (tombstones)
+        self._lock = Lock()
+        self.connected = Event()
+        self._stopping = Event()
+        self._sender_thread = None
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.counters = {"published": 0, "acknowledged": 0, "failed": 0, "rejected": 0, "late_acks": 0}
+
+    def start(self) -> None:
+        self.client.connect_async(self.broker, self.port, 60)
+        self.client.loop_start()
+        self._sender_thread = Thread(target=self._sender_loop, name="mqtt-publisher")
+        self._sender_thread.daemon = True
+        self._sender_thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Sends what's queued (for timeout seconds at most), then closes the connection"""
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and self.connected.is_set() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stopping.set()
+        if self._sender_thread:
+            self._sender_thread.join(timeout=1.0)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+        # nobody is going to send or acknowledge these anymore
+        futures = []
+        while True:
+            try:
+                futures.append(self._queue.get_nowait()[0])
+            except queue.Empty:
+                break
+        with self._lock:
+            futures.extend(self._in_flight.values())
+            self._in_flight.clear()
+        for future in futures:
+            self._fail(future, PublishError(f"MQTT publisher stopped, {future.command} not delivered"))
+
+    def publish(self, topic: str, payload: bytes, qos: int = 1, retain: bool = False, properties=None,
+                command: str = "") -> PublishFuture:
+        """Queues a message, returns its future. command: what the message is, for the latency histograms"""
+        future = PublishFuture(next(self._tickets), command)
+        try:
+            self._queue.put_nowait((future, topic, payload, qos, retain, properties))
+        except queue.Full:
+            self.counters["rejected"] += 1
+            future.set_exception(PublishError(f"Outbound queue full, {command} to {topic} dropped"))
+        return future
+
+    def _sender_loop(self) -> None:
+        while not self._stopping.is_set():
+            self._expire_in_flight()
+            if not self.connected.wait(0.5):
+                continue  # the queue holds the messages until we're back
+            try:
+                future, topic, payload, qos, retain, properties = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                info = self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+            except Exception as e:
+                self._fail(future, PublishError(f"Error publishing {future.command} to {topic}: {str(e)}"))
+                continue
+            # MQTT_ERR_NO_CONN: paho keeps the QoS > 0 message and sends it after the reconnection
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                self._fail(future, PublishError(f"Error publishing {future.command} to {topic}: "
+                                                f"{mqtt.error_string(info.rc)}"))
+                continue
+            self.counters["published"] += 1
+
+            if qos == 0:
+                self._resolve(future)  # no PUBACK for QoS 0
+                continue
+            with self._lock:
+                self._expired_mids.discard(info.mid)  # reused by paho: its PUBACKs are this publish's now
+                if self._early_acks.pop(info.mid, None) is not None:
+                    acknowledged = True
+                else:
+                    self._in_flight[info.mid] = future
+                    acknowledged = False
+            if acknowledged:
+                self._resolve(future)
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            self.connected.set()
+            self._log("info", f"MQTT publisher connected as {self.client_id}")
+        else:
+            self._log("error", f"MQTT publisher failed to connect with code: {rc}")
+
+    def _on_disconnect(self, client, userdata, rc, properties=None):
+        self.connected.clear()
+        if rc != 0:
+            self._log("warning", f"Unexpected disconnection of the MQTT publisher: {rc}")
+
+    def _on_publish(self, client, userdata, mid):
+        """PUBACK (runs in paho's network thread, which may hold paho's locks: never call paho from here)"""
+        with self._lock:
+            future = self._in_flight.pop(mid, None)
+            if future is None:
+                if mid in self._expired_mids:
+                    self._expired_mids.discard(mid)  # its future already failed, don't count it twice
+                    self.counters["late_acks"] += 1
+                else:
+                    self._early_acks[mid] = time.monotonic()
+                return
+        self._resolve(future)
+
+    def _resolve(self, future: PublishFuture) -> None:
+        latency = time.monotonic() - future.enqueued_at
+        with self._lock:
+            self.histograms.setdefault(future.command, LatencyHistogram()).observe(latency)
+            self.counters["acknowledged"] += 1
+        future.set_result(latency)
+
+    def _fail(self, future: PublishFuture, error: Exception) -> None:
+        if future.done():
+            return
+        self.counters["failed"] += 1
+        self._log("error", str(error))
+        future.set_exception(error)
+
+    def _expire_in_flight(self) -> None:
+        """Fails the futures whose PUBACK is late, forgets the early PUBACKs nobody claimed"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [mid for mid, future in self._in_flight.items() if future.enqueued_at < now - self.ack_timeout]
+            futures = [self._in_flight.pop(mid) for mid in expired]
+            self._expired_mids.update(expired)
+            for mid in [mid for mid, acked_at in self._early_acks.items() if acked_at < now - EARLY_ACK_WINDOW]:
+                del self._early_acks[mid]
+        for future in futures:
+            self._fail(future, PublishError(f"No PUBACK for {future.command} after {self.ack_timeout}s"))
+
+    def stats(self) -> Dict:
+        """Counters, queue length, publishes waiting for the PUBACK and the latency histogram of each command"""
+        with self._lock:
+            return dict(self.counters, queued=self._queue.qsize(), in_flight=len(self._in_flight),
+                        latency={command: histogram.snapshot() for command, histogram in self.histograms.items()})
+
+    def _log(self, level: str, message: str) -> None:
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+        else:
+            print(message)
+
+
+def count_delivered(futures: List[Future], timeout: float) -> int:
+    """Waits (timeout seconds at most, overall) for some publish futures, returns how many got acknowledged"""
+    deadline = time.monotonic() + timeout
+    delivered = 0
+    for future in futures:
+        try:
+            future.result(timeout=max(deadline - time.monotonic(), 0))
+            delivered += 1
+        except Exception:
+            pass  # failed, or still not acknowledged
+    return delivered
@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+# Passing by detections that shouldn't reach passingByDetection_Handler (DB writes, position updates and maybe a
+# bogus "position mismatch"/"prohibited room" telegram alert):
+#   - DUPLICATES: QoS 1 means "at least once", after a reconnection the broker (or the device) redelivers messages
+#     we already processed. A detection is identified by device, type and the device's own timestamp: seen that
+#     idempotency key already (in the last dedup_ttl seconds), it's a copy. Only timestamps down to the second
+#     identify a detection (a date alone is the same for a whole day of passes): the others get no key.
+#   - BOUNCES: a single pass of the pet can trip the sensor several times, each with its own timestamp. Detections
+#     of the same type from the same device closer than debounce_window seconds to the last accepted one are dropped.
+#     "Closer" in event time (see parse_device_timestamp), not in processing time: inbox replays, catch-up batches and
+#     redelivery bursts process detections minutes apart within a few milliseconds.
+#     A detection of the other type is never debounced: an entry right after an exit is the pet changing its mind,
+#     dropping it would leave the pet in the wrong room.
+#
+# It works on the parsed envelope only, before any DB access.
+
+DEFAULT_DEBOUNCE_WINDOW = 1.0  # seconds
+DEFAULT_DEDUP_TTL = 600  # seconds an idempotency key is remembered
+MAX_IDEMPOTENCY_KEYS = 100000  # bound of the idempotency key cache, the oldest ones go first
+
+DeviceKey = Tuple[str, str, int]  # (user, device name, sequential number)
+
+
+class PassingByDeduplicator:
+    """Per device debounce and idempotency key cache of the passing by detections, see the comment above"""
+
+    def __init__(self, debounce_window: float = DEFAULT_DEBOUNCE_WINDOW, dedup_ttl: float = DEFAULT_DEDUP_TTL,
+                 max_keys: int = MAX_IDEMPOTENCY_KEYS):
+        self.debounce_window = debounce_window
+        self.dedup_ttl = dedup_ttl
+        self.max_keys = max_keys
+        self._seen: "OrderedDict[Tuple[DeviceKey, str, str], float]" = OrderedDict()  # key -> when it was seen
+        self._last_accepted: Dict[DeviceKey, Tuple[str, datetime]] = {}  # device -> (type, event time)
+        self.counters = {"accepted": 0, "duplicates": 0, "debounced": 0}
+        self._lock = Lock()
+
+    def accept(self, device_key: DeviceKey, detection_type: str, event_time: datetime,
+               device_timestamp: Optional[str] = None) -> bool:
+        """True if the detection has to be processed, False if it's a duplicate or a bounce (and gets counted).
+        device_timestamp: the device's own timestamp, only if precise enough to identify the detection"""
+        now = time.monotonic()
+
+        with self._lock:
+            self._expire(now)
+
+            if device_timestamp is not None:
+                idempotency_key = (device_key, detection_type, device_timestamp)
+                if idempotency_key in self._seen:
+                    self.counters["duplicates"] += 1
+                    return False
+                self._seen[idempotency_key] = now
+                if len(self._seen) > self.max_keys:
+                    self._seen.popitem(last=False)
+
+            last = self._last_accepted.get(device_key)
+            if last is not None and last[0] == detection_type \
+                    and abs((event_time - last[1]).total_seconds()) < self.debounce_window:
+                self.counters["debounced"] += 1
+                return False
+
+            self._last_accepted[device_key] = (detection_type, event_time)
+            self.counters["accepted"] += 1
+            return True
+
+    def _expire(self, now: float) -> None:
+        # keys are in insertion order, so the expired ones are at the beginning
+        while self._seen:
+            oldest_key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.dedup_ttl:
+                break
+            del self._seen[oldest_key]
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of the accepted and suppressed detections"""
+        with self._lock:
+            return dict(self.counters)
@@ -0,0 +1,86 @@
+import json
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+# Payload formats of the MQTT messages. JSON is the default one (the NodeMCU program speaks JSON), CBOR and MessagePack
+# are compact binary alternatives for constrained links: same objects ({type, value, timestamp}, {data}, {setting}...),
+# less bytes on the air and a faster parse.
+#
+# CONTENT TYPE CONVENTION: the format of a message is
+#     1. its MQTT v5 Content Type property (application/json, application/cbor, application/msgpack), if it has one;
+#     2. otherwise the suffix of its last topic level, for the MQTT 3.1.1 clients that can't set properties (like
+#        PubSubClient on the NodeMCU): pettracker/customernick/NodeMCU@1/passingByDetection.cbor
+#     3. otherwise JSON.
+# The server answers each device in the format (and with the convention) the device used last, and clears the retained
+# setting left on the other topic variant when a device switches convention (see DoorMQTTHandler._publish_setting).
+#
+# cbor2 and msgpack are in requirements.txt. They're still imported optionally: without them their formats are just
+# not accepted.
+
+
+class PayloadCodec(NamedTuple):
+    content_type: str
+    suffix: str  # topic suffix, without the dot
+    loads: Callable[[bytes], Any]
+    dumps: Callable[[Any], bytes]
+
+
+JSON_CONTENT_TYPE = "application/json"
+CBOR_CONTENT_TYPE = "application/cbor"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+try:
+    import orjson
+
+    _json_codec = PayloadCodec(JSON_CONTENT_TYPE, "json", orjson.loads, orjson.dumps)  # works on bytes directly
+except ImportError:  # orjson is in requirements.txt, this is just for environments without it
+    _json_codec = PayloadCodec(JSON_CONTENT_TYPE, "json", json.loads, lambda obj: json.dumps(obj).encode())
+
+CODECS: Dict[str, PayloadCodec] = {JSON_CONTENT_TYPE: _json_codec}
+
+try:
+    import cbor2
+
+    CODECS[CBOR_CONTENT_TYPE] = PayloadCodec(CBOR_CONTENT_TYPE, "cbor", cbor2.loads, cbor2.dumps)
+except ImportError:
+    pass
+
+try:
+    import msgpack
+
+    CODECS[MSGPACK_CONTENT_TYPE] = PayloadCodec(
+        MSGPACK_CONTENT_TYPE, "msgpack",
+        lambda payload: msgpack.unpackb(payload, raw=False),
+        lambda obj: msgpack.packb(obj, use_bin_type=True)
+    )
+except ImportError:
+    pass
+
+# content types and suffixes we know about, even when their library isn't installed (so we can tell the user why
+# a message got dropped, instead of treating ".cbor" as part of an unknown topic)
+KNOWN_CONTENT_TYPES = {
+    JSON_CONTENT_TYPE: JSON_CONTENT_TYPE,
+    CBOR_CONTENT_TYPE: CBOR_CONTENT_TYPE,
+    MSGPACK_CONTENT_TYPE: MSGPACK_CONTENT_TYPE,
+    "application/x-msgpack": MSGPACK_CONTENT_TYPE,  # the unofficial one, used by many clients
+    "application/vnd.msgpack": MSGPACK_CONTENT_TYPE,
+}
+KNOWN_SUFFIXES = {"json": JSON_CONTENT_TYPE, "cbor": CBOR_CONTENT_TYPE, "msgpack": MSGPACK_CONTENT_TYPE}
+
+
+class UnsupportedContentType(ValueError):
+    """A payload format we don't know, or whose library is not installed"""
+
+
+def get_codec(content_type: str) -> PayloadCodec:
+    codec = CODECS.get(KNOWN_CONTENT_TYPES.get(content_type.lower(), content_type.lower()))
+    if codec is None:
+        raise UnsupportedContentType(f"Unsupported payload content type: {content_type}")
+    return codec
+
+
+def split_topic_suffix(topic: str) -> Tuple[str, Optional[str]]:
+    """'passingByDetection.cbor' -> ('passingByDetection', 'application/cbor'), 'powerStatus' -> ('powerStatus', None)"""
+    name, separator, suffix = topic.rpartition('.')
+    if separator and suffix in KNOWN_SUFFIXES:
+        return name, KNOWN_SUFFIXES[suffix]
+    return topic, None
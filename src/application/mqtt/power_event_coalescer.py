@@ -0,0 +1,66 @@
+import time
+from threading import Lock, Timer
+from typing import Any, Callable, Dict, List
+
+# Fault storms: when a building loses power, the powerStatus=false messages (retained/LWT) of all its NodeMCUs arrive
+# at the same time. Handling them one by one means running the fault recovery, republishing the settings of every
+# device and notifying the user once per device... O(N^2) MQTT publishes and N telegram messages.
+#
+# The coalescer collects the power status transitions of the devices of a smart home for a short debounce window
+# (restarted at every new transition, but never longer than max_delay since the first one), then hands the final
+# status of each device to process_batch(home_key, {door_id: power_status}, tokens) in a single call.
+# tokens: whatever the callers gave along with the transitions of the batch (the handler passes the messages, whose
+# inbox ids stay held until the batch is processed: a batch that fails doesn't get lost).
+
+DEFAULT_POWER_EVENTS_WINDOW = 2.0  # seconds of quiet before a batch gets processed
+DEFAULT_POWER_EVENTS_MAX_DELAY = 10.0  # seconds a batch can be delayed by a never ending storm
+
+
+class PowerEventCoalescer:
+    """Per smart home debounce of the power status transitions, see the comment above"""
+
+    def __init__(self, process_batch: Callable[[str, Dict[str, bool], List[Any]], None],
+                 window: float = DEFAULT_POWER_EVENTS_WINDOW,
+                 max_delay: float = DEFAULT_POWER_EVENTS_MAX_DELAY):
+        self.process_batch = process_batch
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self._pending: Dict[str, Dict] = {}  # home_key -> {"transitions": {door_id: status}, "tokens", "first_at", "timer"}
+        self._lock = Lock()
+
+    def submit(self, home_key: str, door_id: str, power_status: bool, tokens: List[Any] = ()) -> None:
+        """Adds a power status transition to the batch of its smart home, (re)starting the debounce window"""
+        now = time.monotonic()
+        with self._lock:
+            batch = self._pending.setdefault(home_key, {"transitions": {}, "tokens": [], "first_at": now, "timer": None})
+            batch["transitions"][door_id] = power_status  # only the last status of each device matters
+            batch["tokens"].extend(tokens)
+
+            if batch["timer"] is not None:
+                batch["timer"].cancel()
+            delay = min(self.window, batch["first_at"] + self.max_delay - now)
+
+            batch["timer"] = Timer(max(delay, 0), self._fire, args=(home_key,))
+            batch["timer"].daemon = True
+            batch["timer"].start()
+
+    def _fire(self, home_key: str) -> None:
+        with self._lock:
+            batch = self._pending.pop(home_key, None)
+        if batch is None:
+            return  # already flushed
+
+        try:
+            self.process_batch(home_key, batch["transitions"], batch["tokens"])
+        except Exception as e:
+            print(f"Failed to process the power status transitions of {home_key}: {str(e)}")
+
+    def flush(self) -> None:
+        """Processes all the pending batches right away (ex. when shutting down)"""
+        with self._lock:
+            home_keys = list(self._pending.keys())
+            for batch in self._pending.values():
+                batch["timer"].cancel()
+
+        for home_key in home_keys:
+            self._fire(home_key)
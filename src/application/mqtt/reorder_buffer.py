@@ -0,0 +1,127 @@
+import heapq
+import itertools
+import time
+from datetime import datetime, timedelta
+from threading import Lock, RLock, Timer
+from typing import Any, Callable, Dict, List
+
+# Event-time ordering of the passing by detections of a smart home. Queuing, redeliveries and (later on) parallel
+# workers can hand us the detections out of order, and the dwell times (seconds between entering and leaving a room)
+# and the denial statistics are computed out of consecutive detections: processing them out of order corrupts them.
+#
+# Each smart home has a small min-heap of detections keyed by event time (the device's timestamp). The watermark of
+# a home is the latest event time seen minus allowed_lateness: detections older than the watermark can't be
+# overtaken by anything else anymore, so they get released to process_batch(home_key, items), in event time order.
+# A home whose devices go quiet still gets its detections released: each one is held allowed_lateness seconds of
+# wall clock time at most.
+# Detections older than the last released one of their home arrived too late to be put in order: they get processed
+# right away (and counted).
+
+DEFAULT_ALLOWED_LATENESS = 2.0  # seconds
+
+
+class EventReorderBuffer:
+    """Per smart home reorder buffer of the events, bounded by a watermark, see the comment above"""
+
+    def __init__(self, process_batch: Callable[[str, List[Any]], None],
+                 allowed_lateness: float = DEFAULT_ALLOWED_LATENESS):
+        self.process_batch = process_batch
+        self.allowed_lateness = allowed_lateness
+        self._homes: Dict[str, Dict] = {}  # home_key -> {"heap", "max_event_time", "last_released", "timer"}
+        self._sequence = itertools.count()  # tie breaker of the events with the same event time (arrival order)
+        self._lock = Lock()
+        # the released batches of a home get processed one at a time, in release order. One lock per home: a home
+        # whose batch is slow (DB writes, telegram notifications) doesn't hold back the others
+        self._process_locks: Dict[str, RLock] = {}
+        self.counters = {"in_order": 0, "reordered": 0, "late": 0}
+
+    def submit(self, home_key: str, event_time: datetime, item: Any) -> None:
+        """Adds an event to the buffer of its smart home, processing the events the watermark releases"""
+        with self._process_lock(home_key):
+            with self._lock:
+                home = self._homes.setdefault(
+                    home_key, {"heap": [], "max_event_time": None, "last_released": None, "timer": None})
+
+                if home["last_released"] is not None and event_time < home["last_released"]:
+                    self.counters["late"] += 1
+                    ready = [item]
+                else:
+                    if home["max_event_time"] is not None and event_time < home["max_event_time"]:
+                        self.counters["reordered"] += 1
+                    else:
+                        self.counters["in_order"] += 1
+                    heapq.heappush(home["heap"], (event_time, next(self._sequence), time.monotonic(), item))
+                    home["max_event_time"] = max(home["max_event_time"] or event_time, event_time)
+
+                    ready = self._release(home, home["max_event_time"] - timedelta(seconds=self.allowed_lateness))
+                    self._schedule(home_key, home)
+
+            if ready:
+                self.process_batch(home_key, ready)
+
+    def _release(self, home: Dict, watermark: datetime) -> List[Any]:
+        """Pops the events of a home up to the watermark, in event time order"""
+        ready = []
+        while home["heap"] and home["heap"][0][0] <= watermark:
+            event_time, _, _, item = heapq.heappop(home["heap"])
+            home["last_released"] = event_time
+            ready.append(item)
+        return ready
+
+    def _schedule(self, home_key: str, home: Dict) -> None:
+        # a timer for the oldest held event (by arrival), so that quiet homes get their events released too
+        if not home["heap"] or home["timer"] is not None:
+            return
+        oldest_arrival = min(entry[2] for entry in home["heap"])
+        delay = max(oldest_arrival + self.allowed_lateness - time.monotonic(), 0)
+        home["timer"] = Timer(delay, self._fire, args=(home_key,))
+        home["timer"].daemon = True
+        home["timer"].start()
+
+    def _process_lock(self, home_key: str) -> RLock:
+        with self._lock:
+            return self._process_locks.setdefault(home_key, RLock())
+
+    def _fire(self, home_key: str) -> None:
+        with self._process_lock(home_key):
+            with self._lock:
+                home = self._homes.get(home_key)
+                if home is None:
+                    return
+                home["timer"] = None
+                # the events held for allowed_lateness seconds, and the ones before them in event time order
+                expired_before = time.monotonic() - self.allowed_lateness
+                expired = [entry[0] for entry in home["heap"] if entry[2] <= expired_before]
+                ready = self._release(home, max(expired)) if expired else []
+                self._schedule(home_key, home)
+
+            if ready:
+                try:
+                    self.process_batch(home_key, ready)
+                except Exception as e:
+                    print(f"Failed to process the reordered events of {home_key}: {str(e)}")
+
+    def flush(self) -> None:
+        """Processes all the held events right away (ex. when shutting down)"""
+        with self._lock:
+            home_keys = list(self._homes.keys())
+
+        for home_key in home_keys:
+            with self._process_lock(home_key):
+                with self._lock:
+                    home = self._homes[home_key]
+                    if home["timer"] is not None:
+                        home["timer"].cancel()
+                        home["timer"] = None
+                    ready = self._release(home, max(entry[0] for entry in home["heap"])) if home["heap"] else []
+
+                if ready:
+                    try:
+                        self.process_batch(home_key, ready)
+                    except Exception as e:
+                        print(f"Failed to process the reordered events of {home_key}: {str(e)}")
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of the events that arrived in order, out of order (and got reordered) and too late"""
+        with self._lock:
+            return dict(self.counters)
@@ -0,0 +1,172 @@
+import time
+from collections import deque
+from threading import Condition, Event, Thread
+from typing import Callable, Deque, Dict, Optional, Tuple, Type
+
+# Scheduler of the MQTT work (the part that needs the smart home DT: the topic handlers), in front of a pool of
+# worker threads, so that a flood of passing by detections from a noisy home can't delay the fault handling of the
+# others:
+#   - PRIORITY CLASSES: a worker always picks from the most important class with something runnable: the power
+#     status (fault) events preempt the routine passing by detections.
+#   - WEIGHTED FAIR QUEUING across customers, inside each class: every task gets a virtual finish tag
+#     (max(class virtual time, customer's last tag) + 1 / customer weight), the runnable task with the smallest tag
+#     goes first. A customer with a long queue gets its share, not the whole pool.
+#   - PER-CUSTOMER CONCURRENCY: at most customer_concurrency tasks of the same customer run at the same time
+#     (1 by default: the events of a smart home are processed one at a time, in order).
+#   - PER-CUSTOMER QUEUE CAPS: a customer with customer_queue_cap tasks already queued gets its new tasks shed,
+#     except for the most important class (faults are never shed).
+# Tasks failing with one of the retry_on exceptions (ex. MongoDB unreachable) go back to the head of their
+# customer's queue and get retried after retry_delay seconds.
+
+FAULT_PRIORITY = 0
+ROUTINE_PRIORITY = 1
+TOPIC_PRIORITIES = {"powerStatus": FAULT_PRIORITY, "passingByDetection": ROUTINE_PRIORITY}  # others are routine
+
+DEFAULT_SCHEDULER_WORKERS = 4
+DEFAULT_CUSTOMER_CONCURRENCY = 1
+DEFAULT_CUSTOMER_QUEUE_CAP = 500
+DEFAULT_RETRY_DELAY = 5  # seconds
+
+# a queued task: (finish tag, task, on_done)
+_Task = Tuple[float, Callable[[], None], Optional[Callable[[], None]]]
+
+
+class WorkScheduler:
+    """Priority classes + weighted fair queuing across customers over a pool of workers, see the comment above"""
+
+    def __init__(self, workers: int = DEFAULT_SCHEDULER_WORKERS,
+                 customer_concurrency: int = DEFAULT_CUSTOMER_CONCURRENCY,
+                 customer_queue_cap: int = DEFAULT_CUSTOMER_QUEUE_CAP,
+                 weights: Optional[Dict[str, float]] = None,
+                 retry_on: Tuple[Type[BaseException], ...] = (),
+                 retry_delay: float = DEFAULT_RETRY_DELAY,
+                 on_error: Optional[Callable[[str, Exception], None]] = None):
+        self.workers = workers
+        self.customer_concurrency = customer_concurrency
+        self.customer_queue_cap = customer_queue_cap
+        self.weights = weights or {}
+        self.retry_on = retry_on
+        self.retry_delay = retry_delay
+        self.on_error = on_error or (lambda customer, e: print(f"Scheduled task of {customer} failed: {str(e)}"))
+
+        self._queues: Dict[int, Dict[str, Deque[_Task]]] = {}  # priority -> customer -> its tasks
+        self._virtual_time: Dict[int, float] = {}  # priority -> finish tag of the last picked task
+        self._last_tag: Dict[Tuple[int, str], float] = {}  # (priority, customer) -> finish tag of its last task
+        self._queued: Dict[str, int] = {}  # customer -> tasks queued (all classes)
+        self._in_flight: Dict[str, int] = {}  # customer -> tasks running
+        self._condition = Condition()
+        self._stopping = Event()
+        self._threads = []
+        self.counters = {"scheduled": 0, "completed": 0, "shed": 0, "retried": 0, "failed": 0}
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = Thread(target=self._worker_loop, name=f"mqtt-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, customer: str, priority: int, task: Callable[[], None],
+               on_done: Optional[Callable[[], None]] = None) -> bool:
+        """Queues a task of a customer. Returns False if it got shed (the customer's queue is full).
+        on_done gets called once the task is over (completed, failed or shed), not after a retryable failure"""
+        with self._condition:
+            if priority != FAULT_PRIORITY and self._queued.get(customer, 0) >= self.customer_queue_cap:
+                self.counters["shed"] += 1
+                shed = True
+            else:
+                shed = False
+                start_tag = max(self._virtual_time.get(priority, 0.0), self._last_tag.get((priority, customer), 0.0))
+                finish_tag = start_tag + 1.0 / self.weights.get(customer, 1.0)
+                self._last_tag[(priority, customer)] = finish_tag
+
+                self._queues.setdefault(priority, {}).setdefault(customer, deque()).append((finish_tag, task, on_done))
+                self._queued[customer] = self._queued.get(customer, 0) + 1
+                self.counters["scheduled"] += 1
+                self._condition.notify()
+
+        if shed and on_done is not None:
+            on_done()
+        return not shed
+
+    def _pick(self) -> Optional[Tuple[int, str, _Task]]:
+        """The runnable task with the smallest finish tag, of the most important class (lock held)"""
+        for priority in sorted(self._queues):
+            candidates = [
+                (queue[0][0], customer) for customer, queue in self._queues[priority].items()
+                if queue and self._in_flight.get(customer, 0) < self.customer_concurrency
+            ]
+            if not candidates:
+                continue
+            finish_tag, customer = min(candidates)
+            queue = self._queues[priority][customer]
+            item = queue.popleft()
+            if not queue:
+                del self._queues[priority][customer]
+            self._virtual_time[priority] = max(self._virtual_time.get(priority, 0.0), finish_tag)
+            self._queued[customer] -= 1
+            self._in_flight[customer] = self._in_flight.get(customer, 0) + 1
+            return priority, customer, item
+        return None
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._condition:
+                picked = self._pick()
+                while picked is None:
+                    if self._stopping.is_set():
+                        return
+                    self._condition.wait(1.0)
+                    picked = self._pick()
+            priority, customer, (finish_tag, task, on_done) = picked
+
+            retry = False
+            try:
+                task()
+                self.counters["completed"] += 1
+            except self.retry_on as e:
+                retry = not self._stopping.is_set()
+                self.counters["retried" if retry else "failed"] += 1
+                self.on_error(customer, e)
+            except Exception as e:
+                self.counters["failed"] += 1
+                self.on_error(customer, e)
+
+            if retry:
+                # keep the customer busy while waiting, so that its next tasks don't overtake this one
+                self._stopping.wait(self.retry_delay)
+
+            with self._condition:
+                self._in_flight[customer] -= 1
+                if retry:
+                    self._queues.setdefault(priority, {}).setdefault(customer, deque()).appendleft(
+                        (finish_tag, task, on_done))
+                    self._queued[customer] += 1
+                self._condition.notify_all()
+
+            if not retry and on_done is not None:
+                on_done()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Waits until there's nothing queued or running. Returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while any(self._queued.values()) or any(self._in_flight.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Runs what's queued (for timeout seconds at most), then stops the workers"""
+        self.join(timeout)
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return dict(self.counters, queued=sum(self._queued.values()), running=sum(self._in_flight.values()))
@@ -5,6 +5,7 @@ from datetime import datetime
 MAX_PERSONAL_ROOMS_PER_USER = 20
 MAX_CHARACTERS_ROOM_NAME = 128
 from src.virtualization.digital_replica.dr_factory import DRFactory
+from src.application.mqtt.mqtt_handler import get_smart_home_dt_and_dr_from_customer_username
 from bson import ObjectId
 
 # HTTP API v1 for pettracking application
@@ -25,6 +26,25 @@ pettracker_api = Blueprint('pettracker_api', __name__, url_prefix='/api/pettrack
 #     return room["_id"]
 
 
+def _set_home_id(dr_type, dr_ids, home_id):
+    """Sets the home_id back reference of the given room/door DRs (None to detach them from any smart home)"""
+    for dr_id in dr_ids:
+        current_app.config["DR_FACTORY"].update_dr(dr_type, dr_id, {"data": {"home_id": home_id}})
+
+
+def _refresh_faulted_door_ids(smart_home_id):
+    """Rebuilds the set of faulted devices of a smart home out of its door DRs (after its list of devices changed)"""
+    smart_home_dr = current_app.config["DR_FACTORY"].get_dr("smart_home", smart_home_id)
+    faulted_doors = current_app.config["DR_FACTORY"].query_drs(
+        "door",
+        {"_id": {"$in": smart_home_dr["data"].get("list_of_devices") or []}, "data.power_status": {"$ne": True}},
+        {"_id": 1}
+    )
+    current_app.config["DR_FACTORY"].update_dr(
+        "smart_home", smart_home_id, {"data": {"faulted_door_ids": [door["_id"] for door in faulted_doors]}}
+    )
+
+
 def register_pettracker_blueprint(app):
     app.register_blueprint(pettracker_api)
 
@@ -72,6 +92,9 @@ def update_door(door_id): # this is idempotent... we can use PUT
         if "data" in data:
             update_data["data"] = data["data"]
 
+            # the smart home back reference is maintained by the smart home APIs only
+            update_data["data"].pop("home_id", None)
+
             # The list of measurements gets appended, not replaced...
             # if and only if there was no measurement before.
             current_dr = current_app.config["DR_FACTORY"].get_dr("door", door_id)
@@ -111,6 +134,13 @@ def update_door(door_id): # this is idempotent... we can use PUT
         update_data["metadata"] = {"updated_at": datetime.utcnow()}
 
         current_app.config["DR_FACTORY"].update_dr("door", door_id, update_data)
+
+        # keep the set of faulted devices of its smart home in sync
+        if "data" in data and "power_status" in data["data"] and current_dr["data"].get("home_id"):
+            current_app.config["DR_FACTORY"].update_dr_set_member(
+                "smart_home", current_dr["data"]["home_id"], "data", "faulted_door_ids",
+                door_id, not data["data"]["power_status"]
+            )
         return jsonify({"status": "success", "message": "Door updated successfully"}), 200
     except Exception as e:
         current_app.logger.error(e)
@@ -139,12 +169,17 @@ def delete_door(door_id):
             return jsonify({"error": "Door not found"}), 404
 
         # we can't delete a door if there exists some reference in a smart home (the devices can't go "poof"!)
-        filters = {"list_of_devices": door["_id"]   # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#query-an-array-for-an-element
-            #                         {"$all": [door["_id"]]} # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#match-an-array
-        }
-
-        smart_homes_associated_to_door = current_app.config["DR_FACTORY"].query_drs("smart_home", filters)
-        if smart_homes_associated_to_door:
+        if "home_id" in door["data"]:
+            # the door knows its smart home, no need to look for it
+            door_is_associated = door["data"]["home_id"] is not None
+        else:
+            # doors created before the home_id back reference existed: look for it in the smart homes' lists
+            filters = {"list_of_devices": door["_id"]   # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#query-an-array-for-an-element
+                #                         {"$all": [door["_id"]]} # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#match-an-array
+            }
+            door_is_associated = bool(current_app.config["DR_FACTORY"].query_drs("smart_home", filters, {"_id": 1}))
+
+        if door_is_associated:
             return jsonify({"error": "Door cannot be deleted, it is still associated to some smart homes!"}), 400
 
         current_app.config["DR_FACTORY"].delete_dr("door", door_id)
@@ -277,6 +312,9 @@ def update_room(room_id): # this one is idempotent too, we can use PUT
         if "data" in data:
             update_data["data"] = data["data"]
 
+            # the smart home back reference is maintained by the smart home APIs only
+            update_data["data"].pop("home_id", None)
+
             # The list of measurements gets appended, not replaced...
             # if and only if there was no measurement before.
 
@@ -336,13 +374,18 @@ def delete_room(room_id):
             return jsonify({"error": "Room cannot be deleted, some door devices are still associated to it!"}), 400
 
         # we can't delete a room if there exists some reference in a smart home (the rooms can't go "poof"!)
-        filters = {"list_of_rooms": room["_id"]
-                   # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#query-an-array-for-an-element
-                   #                {"$all": [room["_id"]]} # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#match-an-array
-                   }
-
-        smart_homes_associated_to_room = current_app.config["DR_FACTORY"].query_drs("smart_home", filters)
-        if smart_homes_associated_to_room:
+        if "home_id" in room["data"]:
+            # the room knows its smart home, no need to look for it
+            room_is_associated = room["data"]["home_id"] is not None
+        else:
+            # rooms created before the home_id back reference existed: look for it in the smart homes' lists
+            filters = {"list_of_rooms": room["_id"]
+                       # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#query-an-array-for-an-element
+                       #                {"$all": [room["_id"]]} # https://www.mongodb.com/docs/manual/tutorial/query-arrays/#match-an-array
+                       }
+            room_is_associated = bool(current_app.config["DR_FACTORY"].query_drs("smart_home", filters, {"_id": 1}))
+
+        if room_is_associated:
             return jsonify({"error": "Room cannot be deleted, it is still associated to some smart homes!"}), 400
 
         current_app.config["DR_FACTORY"].delete_dr("room", room_id)
@@ -401,10 +444,15 @@ def create_smart_home():
             data['data'] = {}
 
         data['data']['default_room_id'] = room["_id"]
+        data['data']['current_room_id'] = room["_id"]  # ...and the pet is there, see above
         data['data']['list_of_rooms'] = [room["_id"]] # replace every content of this initial data with this list containing only the defaul room.
+        data['data']['faulted_door_ids'] = []  # no devices yet (see list_of_devices' initialization), no faulted ones
 
         smart_home = dr_factory.create_dr('smart_home',
                                           data)  # this will create a dr, validate it through the schema registry and save it on MongoDB
+
+        # the default room belongs to the new smart home
+        _set_home_id("room", [room["_id"]], smart_home["_id"])
         return jsonify({"status": "success", "message": "smart_home created successfully",
                         "smart_home_id": smart_home["_id"]}), 201
     except Exception as e:
@@ -414,10 +462,11 @@ def create_smart_home():
             current_app.config["DR_FACTORY"].delete_dr("room", room['_id'])
         return jsonify({"error": str(e)}), 500
 
-def _initialize_room_associations_of_device(door_id, somewhere_else_room_id):
+def _initialize_room_associations_of_device(door_id, somewhere_else_room_id, home_id):
     current_app.config["DR_FACTORY"].update_dr("door", door_id,
                                                {"data":
                                                    {
+                                                       "home_id": home_id,  # the device now belongs to this smart home
                                                        "power_saving_mode_status": True,
                                                        "entry_side_room_id": somewhere_else_room_id,
                                                        "exit_side_room_id": somewhere_else_room_id,
@@ -456,6 +505,10 @@ def update_smart_home(smart_home_id): # THIS ONE IS NOT IDEMPOTENT, WE CAN'T USE
 
             # any overwrite to the default_room_id gets blocked.
             update_data["data"].pop("default_room_id", None)
+            # the pet position pointer follows the rooms' vacancy statuses only
+            update_data["data"].pop("current_room_id", None)
+            # and the faulted devices' set follows the devices' power statuses only
+            update_data["data"].pop("faulted_door_ids", None)
 
             # The list of rooms and devices gets appended, not replaced.
             current_dr = current_app.config["DR_FACTORY"].get_dr("smart_home", smart_home_id)
@@ -463,6 +516,7 @@ def update_smart_home(smart_home_id): # THIS ONE IS NOT IDEMPOTENT, WE CAN'T USE
                 return jsonify({"error": "Smart home not found"}), 404
 
             if "list_of_rooms" in data["data"]:
+                added_room_ids = list(data["data"]["list_of_rooms"])  # (the list gets extended below)
                 if "list_of_rooms" in current_dr["data"]:
                     # max 20 user-defined rooms..
                     if len(update_data["data"]["list_of_rooms"]) + len(current_dr["data"]["list_of_rooms"]) <= MAX_PERSONAL_ROOMS_PER_USER + 1:
@@ -477,7 +531,7 @@ def update_smart_home(smart_home_id): # THIS ONE IS NOT IDEMPOTENT, WE CAN'T USE
                 for door_id in data["data"]["list_of_devices"]:
                     # so, update the door DR associated to the device...
                     somewhere_else_room_id = current_dr["data"]["default_room_id"]
-                    _initialize_room_associations_of_device(door_id, somewhere_else_room_id)
+                    _initialize_room_associations_of_device(door_id, somewhere_else_room_id, smart_home_id)
 
                 if "list_of_devices" in current_dr["data"]:
                     update_data["data"]["list_of_devices"].extend(current_dr["data"]["list_of_devices"])
@@ -487,6 +541,13 @@ def update_smart_home(smart_home_id): # THIS ONE IS NOT IDEMPOTENT, WE CAN'T USE
         update_data["metadata"] = {"updated_at": datetime.utcnow()}
 
         current_app.config["DR_FACTORY"].update_dr("smart_home", smart_home_id, update_data)
+
+        # the added rooms now belong to this smart home (the added devices got their home_id already, see above)
+        if "data" in data and "list_of_rooms" in data["data"]:
+            _set_home_id("room", added_room_ids, smart_home_id)
+        if "data" in data and "list_of_devices" in data["data"]:
+            _refresh_faulted_door_ids(smart_home_id)
+
         return jsonify({"status": "success", "message": "smart_home updated successfully"}), 200
     except Exception as e:
         current_app.logger.error(e)
@@ -516,6 +577,10 @@ def update_smart_home_unsafe(smart_home_id): # THIS ONE IS IDEMPOTENT, BUT ALLOW
 
             # any overwrite to the default_room_id gets blocked.
             update_data["data"].pop("default_room_id", None)
+            # the pet position pointer follows the rooms' vacancy statuses only
+            update_data["data"].pop("current_room_id", None)
+            # and the faulted devices' set follows the devices' power statuses only
+            update_data["data"].pop("faulted_door_ids", None)
 
             # The lists of rooms and devices GET REPLACED.
             current_dr = current_app.config["DR_FACTORY"].get_dr("smart_home", smart_home_id)
@@ -528,19 +593,63 @@ def update_smart_home_unsafe(smart_home_id): # THIS ONE IS IDEMPOTENT, BUT ALLOW
                 for door_id in data["data"]["list_of_devices"]:
                     # so, update the door DR associated to the device...
                     somewhere_else_room_id = current_dr["data"]["default_room_id"]
-                    _initialize_room_associations_of_device(door_id, somewhere_else_room_id)
+                    _initialize_room_associations_of_device(door_id, somewhere_else_room_id, smart_home_id)
 
 
         #Always update the 'updated at' timestamp
         update_data["metadata"] = {"updated_at": datetime.utcnow()}
 
         current_app.config["DR_FACTORY"].update_dr("smart_home", smart_home_id, update_data)
+
+        # keep the home_id back references in sync with the replaced lists: the new rooms belong to this smart home,
+        # the removed rooms and devices don't anymore (the new devices got their home_id already, see above)
+        if "data" in data:
+            if "list_of_rooms" in data["data"]:
+                _set_home_id("room", data["data"]["list_of_rooms"], smart_home_id)
+                _set_home_id("room", set(current_dr["data"].get("list_of_rooms", [])) - set(data["data"]["list_of_rooms"]), None)
+            if "list_of_devices" in data["data"]:
+                _set_home_id("door", set(current_dr["data"].get("list_of_devices", [])) - set(data["data"]["list_of_devices"]), None)
+                _refresh_faulted_door_ids(smart_home_id)
+
         return jsonify({"status": "success", "message": "smart_home updated successfully"}), 200
     except Exception as e:
         current_app.logger.error(e)
         return jsonify({"error": str(e)}), 500
 
 
+@pettracker_api.route("/smart_homes/<smart_home_id>/denial_statuses", methods=['PATCH'])
+def update_smart_home_denial_statuses(smart_home_id):
+    """Changes the denial statuses of several rooms of a smart home at once, {"denial_statuses": {room_id: bool}}.
+    The devices get updated in a single pass, only the ones leading to the changed rooms."""
+    try:
+        data = request.get_json()
+        denial_statuses = data.get("denial_statuses") if data else None
+        if not isinstance(denial_statuses, dict) or not all(isinstance(v, bool) for v in denial_statuses.values()):
+            return jsonify({"error": "denial_statuses must be an object mapping room ids to booleans"}), 400
+
+        smart_home = current_app.config["DR_FACTORY"].get_dr("smart_home", smart_home_id)
+        if not smart_home:
+            return jsonify({"error": "smart_home not found"}), 404
+
+        result = get_smart_home_dt_and_dr_from_customer_username(smart_home["profile"]["user"])
+        if not result:
+            return jsonify({"error": "smart_home not found"}), 404
+        _, smart_home_dt, smart_home_dr = result
+
+        try:
+            updates = current_app.config["MQTT_HANDLER"].update_rooms_denial_statuses(
+                smart_home_dt, smart_home_dr, denial_statuses
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        return jsonify({"status": "success", "message": "denial statuses updated successfully",
+                        "updated_devices": len(updates)}), 200
+    except Exception as e:
+        current_app.logger.error(e)
+        return jsonify({"error": str(e)}), 500
+
+
 @pettracker_api.route("/smart_homes/<smart_home_id>", methods=['GET'])
 def get_smart_home(smart_home_id):
     """Get smart_home details"""
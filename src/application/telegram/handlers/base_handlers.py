@@ -9,8 +9,7 @@ from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters,
 from flask import \
     current_app  # we need this to access the dr factories, we registered them under app.config dictionary.
 
-from src.application.mqtt.mqtt_handler import get_smart_home_dt_and_dr_from_customer_username, \
-    calculateSecondsOfDifference
+from src.application.mqtt.mqtt_handler import get_smart_home_dt_and_dr_from_customer_username
 from src.digital_twin.core import DigitalTwin
 
 MAX_PERSONAL_ROOMS_PER_USER = 20
@@ -185,19 +184,30 @@ def _check_if_registered_through_telegramUpdate(update) -> Optional[tuple[str, D
         current_app.logger.error(f"Error during user search: {str(e)}")
 
 
+def _get_home_state_through_telegramUpdate(update) -> Optional[dict]:
+    """Gets the home state snapshot (see home_state.py) of the smart home of the telegram user contained in the update.
+    Returns None if the user isn't registered.
+    Use it for the read-only commands: it's a single small read, no DT gets built."""
+    try:
+        telegram_id = update.effective_user.username
+        smart_home_id = current_app.config["CUSTOMER_INDEX"].lookup(telegram_id)
+        if smart_home_id is None:
+            return None  # not registered, no need to ask the database
+        return current_app.config["HOME_STATE"].get(smart_home_id)
+    except Exception as e:
+        current_app.logger.error(f"Error during user search: {str(e)}")
+
+
 async def save_chat_id(update, context):
     try:
         telegram_id = update.effective_user.username
         chat_id = update.message.chat_id
 
         # Does the user have a registered home in our system?
-        dr_factory = current_app.config["DR_FACTORY"]
-        smart_home_drs = dr_factory.query_drs(  # we answer this question by querying the database...
-            "smart_home", {"profile.user": telegram_id}
-        )
-        if smart_home_drs:  # and see if we get some smart homes...
+        # we answer this question through the customer index (it asks the database only when needed)...
+        smart_home_dr = current_app.config["CUSTOMER_INDEX"].get_smart_home_dr(telegram_id)
+        if smart_home_dr:  # and see if we get some smart home...
             # todo: right now, only one smart home per user, maybe in the future we'll program multi smart home support...
-            smart_home_dr = smart_home_drs[0]
 
             # Update smart_home_dr in database, replaces old chat_id (even if none was present).
             current_app.config['DR_FACTORY'].update_dr(
@@ -291,19 +301,15 @@ async def conversation_start_handler(update: Update, context: ContextTypes.DEFAU
 
 
 async def room_denial_statutes_retrieval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    dt_id, smart_home_dt, smart_home_dr = None, None, None
-   # try:
-    result = _check_if_registered_through_telegramUpdate(update)
+    # a single small read: the home state snapshot has the current denial status of each room, no need to build the DT
+    home_state = _get_home_state_through_telegramUpdate(update)
 
-    if result:
-        dt_id, smart_home_dt, smart_home_dr = result
-        smart_home_dt: DigitalTwin = smart_home_dt
+    if home_state:
         final_message = "Here is the room denial status for all rooms:\n ⛔: denied room; 🟢: accessible room\n\n"
 
-        # take each room DR in the smart_home_dt
-        for dr in smart_home_dt.digital_replicas:
-            if dr["type"] == "room":
-                final_message += f'{"⛔" if dr["data"]["denial_status"] else "🟢"} {dr["profile"]["name"]}\n'
+        # take each room in the home state
+        for room in home_state["rooms"].values():
+            final_message += f'{"⛔" if room.get("denial_status") else "🟢"} {room.get("name")}\n'
 
         await update.message.reply_text(
             final_message
@@ -315,27 +321,15 @@ async def room_denial_statutes_retrieval_handler(update: Update, context: Contex
             "If you have already bought our product, please, contact support at 123-456-7890"
         )
 
-    #finally:
-        # try:
-        #     current_app.config["DT_FACTORY"].get_dt(dt_id)
-        #     if dt_id:
-        #         current_app.config["DT_FACTORY"].delete_dt(dt_id)
-        # except Exception as e:
-        #     current_app.logger.error(e)
 
 async def room_vacancy_statutes_retrieval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    dt_id, smart_home_dt, smart_home_dr = None, None, None
-    #try:
-    result = _check_if_registered_through_telegramUpdate(update)
+    home_state = _get_home_state_through_telegramUpdate(update)
 
-    if result:
-        dt_id, smart_home_dt, smart_home_dr = result
-        smart_home_dt: DigitalTwin = smart_home_dt
+    if home_state:
         final_message = "Here is the room vacancy status for all rooms:\n 🔴: occupied room; ⚪: empty room\n\n"
-        # take each room DR in the smart_home_dt
-        for dr in smart_home_dt.digital_replicas:
-            if dr["type"] == "room":
-                final_message += f'{"🔴" if not dr["data"]["vacancy_status"] else "⚪"} {dr["profile"]["name"]}\n'
+        # take each room in the home state
+        for room in home_state["rooms"].values():
+            final_message += f'{"🔴" if not room.get("vacancy_status") else "⚪"} {room.get("name")}\n'
 
         await update.message.reply_text(
             final_message
@@ -347,13 +341,6 @@ async def room_vacancy_statutes_retrieval_handler(update: Update, context: Conte
             "If you have already bought our product, please, contact support at 123-456-7890"
         )
 
-    #finally:
-        # try:
-        #     current_app.config["DT_FACTORY"].get_dt(dt_id)
-        #     if dt_id:
-        #         current_app.config["DT_FACTORY"].delete_dt(dt_id)
-        # except Exception as e:
-        #     current_app.logger.error(e)
 
 async def room_statistics_retrieval_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     dt_id, smart_home_dt, smart_home_dr = None, None, None
@@ -398,19 +385,17 @@ async def room_statistics_retrieval_handler(update: Update, context: ContextType
 
 
 async def list_faulted_devices_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    dt_id, smart_home_dt, smart_home_dr = None, None, None
-    #try:
-    result = _check_if_registered_through_telegramUpdate(update)
-
-    if result:
-        dt_id, smart_home_dt, smart_home_dr = result
-        smart_home_dt: DigitalTwin = smart_home_dt
+    home_state = _get_home_state_through_telegramUpdate(update)
 
-        list_of_faulted_devices = smart_home_dt.execute_service(
-            "FindFaultsService")
+    if home_state:
+        if home_state.get("faulted_door_ids") is not None:
+            # the smart home keeps the set of its faulted devices
+            faulted_doors = [home_state["doors"][door_id] for door_id in home_state["faulted_door_ids"]
+                             if door_id in home_state["doors"]]
+        else:
+            faulted_doors = [door for door in home_state["doors"].values() if not door.get("power_status")]
 
-        if list_of_faulted_devices is None or len(
-                list_of_faulted_devices) == 0:  # yes, all devices are now functional
+        if len(faulted_doors) == 0:  # yes, all devices are now functional
             await update.message.reply_text(
                 "No faults detected!"
             )
@@ -418,10 +403,8 @@ async def list_faulted_devices_handler(update: Update, context: ContextTypes.DEF
 
             final_message = "Some faults were detected, here is the list of faulted devices:\n\n"
 
-            # take each room DR in the smart_home_dt
-            for dr in smart_home_dt.digital_replicas:
-                if dr["type"] == "door" and not dr["data"]["power_status"]:
-                    final_message += f'{dr["profile"]["device_name"]}@{dr["profile"]["seq_number"]}\n'
+            for door in faulted_doors:
+                final_message += f'{door.get("device_name")}@{door.get("seq_number")}\n'
 
             await update.message.reply_text(
                 final_message
@@ -433,44 +416,21 @@ async def list_faulted_devices_handler(update: Update, context: ContextTypes.DEF
             "If you have already bought our product, please, contact support at 123-456-7890"
         )
 
-    #finally:
-        # try:
-        #     current_app.config["DT_FACTORY"].get_dt(dt_id)
-        #     if dt_id:
-        #         current_app.config["DT_FACTORY"].delete_dt(dt_id)
-        # except Exception as e:
-        #     current_app.logger.error(e)
-
 
 async def retrieve_pet_position_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    dt_id, smart_home_dt, smart_home_dr = None, None, None
-    # try:
-    result = _check_if_registered_through_telegramUpdate(update)
-
-    if result:
-        dt_id, smart_home_dt, smart_home_dr = result
-        smart_home_dt: DigitalTwin = smart_home_dt
+    home_state = _get_home_state_through_telegramUpdate(update)
 
-        pet_position_room_id = smart_home_dt.execute_service(
-            "RetrievePetPositionService")
+    if home_state:
+        pet_position_room = home_state["rooms"].get(home_state.get("pet_room_id"))
 
-        rooms = list(filter(lambda dr: dr["type"] == "room" and dr["_id"] == pet_position_room_id,
-                            smart_home_dt.digital_replicas))
-        if rooms is None:
+        if pet_position_room is None:
             await update.message.reply_text(
                 f'Something went wrong. Contact support.'
             )
         else:
-            if len(rooms) == 1:
-                pet_position_room_dr = rooms[0]
-
-                await update.message.reply_text(
-                    f'Your {smart_home_dr["profile"]["pet_name"]} is inside the {pet_position_room_dr["profile"]["name"]} room.'
-                )
-            else:
-                await update.message.reply_text(
-                    f'Something went wrong. Contact support.'
-                )
+            await update.message.reply_text(
+                f'Your {home_state["pet_name"]} is inside the {pet_position_room["name"]} room.'
+            )
 
     else:
         await update.message.reply_text(
@@ -478,14 +438,6 @@ async def retrieve_pet_position_handler(update: Update, context: ContextTypes.DE
             "If you have already bought our product, please, contact support at 123-456-7890"
         )
 
-    # finally:
-    #     # try:
-    #     #     current_app.config["DT_FACTORY"].get_dt(dt_id)
-    #     #     if dt_id:
-    #     #         current_app.config["DT_FACTORY"].delete_dt(dt_id)
-    #     # except Exception as e:
-    #     #     current_app.logger.error(e)
-
 
 async def powersaving_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     dt_id, smart_home_dt, smart_home_dr = None, None, None
@@ -586,7 +538,8 @@ async def powersaving_handler_yes(update: Update, context: ContextTypes.DEFAULT_
 
                 # put the pet in the somewhere else room...
                 real_exited_room_id = smart_home_dt.execute_service(
-                    "RetrievePetPositionService")  # this variable contains the exited' room according to the internal status of the pet tracking app...
+                    "RetrievePetPositionService",
+                    current_room_id=smart_home_dr["data"].get("current_room_id"))  # this variable contains the exited' room according to the internal status of the pet tracking app...
 
                 if not real_exited_room_id:
                     current_app.logger.error("No room was occupied before this other room! Impossible.")
@@ -595,9 +548,9 @@ async def powersaving_handler_yes(update: Update, context: ContextTypes.DEFAULT_
                 now = datetime.utcnow()
 
                 # and toggle the room vacancy status for that room... this will update statistics too...
-                current_app.config['MQTT_HANDLER']._update_vacancy_status(now, real_exited_room_id, True)
+                current_app.config['MQTT_HANDLER']._update_vacancy_status(now, real_exited_room_id, True, smart_home_dr)
                 current_app.config['MQTT_HANDLER']._update_vacancy_status(now, smart_home_dr["data"]["default_room_id"],
-                                                                          False)
+                                                                          False, smart_home_dr)
 
             current_app.logger.info(
                 f'Smart home {smart_home_dr["_id"]} power saving mode setting updated to {smart_home_dr["data"]["power_saving_status"]}')
@@ -915,52 +868,14 @@ def room_denial_statuses_change__room_selected_handler__builder(room_index: int,
                 chosen_room = list(filter(lambda dr: dr["type"] == "room" and dr["_id"] == chosen_room["_id"],
                                 smart_home_dt.digital_replicas))[0]
 
-                chosen_room["data"]["denial_status"] = not chosen_room["data"]["denial_status"]
-
-                #update it in the database too...
-
-
-                # add a new measurement to the chosen room dr: new denial setting
-                # get the latest setting change timestamp... if there is no measurements, let the creation time be it.
-                time_since_last_denial_setting = max(chosen_room["data"]["measurements"], key=lambda k: k["timestamp"])[
-                    "timestamp"] if len(chosen_room["data"]["measurements"]) > 0 else chosen_room["metadata"][
-                    "created_at"]  # get the latest setting change timestamp... if there isn't, get the creation time of the DR
-
-                print(time_since_last_denial_setting)
-                print(datetime.utcnow())
-                print(calculateSecondsOfDifference(time_since_last_denial_setting, datetime.utcnow()))
-                measurement = {
-                    "type": "denial_status_change",
-                    "value": calculateSecondsOfDifference(time_since_last_denial_setting, datetime.utcnow()),
-                    # just a null value in case the room was never accessed before
-                    "timestamp": datetime.utcnow()
-                }
-
-                # Update measurements
-                if 'data' not in chosen_room:
-                    chosen_room['data'] = {}
-                if 'measurements' not in chosen_room['data']:
-                    chosen_room['data']['measurements'] = []
-
-                chosen_room['data']['measurements'].append(measurement)
-
-                # Update room in database
-                current_app.config['DR_FACTORY'].update_dr(
-                    "room",
-                    chosen_room["_id"],
-                    {
-                        "data": {
-                            "denial_status": chosen_room["data"]["denial_status"],
-                            "measurements": chosen_room['data']['measurements']  # updates the measurements list
-                        }
-                    }
+                # update it in the database too (with a new denial_status_change measurement), then update the
+                # denial settings of the devices leading to that room only
+                current_app.config["MQTT_HANDLER"].update_rooms_denial_statuses(
+                    smart_home_dt, smart_home_dr, {chosen_room["_id"]: not chosen_room["data"]["denial_status"]}
                 )
                 current_app.logger.info(
                     f"Room {chosen_room['_id']} measurements updated ")
 
-                # reapply denial statuses for all devices...
-                current_app.config["MQTT_HANDLER"]._reapply_denial_statuses(smart_home_dt, smart_home_dr)
-
                 await update.message.reply_text(
                     f'Updated room {chosen_room["profile"]["name"]} denial status to {chosen_room["data"]["denial_status"]}.',
                     reply_markup=ReplyKeyboardRemove()
@@ -1028,8 +943,10 @@ async def new_room_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                 {
                                                     "profile": {
                                                         "name": update.message.text[0:128]
+                                                    },
+                                                    "data": {
+                                                        "home_id": smart_home_dr["_id"]  # back reference to its smart home
                                                     }
-
                                                 })
 
                     smart_home_dr["data"]["list_of_rooms"].extend([room["_id"]])
@@ -1297,7 +1214,8 @@ def change_pet_position__room_selected_handler__builder(room_index: int, action:
 
                 # get the room currently occupied by the pet (use the smart home DT services to gather it)
                 exited_room_id = smart_home_dt.execute_service(
-                    "RetrievePetPositionService")  # this variable contains the exited' room according to the internal status of the pet tracking app...
+                    "RetrievePetPositionService",
+                    current_room_id=smart_home_dr["data"].get("current_room_id"))  # this variable contains the exited' room according to the internal status of the pet tracking app...
 
                 #if the ids are the same, tell the user.
                 if exited_room_id == chosen_room["_id"]:
@@ -1309,9 +1227,9 @@ def change_pet_position__room_selected_handler__builder(room_index: int, action:
                     now = datetime.utcnow()
                     # move the pet from the previous room to the next, updating database too.
                     current_app.config["MQTT_HANDLER"]._update_vacancy_status(now, exited_room_id,
-                                                                              True)  # this one gets ALWAYS updated.
+                                                                              True, smart_home_dr)  # this one gets ALWAYS updated.
                     current_app.config["MQTT_HANDLER"]._update_vacancy_status(now, chosen_room["_id"],
-                                                                              False)  # this one gets ALWAYS updated.
+                                                                              False, smart_home_dr)  # this one gets ALWAYS updated.
 
                     current_app.logger.info(
                         f"Moved pet from {exited_room_id} to {chosen_room['_id']}.")
@@ -1708,8 +1626,10 @@ async def room_association_change__new_room_handler(update: Update, context: Con
                                                 {
                                                     "profile": {
                                                         "name": update.message.text[0:128]
+                                                    },
+                                                    "data": {
+                                                        "home_id": smart_home_dr["_id"]  # back reference to its smart home
                                                     }
-
                                                 })
 
                     smart_home_dr["data"]["list_of_rooms"].extend([room["_id"]])
@@ -9,10 +9,16 @@ class DigitalTwin:
     def __init__(self):
         self.digital_replicas: List = []  # Lista di DR objects
         self.active_services: Dict = {}  # service_name -> service_instance
+        self._digital_replicas_by_id: Dict = {}  # dr _id -> DR object (the same objects of digital_replicas)
 
     def add_digital_replica(self, dr_instance: Any) -> None:
         """Aggiunge una Digital Replica al twin"""
         self.digital_replicas.append(dr_instance)
+        self._digital_replicas_by_id[dr_instance["_id"]] = dr_instance
+
+    def get_digital_replica(self, dr_id: str) -> Any:
+        """Returns the Digital Replica of the twin with the given id (None if it isn't there), without scanning them all"""
+        return self._digital_replicas_by_id.get(dr_id)
 
     def add_service(self, service):
         """Add a service to the DT"""
@@ -1,8 +1,11 @@
 from typing import Dict, List, Optional
 from datetime import datetime
+import hashlib
+import json
 from bson import ObjectId
 from flask import current_app
-from pymongo.errors import DuplicateKeyError
+from pymongo import ReturnDocument
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
 
 from database import Database
 from src.virtualization.digital_replica.schema_registry import SchemaRegistry
@@ -40,18 +43,112 @@ class DTFactory:
                 "status": "active",
             },
         }
-        while(True):
-            try:
-                dt_collection = self.db_service.db["digital_twins"]
-                result = dt_collection.insert_one(dt_data)
-                return str(result.inserted_id)
-            except DuplicateKeyError as e:
-                # # remove the old one...
-                # self.delete_dt(self.get_dt_by_name(name)["_id"])
-                # get the old one...
-                return self.get_dt_by_name(name)["_id"]
-            except Exception as e:
-                raise Exception(f"Failed to create Digital Twin: {str(e)}")
+        try:
+            dt_collection = self.db_service.db["digital_twins"]
+            # single atomic upsert: if a DT with the same name is already there we get the old one back, untouched
+            dt = self._upsert_dt_by_name(dt_collection, name, dt_data)
+            return str(dt["_id"])
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
+        except Exception as e:
+            raise Exception(f"Failed to create Digital Twin: {str(e)}")
+
+    def _upsert_dt_by_name(self, dt_collection, name: str, dt_data: Dict) -> Dict:
+        """Inserts dt_data if there's no DT named name, returning the stored DT in both cases"""
+        try:
+            return dt_collection.find_one_and_update(
+                {"name": name},
+                {"$setOnInsert": dt_data},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # someone else upserted the same name in the meantime (the unique index on name stopped us), take theirs
+            return dt_collection.find_one({"name": name})
+
+    @staticmethod
+    def _references_hash(digital_replicas: List[Dict], services: List[Dict]) -> str:
+        """Content hash of the DR and service references of a DT, used to skip writes when nothing changed"""
+        canonical = json.dumps(
+            {
+                "digital_replicas": [[dr_ref["type"], dr_ref["id"]] for dr_ref in digital_replicas],
+                "services": [[service["name"], service.get("config", {})] for service in services],
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def ensure_dt(
+        self, name: str, digital_replicas: List[Dict], services: List[str], description: str = ""
+    ) -> Dict:
+        """
+        Makes sure a Digital Twin named name exists with exactly the given DR and service references.
+        It's an atomic upsert: the DT gets written only when it's created or when its references changed
+        (checked through a content hash), so calling it again and again with the same references costs a single read.
+
+        Args:
+            name: Name of the Digital Twin
+            digital_replicas: DR references, as {"type": dr_type, "id": dr_id}
+            services: names of the services of the DT (see _get_service_module_mapping())
+            description: Optional description, used only when the DT gets created
+
+        Returns:
+            Dict: the Digital Twin data, as stored in the database (ready for create_dt_from_data())
+        """
+        try:
+            module_mapping = self._get_service_module_mapping()
+            for service_name in services:
+                if service_name not in module_mapping:
+                    raise ValueError(f"Service {service_name} not configured in module mapping")
+
+            now = datetime.utcnow()
+            digital_replicas = [{"type": dr_ref["type"], "id": dr_ref["id"]} for dr_ref in digital_replicas]
+            services_data = [
+                {"name": service_name, "config": {}, "status": "active", "added_at": now}
+                for service_name in services
+            ]
+            content_hash = self._references_hash(digital_replicas, services_data)
+
+            dt_collection = self.db_service.db["digital_twins"]
+            dt = self._upsert_dt_by_name(
+                dt_collection,
+                name,
+                {
+                    "_id": str(ObjectId()),
+                    "name": name,
+                    "description": description,
+                    "digital_replicas": digital_replicas,
+                    "services": services_data,
+                    "content_hash": content_hash,
+                    "metadata": {
+                        "created_at": now,
+                        "updated_at": now,
+                        "status": "active",
+                    },
+                },
+            )
+
+            # already there, but with different references (or created before content hashes existed): update it
+            if dt.get("content_hash") != content_hash:
+                dt = dt_collection.find_one_and_update(
+                    {"_id": dt["_id"]},
+                    {
+                        "$set": {
+                            "digital_replicas": digital_replicas,
+                            "services": services_data,
+                            "content_hash": content_hash,
+                            "metadata.updated_at": now,
+                        }
+                    },
+                    return_document=ReturnDocument.AFTER,
+                )
+
+            return dt
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
+        except Exception as e:
+            raise Exception(f"Failed to ensure Digital Twin: {str(e)}")
 
     def add_digital_replica(self, dt_id: str, dr_type: str, dr_id: str) -> None:
         """
@@ -78,6 +175,8 @@ class DTFactory:
                     "$set": {"metadata.updated_at": datetime.utcnow()},
                 },
             )
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to add Digital Replica: {str(e)}")
 
@@ -101,6 +200,8 @@ class DTFactory:
                              "metadata.updated_at": datetime.utcnow()}
                 },
             )
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to reset Digital Replicas List: {str(e)}")
 
@@ -165,6 +266,8 @@ class DTFactory:
                     f"Failed to load service {service_name} from module {module_name}: {str(e)}"
                 )
 
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to add service: {str(e)}")
 
@@ -187,6 +290,8 @@ class DTFactory:
             )
 
 
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to reset services' list: {str(e)}")
 
@@ -203,6 +308,8 @@ class DTFactory:
         try:
             dt_collection = self.db_service.db["digital_twins"]
             return dt_collection.find_one({"_id": dt_id})
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to get Digital Twin: {str(e)}")
 
@@ -219,6 +326,8 @@ class DTFactory:
         try:
             dt_collection = self.db_service.db["digital_twins"]
             return dt_collection.find_one({"name": name})
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to get Digital Twin: {str(e)}")
 
@@ -232,6 +341,8 @@ class DTFactory:
         try:
             dt_collection = self.db_service.db["digital_twins"]
             return list(dt_collection.find())
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to list Digital Twins: {str(e)}")
 
@@ -276,6 +387,8 @@ class DTFactory:
             if result.deleted_count == 0:
                 raise ValueError(f"Digital Twin not found: {dt_id}")
 
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to delete Digital Twin: {str(e)}")
 
@@ -303,6 +416,8 @@ class DTFactory:
                     }
                 }
             )
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to remove Digital Replica: {str(e)}")
 
@@ -346,6 +461,8 @@ class DTFactory:
                 dt_collection.create_index("name", unique=True)
                 dt_collection.create_index("metadata.created_at")
                 dt_collection.create_index("metadata.updated_at")
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to initialize DT collection: {str(e)}")
 
@@ -406,6 +523,8 @@ class DTFactory:
 
             return dt
 
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             #print(f"Error creating DT: {str(e)}")
             #print(f"Exception type: {type(e)}")
@@ -430,5 +549,7 @@ class DTFactory:
             # Create and return DT instance
             return self.create_dt_from_data(dt_data)
 
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to get DT instance: {str(e)}")
@@ -0,0 +1,106 @@
+from threading import Lock
+from typing import Dict, FrozenSet, List, Set, Tuple
+
+# Home topology: the bipartite graph doors <-> rooms of a smart home.
+# Each door has two edges (entry side room, exit side room), both in the normal room associations and in the
+# override ones (the ones used while some fault is present), so we keep two sets of edges:
+#   door_id -> (entry_side_room_id, exit_side_room_id)      and its reverse     room_id -> {door_ids}
+# The services can then answer "which rooms does this door connect?" and "which doors lead to this room?" with a
+# dictionary lookup, instead of filtering all the DRs of the DT.
+#
+# The topology only changes when the room associations (or the rooms/doors of the home) change: the graph gets cached
+# per home together with its signature, the set of everything it's built from (the door edges, the rooms, the default
+# room), taken from the same DRs. A DT whose DRs have the same signature gets the cached graph, any other gets a new
+# one: the cache can't serve a graph built out of different DRs than the caller's (unlike a version number read
+# separately from the DRs, which a concurrent association write can get ahead of). Computing the signature is a single
+# pass over the DRs, cheaper than building the graph and its reverse indexes.
+
+NORMAL_EDGE_FIELDS = ("entry_side_room_id", "exit_side_room_id")
+OVERRIDE_EDGE_FIELDS = ("override_entry_side_room_id", "override_exit_side_room_id")
+
+
+class HomeTopology:
+    """Door <-> room bipartite graph of a smart home, see the comment above"""
+
+    def __init__(self, digital_replicas: List[Dict], default_room_id: str = None, signature: FrozenSet[tuple] = None):
+        self.signature = signature or topology_signature(digital_replicas, default_room_id)
+        self.default_room_id = default_room_id
+        self.default_room_candidates: List[str] = []  # rooms named 'Somewhere else'
+
+        self.room_ids: Set[str] = set()
+        self.door_ids: Set[str] = set()
+        self.edges: Dict[str, Tuple[str, str]] = {}  # door_id -> (entry side room, exit side room)
+        self.override_edges: Dict[str, Tuple[str, str]] = {}  # same, override room associations
+        self.room_doors: Dict[str, Set[str]] = {}  # room_id -> doors leading to it
+        self.override_room_doors: Dict[str, Set[str]] = {}  # same, override room associations
+
+        for dr in digital_replicas:
+            if dr["type"] == "room":
+                self.room_ids.add(dr["_id"])
+                # older smart homes without the default_room_id... the services will look for it by name
+                if dr["profile"].get("name") == 'Somewhere else':
+                    self.default_room_candidates.append(dr["_id"])
+            elif dr["type"] == "door":
+                self.door_ids.add(dr["_id"])
+                self._add_edges(dr, NORMAL_EDGE_FIELDS, self.edges, self.room_doors)
+                self._add_edges(dr, OVERRIDE_EDGE_FIELDS, self.override_edges, self.override_room_doors)
+
+    @staticmethod
+    def _add_edges(door_dr: Dict, fields: Tuple[str, str], edges: Dict, room_doors: Dict) -> None:
+        entry_room_id, exit_room_id = (door_dr["data"].get(field) for field in fields)
+        edges[door_dr["_id"]] = (entry_room_id, exit_room_id)
+        for room_id in (entry_room_id, exit_room_id):
+            if room_id is not None:
+                room_doors.setdefault(room_id, set()).add(door_dr["_id"])
+
+    def rooms_of(self, door_id: str, override: bool = False) -> Set[str]:
+        """Rooms connected by a door"""
+        edges = self.override_edges if override else self.edges
+        return {room_id for room_id in edges.get(door_id, ()) if room_id is not None}
+
+    def doors_of(self, room_id: str, override: bool = False) -> Set[str]:
+        """Doors leading to a room"""
+        room_doors = self.override_room_doors if override else self.room_doors
+        return room_doors.get(room_id, set())
+
+
+def topology_signature(digital_replicas: List[Dict], default_room_id: str = None) -> FrozenSet[tuple]:
+    """Everything the topology of a home is built from, see the comment above"""
+    signature = {("default_room", default_room_id)}
+    for dr in digital_replicas:
+        if dr["type"] == "room":
+            signature.add(("room", dr["_id"], dr["profile"].get("name") == 'Somewhere else'))
+        elif dr["type"] == "door":
+            data = dr["data"]
+            signature.add(("door", dr["_id"]) +
+                          tuple(data.get(field) for field in NORMAL_EDGE_FIELDS + OVERRIDE_EDGE_FIELDS))
+    return frozenset(signature)
+
+
+# home_id -> topology built out of its latest DRs
+_topologies: Dict[str, HomeTopology] = {}
+_topologies_lock = Lock()
+
+
+def get_home_topology(home_id: str, digital_replicas: List[Dict], default_room_id: str = None) -> HomeTopology:
+    """
+    Gets the topology of a smart home, building it only if the cached one was built out of different DRs
+
+    Args:
+        home_id: id of the smart home DR
+        digital_replicas: room and door DRs of the smart home DT
+        default_room_id: the default_room_id of the smart home DR
+
+    Returns:
+        HomeTopology: the topology of the smart home
+    """
+    signature = topology_signature(digital_replicas, default_room_id)
+    with _topologies_lock:
+        topology = _topologies.get(home_id)
+    if topology is not None and topology.signature == signature:
+        return topology
+
+    topology = HomeTopology(digital_replicas, default_room_id, signature)
+    with _topologies_lock:
+        _topologies[home_id] = topology
+    return topology
@@ -1,11 +1,11 @@
-import itertools
 from datetime import datetime
 import datetime as dt
 from idlelib.run import Executive
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 from src.application.mqtt.mqtt_handler import calculateSecondsOfDifference
 from src.services.base import BaseService
+from src.services.home_topology import HomeTopology
 
 
 class PetTrackerException(Exception):
@@ -24,7 +24,8 @@ class RetrievePetPositionService(BaseService):
     def __init__(self):
         BaseService.__init__(self)
 
-    def execute(self, data: Dict, dr_type: str = "room", attribute: str = None) -> Any:
+    def execute(self, data: Dict, dr_type: str = "room", attribute: str = None,
+                current_room_id: str = None, check_consistency: bool = False) -> Any:
         """
             Execute the service on provided data.
             Args:
@@ -33,15 +34,33 @@ class RetrievePetPositionService(BaseService):
                       It requires the digital_replicas to have the "vacancy_status" data field.
                 dr_type: The default is room since we are going to analyze only room DRs among all DRs associated to the DT
                 attribute: Specific attribute to analyze
+                current_room_id: the current_room_id pointer of the smart home DR, if any. When given, it's returned
+                                 right away (O(1)) without scanning the rooms.
+                check_consistency: scan the rooms anyway, and check that the pointer agrees with their vacancy statuses.
             Returns:
                 The DR id whose vacancy status is false.
             Throws:
-                An exception if there is more than one DR whose vacancy status is false.
+                An exception if there is more than one DR whose vacancy status is false (scan only),
+                or if the pointer disagrees with the rooms' vacancy statuses (consistency check only).
             """
+        if current_room_id and not check_consistency:
+            return current_room_id  # the smart home knows where the pet is, no need to look at the rooms
+
         if "digital_replicas" not in data:
             return None
 
-        digital_replicas = data["digital_replicas"]
+        occupied_room_id = self._scan_rooms(data["digital_replicas"], dr_type)
+
+        if current_room_id and occupied_room_id != current_room_id:
+            raise PetTrackerException(
+                f"The current pet position {current_room_id} doesn't match the occupied room {occupied_room_id}!")
+
+        return occupied_room_id
+
+    @staticmethod
+    def _scan_rooms(digital_replicas: List[Dict], dr_type: str = "room") -> Any:
+        """Legacy lookup of the pet position: the only room whose vacancy status is false.
+        Used when the smart home has no current_room_id pointer yet, and as a consistency check"""
 
         rooms = list(
             filter(lambda dr: dr["type"] == dr_type, digital_replicas))  # pick up all the DT's rooms
@@ -99,7 +118,6 @@ class FindFaultsService(BaseService):
         faulted_doors = list(
             filter(lambda dr: (not dr["data"]["power_status"]),
                    doors))  # pick up all the DT's doors who are currently offline
-        print(faulted_doors)
 
         return faulted_doors
 
@@ -113,8 +131,8 @@ class FaultRecoveryService(FindFaultsService):
     def __init__(self):
         BaseService.__init__(self)
 
-    # todo: provide implementation
-    def execute(self, data: Dict, dr_type: str = None, attribute: str = None) -> Any:
+    def execute(self, data: Dict, dr_type: str = None, attribute: str = None,
+                default_room_id: str = None, topology: HomeTopology = None) -> Any:
         """
             Execute the service on provided data.
             Args:
@@ -125,137 +143,79 @@ class FaultRecoveryService(FindFaultsService):
                       override_entry_side_room_id and override_exit_side_room_id fields.
                 dr_type: The default is None since we can't specify more than one DR, even if we are analyzing door and room DRs
                 attribute: Specific attribute to analyze
+                default_room_id: the default_room_id of the smart home DR. If not given, the default room is
+                                 looked for by name ("Somewhere else") among the rooms.
+                topology: the (cached) topology of the smart home, see home_topology.py. If not given, it's built
+                          out of the digital replicas... which, for homes of a few hundred rooms or less, is slower
+                          than the old list based scan (see benchmarks/bench_fault_recovery.py): pass the cached one
+                          (get_home_topology) whenever you can.
             Returns:
                 None if the superclass service returns None,
                 An empty dictionary if no fault is present,
                 A dictionary whose keys are the IDs of the door DRs whose room associations need to be changed.
                 The values contain the suggested DR updates (new room associations & power saving mode setting) for fault recovery.
             Throws:
-                An exception if there is more than one room DR whose name is "Somewhere else".
+                An exception if there is more than one room DR whose name is "Somewhere else" (no default_room_id only).
             CAVEATS:
                 Faulted devices' room associations are ignored and not provided in the result!!!!!!!!!!!!!!!!!!!!!!!!
                 use the superclass' execute() method to retrieve the list of faulted devices and apply changes as per last step of figure 1.10
             """
         # we use the upper class to retrieve the list of faulted device.
         # we are in fact in a specialized class that provides more service on top of the superclass' services.
-        digital_replicas = data["digital_replicas"]
-        list_of_faulted_devices = super().execute(data, dr_type, attribute)
+        list_of_faulted_devices = super().execute(data, "door", attribute)
 
         if not list_of_faulted_devices:
             return None
         if len(list_of_faulted_devices) == 0:
             return {}
 
-        #get the default "somewhere else" room id in this smart home dt, to ignore it during the search
-        default_rooms = list(
-            filter(
-                lambda room: room["profile"]["name"] == 'Somewhere else',
-                filter(
-                    lambda dr: dr["type"] == "room",
-                    digital_replicas
-                )
-            )
-        )
-        if len(default_rooms) == 0:
-            raise PetTrackerException(
-                "There is no default room associated to this smart home! This is not a valid smart home DT")
-        elif len(default_rooms) > 1:
-            raise PetTrackerException(
-                "There can't be more than 1 default room associated to a smart home DT! This is not a valid smart home DT")
-
-        default_room_id = default_rooms[0]["_id"]
-
-        # contais rooms as per name... ignores default room though.
-        # Read comments from inside out...
-
-        list_of_rooms_id_associated_with_faulted_devices = (
-            list(  # makes a list again
-                set(  # removes duplicates by making a set out of the flattened list
-                    itertools.chain.from_iterable(  # flatten the list
-                        [  # make a list out of the lists of rooms
-                            list(  # make a list out of the iterable returned by the filter
-                                filter(
-                                    lambda room_id: room_id != default_room_id,  # filter out the default room
-                                    [
-                                        #faulted_device["data"]["entry_side_room_id"],
-                                        #faulted_device["data"]["exit_side_room_id"], # fault is already present if we are here.
-                                        # Remember the check on the list of faulted devices?
-                                        # >>>>>>>>>>>>>> we need to look at the override room associations ONLY... <<<<<<<<<<<<<<<<<<
-                                        # best case scenario, there is only one fault and it happened recently,
-                                        #           so the override room associations are a copy of the normal ones.
-                                        # worst case scenario, the fault has been present from quite some time,
-                                        #           room associations may have changed, but we are sure only overriden room associations are being used by the system...
-                                        faulted_device["data"]["override_entry_side_room_id"],
-                                        faulted_device["data"]["override_exit_side_room_id"]
-                                    ]
-                                )
-                            ) for faulted_device in list_of_faulted_devices
-                        ]
-                    )
-                )
-            ))
-
-        # get the list of devices associated with those rooms
-        list_of_devices_associated_to_faulted_rooms = list(
-            filter(
-                # get a device if its ID isn't the same of some faulted device and if one of its override room associations is contained inside the list_of_rooms_id_associated_with_faulted_devices
-                lambda device: (device["_id"] not in [dev["_id"] for dev in list_of_faulted_devices])
-                               and
-                               (
-                                       (device["data"][
-                                            "override_exit_side_room_id"] in list_of_rooms_id_associated_with_faulted_devices)
-                                       or
-                                       (device["data"][
-                                            "override_entry_side_room_id"] in list_of_rooms_id_associated_with_faulted_devices)
-                               ),
-                filter(
-                    lambda dr: dr["type"] == "door",
-                    digital_replicas
-                )
-            )
-        )
-
-        if len(list_of_devices_associated_to_faulted_rooms) == 0:
+        if topology is None:
+            topology = HomeTopology(data["digital_replicas"], default_room_id)
+
+        # get the default "somewhere else" room id in this smart home dt, to ignore it during the search
+        default_room_id = default_room_id or topology.default_room_id
+        if default_room_id is None:
+            if len(topology.default_room_candidates) == 0:
+                raise PetTrackerException(
+                    "There is no default room associated to this smart home! This is not a valid smart home DT")
+            elif len(topology.default_room_candidates) > 1:
+                raise PetTrackerException(
+                    "There can't be more than 1 default room associated to a smart home DT! This is not a valid smart home DT")
+            default_room_id = topology.default_room_candidates[0]
+
+        faulted_door_ids = {faulted_device["_id"] for faulted_device in list_of_faulted_devices}
+
+        # rooms reached by the faulted devices, the default room aside.
+        # >>>>>>>>>>>>>> we need to look at the override room associations ONLY... <<<<<<<<<<<<<<<<<<
+        # best case scenario, there is only one fault and it happened recently,
+        #           so the override room associations are a copy of the normal ones.
+        # worst case scenario, the fault has been present from quite some time,
+        #           room associations may have changed, but we are sure only overriden room associations are being used by the system...
+        faulted_room_ids = set().union(
+            *(topology.rooms_of(door_id, override=True) for door_id in faulted_door_ids)
+        ) - {default_room_id}
+
+        # the working devices leading to those rooms
+        devices_associated_to_faulted_rooms = set().union(
+            *(topology.doors_of(room_id, override=True) for room_id in faulted_room_ids)
+        ) - faulted_door_ids
+
+        if len(devices_associated_to_faulted_rooms) == 0:
             return {}  # no associations to be calculated, seems like the faulted devices were all associated to rooms with a single entry point or to the default room on both sides!
 
         # else, let's calculate the room changes...
-        # simply put the default room id wherever a room in the list_of_rooms_id_associated_with_faulted_devices is.
-
-        dictionary_doorIds_changes = {device_id: changes for (device_id, changes) in
-                                      zip(  # a dictionary made of door IDs and suggested changes...
-
-                                          [device["_id"] for device in list_of_devices_associated_to_faulted_rooms],
-                                          # this is the list of keys for the dictionary to be returned by the service.
-                                          # ...while the one below is the list of values of the dictionary to be returned as a result of our service.
-                                          [
-                                              # list of changes dictionaries, one per device... MADE WITH A LIST COMPREHENSION...
-                                              {
-                                                  # ...another dict comprehension... makes a dictionary of suggested changes based on the list of keys that associate the current device to a faulted room...
-                                                  faulted_room_association_key: default_room_id for
-                                                  faulted_room_association_key in
-                                                  # the keys get associated to the default_room id
-                                                  list(  # make a list out of the filter iterator...
-                                                      filter(
-                                                          # take the keys to the override room associations, if they associate the current device to a faulted room.
-                                                          lambda k: device["data"][
-                                                                        k] in list_of_rooms_id_associated_with_faulted_devices,
-                                                          ['override_exit_side_room_id', 'override_entry_side_room_id']
-                                                      )
-                                                  )
-                                              }
-                                              |  # union operator for dicts, we'll unite the previous dict with another dict containing just the power_saving key suggested change...
-                                              {
-                                                  # the power status suggested doesn't account for the global power saving status... THAT'S A THING OF THE APPLICATION LEVEL. WE SHOULDN'T EVEN BE MENTIONING IT HERE, BUT SINCE WE ARE LEARNING, BETTER TO SPECIFY IT
-                                                  "power_saving_mode_status": device["data"][
-                                                                                  "override_exit_side_room_id"] ==
-                                                                              device["data"][
-                                                                                  "override_entry_side_room_id"]
-                                              }
-                                              for device in list_of_devices_associated_to_faulted_rooms
-                                              # LIST COMPREHENSION ENDLINE
-
-                                          ]
-                                      )}
+        # simply put the default room id wherever a room in faulted_room_ids is.
+        dictionary_doorIds_changes = {}
+        for door_id in devices_associated_to_faulted_rooms:
+            override_entry_side_room_id, override_exit_side_room_id = topology.override_edges[door_id]
+            changes = {}
+            if override_exit_side_room_id in faulted_room_ids:
+                changes["override_exit_side_room_id"] = default_room_id
+            if override_entry_side_room_id in faulted_room_ids:
+                changes["override_entry_side_room_id"] = default_room_id
+            # the power status suggested doesn't account for the global power saving status... THAT'S A THING OF THE APPLICATION LEVEL. WE SHOULDN'T EVEN BE MENTIONING IT HERE, BUT SINCE WE ARE LEARNING, BETTER TO SPECIFY IT
+            changes["power_saving_mode_status"] = override_exit_side_room_id == override_entry_side_room_id
+            dictionary_doorIds_changes[door_id] = changes
 
         return dictionary_doorIds_changes
 
@@ -1,17 +1,209 @@
 from datetime import datetime
-from typing import Dict, Any, Type, Optional, List
-from pydantic import BaseModel, create_model, Field, field_validator
+from typing import Callable, Dict, Any, Type, Optional, List, Tuple, Union
+from typing_extensions import Annotated, Literal, NotRequired, Required, TypedDict
+from pydantic import AfterValidator, BaseModel, ConfigDict, TypeAdapter, create_model, Field
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import ConnectionFailure
 from database import Database
 import yaml
 import uuid
 
 from src.virtualization.digital_replica.schema_registry import SchemaRegistry
+from src.virtualization.digital_replica.model_codegen import template_hash
+
+# static models built out of the templates by model_codegen.py, if someone generated them...
+try:
+    from src.virtualization.digital_replica import generated_models
+except ImportError:
+    generated_models = None
+
+
+# python types of the profile/data fields, as per the templates (model_codegen.py's TYPE_HINTS are the same)
+FIELD_TYPE_MAPPINGS = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "datetime": datetime,
+    "List[str]": List[str],
+    "List[Dict]": List[Dict[str, Any]],
+}
+
+# python types used to validate the items of a List[Dict] field, as per the type_mappings of its item_constraints.
+# datetime fields accept strings too, like the old per-item python validator did.
+ITEM_TYPE_MAPPINGS = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "datetime": Union[datetime, str],
+}
 
 
 class DRFactory:
     def __init__(self, db_service: Database, schema_registry: SchemaRegistry):
         self.db_service = db_service
         self.schema_registry = schema_registry
+        # the pydantic models only depend on the loaded templates, build them once per DR type and reuse them...
+        # rebuilding them on every update_dr() would recompile the validators every time!
+        self._models: Dict[str, Tuple[Type[BaseModel], Type[BaseModel]]] = {}
+        self._item_adapters: Dict[str, Dict[str, TypeAdapter]] = {}
+        # True when MongoDB has the registry's $jsonSchema validators installed on the DR collections
+        self.validators_installed = False
+        # DR types whose collection validates EVERY write ("strict"), only their trusted writes of update_dr() can skip
+        # the python-side validation (see _init_dr_collections)
+        self.strictly_validated_types = set()
+        # callbacks called after every DR write, as listener(event, dr_type, dr_id, changes)
+        # event is "create", "update" or "delete"; changes is the created DR, the update_data or None respectively
+        self._listeners: List[Callable[[str, str, str, Optional[Dict]], None]] = []
+        self._init_dr_collections()
+
+    def add_listener(self, listener: Callable[[str, str, str, Optional[Dict]], None]) -> None:
+        """Registers a callback that gets notified of every DR write (used to keep denormalized views up to date)"""
+        self._listeners.append(listener)
+
+    def _notify_listeners(self, event: str, dr_type: str, dr_id: str, changes: Optional[Dict]) -> None:
+        """Notifies the listeners of a DR write. The write already happened, a failing listener must not make it fail"""
+        for listener in self._listeners:
+            try:
+                listener(event, dr_type, dr_id, changes)
+            except Exception as e:
+                print(f"DR listener {listener} failed on {event} of {dr_type} {dr_id}: {str(e)}")
+
+    def _init_dr_collections(self) -> None:
+        """Creates the DR collections with the $jsonSchema validators of the SchemaRegistry, or updates the validators
+        of the already existing ones through collMod.
+        validationLevel "strict" (every insert and update gets validated) whenever all the documents of the collection
+        respect the validator. A collection holding documents saved before the validators and not respecting them gets
+        "moderate" (updates to those documents aren't validated, they'd fail otherwise) and its DR type is left out of
+        strictly_validated_types: update_dr() validates its trusted writes in python, like without validators.
+        Fix or migrate those documents, the next start switches the collection to strict"""
+        if not self.db_service.is_connected():
+            raise ConnectionError("Database service not connected")
+
+        try:
+            db = self.db_service.db
+            existing_collections = db.list_collection_names()
+
+            for dr_type in self.schema_registry.get_schema_types():
+                collection_name = self.schema_registry.get_collection_name(dr_type)
+                validator = self.schema_registry.get_validation_schema(dr_type)
+
+                if collection_name not in existing_collections:
+                    db.create_collection(
+                        collection_name,
+                        validator=validator,
+                        validationLevel="strict",
+                        validationAction="error",
+                    )
+                    self.strictly_validated_types.add(dr_type)
+                    continue
+
+                # documents saved before the validators got installed may not respect them
+                invalid_documents = db[collection_name].count_documents({"$nor": [validator]})
+                db.command(
+                    "collMod",
+                    collection_name,
+                    validator=validator,
+                    validationLevel="moderate" if invalid_documents else "strict",
+                    validationAction="error",
+                )
+                if invalid_documents:
+                    print(f"{invalid_documents} {dr_type} DRs don't respect the validator, {collection_name} gets "
+                          f"validationLevel moderate and its DRs' updates keep being validated in python")
+                else:
+                    self.strictly_validated_types.add(dr_type)
+
+            self.validators_installed = True
+        except Exception as e:
+            # not a showstopper (ex. the mongo user can't run collMod), we will just keep validating everything in python
+            print(f"Failed to install the DR collections validators, falling back to python-side validation: {str(e)}")
+            self.validators_installed = False
+            self.strictly_validated_types.clear()
+
+        try:
+            # indexes listed by the templates (ex. the data.home_id back references of rooms and doors)
+            for dr_type in self.schema_registry.get_schema_types():
+                collection_name = self.schema_registry.get_collection_name(dr_type)
+                validations = self.schema_registry.schemas_yaml[dr_type]["schemas"].get("validations") or {}
+                for index_field in validations.get("indexes") or []:
+                    self.db_service.db[collection_name].create_index(index_field)
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
+        except Exception as e:
+            raise Exception(f"Failed to initialize DR collections indexes: {str(e)}")
+
+    def _has_generated_models(self, dr_type: str) -> bool:
+        """True if the generated models of dr_type exist and were generated from the currently loaded template"""
+        if generated_models is None or dr_type not in generated_models.MODELS:
+            return False
+        if generated_models.TEMPLATE_HASHES.get(dr_type) != template_hash(self.schema_registry.schemas_yaml[dr_type]):
+            print(f"Generated models of {dr_type} are stale, building them dynamically. "
+                  f"Run python -m src.virtualization.digital_replica.model_codegen to regenerate them.")
+            return False
+        return True
+
+    def _get_models(self, dr_type: str) -> Tuple[Type[BaseModel], Type[BaseModel]]:
+        """Returns the (cached) profile and data Pydantic models of a DR type"""
+        if dr_type not in self._models:
+            if self._has_generated_models(dr_type):
+                self._models[dr_type] = generated_models.MODELS[dr_type]
+            else:
+                self._models[dr_type] = (self._create_profile_model(dr_type), self._create_data_model(dr_type))
+        return self._models[dr_type]
+
+    def _get_item_adapters(self, dr_type: str) -> Dict[str, TypeAdapter]:
+        """Returns the compiled item validators of the List[Dict] fields of a DR type, keyed by field name"""
+        if dr_type not in self._item_adapters and self._has_generated_models(dr_type):
+            self._item_adapters[dr_type] = generated_models.ITEM_ADAPTERS[dr_type]
+
+        if dr_type not in self._item_adapters:
+            type_constraints = (
+                self.schema_registry.schemas_yaml[dr_type]["schemas"].get("validations", {}).get("type_constraints", {})
+            )
+            data_fields = self.schema_registry.schemas_yaml[dr_type]["schemas"].get("entity", {}).get("data", {})
+
+            self._item_adapters[dr_type] = {
+                field_name: self._create_item_adapter(field_name, type_constraints[field_name]["item_constraints"])
+                for field_name, field_type in data_fields.items()
+                if field_type == "List[Dict]"
+                and "item_constraints" in type_constraints.get(field_name, {})
+            }
+        return self._item_adapters[dr_type]
+
+    def _create_item_adapter(self, field_name: str, item_rules: Dict) -> TypeAdapter:
+        """Compiles the item_constraints of a List[Dict] field into a TypeAdapter, so that the items
+        get validated inside pydantic-core instead of a python for loop"""
+        required_fields = item_rules.get("required_fields", [])
+        type_mappings = item_rules.get("type_mappings", {})
+
+        item_fields = {field: Required[Any] for field in required_fields}
+        for key, expected_type in type_mappings.items():
+            item_type = ITEM_TYPE_MAPPINGS.get(expected_type, Any)
+            item_fields[key] = Required[item_type] if key in required_fields else NotRequired[item_type]
+
+        item_model = TypedDict(f"{field_name}_item", item_fields, total=False)
+        item_model.__pydantic_config__ = ConfigDict(extra="allow")  # keep any other key of the items, as before
+
+        return TypeAdapter(List[item_model])
+
+    def _field_type(self, field_name: str, field_type: str, type_constraints: Dict) -> Any:
+        """Python type of a profile/data field: its enum as a Literal, or the FIELD_TYPE_MAPPINGS one.
+        Same mapping as model_codegen.py's TYPE_HINTS, generated and dynamic models must accept the same DRs"""
+        if "enum" in type_constraints.get(field_name, {}):
+            return Literal[tuple(type_constraints[field_name]["enum"])]
+        return FIELD_TYPE_MAPPINGS.get(field_type, Any)
+
+    @staticmethod
+    def _field_constraints(field_name: str, type_constraints: Dict) -> Dict[str, Any]:
+        """min/max type constraints as the Field(...) arguments"""
+        rules = type_constraints.get(field_name, {})
+        constraints = {}
+        if "min" in rules:
+            constraints["ge"] = rules["min"]
+        if "max" in rules:
+            constraints["le"] = rules["max"]
+        return constraints
 
     def _create_profile_model(self, dr_type: str) -> Type[BaseModel]:
         """Create Pydantic model for profile section"""
@@ -30,52 +222,15 @@ class DRFactory:
         profile_fields = self.schema_registry.schemas_yaml[dr_type]["schemas"]["common_fields"].get("profile", {})
 
         for field_name, field_type in profile_fields.items():
-            is_required = field_name in mandatory_fields
-            constraints = {}
-
-            if field_name in type_constraints:
-                rules = type_constraints[field_name]
-                if "min" in rules:
-                    constraints["ge"] = rules["min"]
-                if "max" in rules:
-                    constraints["le"] = rules["max"]
-
-            field_definitions[field_name] = (
-                (
-                    str
-                    if field_type == "str"
-                    else (
-                        int
-                        if field_type == "int"
-                        else (
-                            float
-                            if field_type == "float"
-                            else datetime if field_type == "datetime" else Any
-                        )
-                    )
-                ),
-                Field(None if not is_required else ..., **constraints),
-            )
-
-        model = create_model("Profile", **field_definitions)
-
-        # Add enum validators where needed
-        for field_name in field_definitions:
-            if (
-                    field_name in type_constraints
-                    and "enum" in type_constraints[field_name]
-            ):
-                enum_values = type_constraints[field_name]["enum"]
-
-                @field_validator(field_name)
-                def validate_enum(value, field):
-                    if value not in enum_values:
-                        raise ValueError(f"{field.name} must be one of {enum_values}")
-                    return value
-
-                setattr(model, f"validate_{field_name}", validate_enum)
+            python_type = self._field_type(field_name, field_type, type_constraints)
+            constraints = self._field_constraints(field_name, type_constraints)
+            if field_name in mandatory_fields:
+                field_definitions[field_name] = (python_type, Field(..., **constraints))
+            else:
+                field_definitions[field_name] = (Optional[python_type], Field(None, **constraints))
 
-        return model
+        # the enums are Literal types: pydantic enforces them (a validator attached after create_model never runs)
+        return create_model("Profile", **field_definitions)
 
     def _create_data_model(self, dr_type: str) -> Type[BaseModel]:
         """Create Pydantic model for data section"""
@@ -84,99 +239,33 @@ class DRFactory:
         )
         data_fields = self.schema_registry.schemas_yaml[dr_type]["schemas"].get("entity", {}).get("data", {})
 
+        item_adapters = self._get_item_adapters(dr_type)
+
         field_definitions = {}
         for field_name, field_type in data_fields.items():
-            if field_type == "List[Dict]":
+            if field_type == "List[Dict]" and field_name in item_adapters:
+                # the items get validated by the compiled item adapter, in a single call for the whole list
+                field_definitions[field_name] = (
+                    Annotated[list, AfterValidator(item_adapters[field_name].validate_python)],
+                    Field(default_factory=list),
+                )
+            elif field_type.startswith("List["):
                 field_definitions[field_name] = (
-                    List[Dict[str, Any]],
+                    self._field_type(field_name, field_type, type_constraints),
                     Field(default_factory=list),
                 )
-            elif field_type == "List[str]":
-                field_definitions[field_name] = (List[str], Field(default_factory=list))
             else:
                 field_definitions[field_name] = (
-                    (
-                        str
-                        if field_type == "str"
-                        else (
-                            int
-                            if field_type == "int"
-                            else float if field_type == "float" else Any
-                        )
-                    ),
-                    Field(None),
+                    Optional[self._field_type(field_name, field_type, type_constraints)],
+                    Field(None, **self._field_constraints(field_name, type_constraints)),
                 )
 
-        model = create_model("Data", **field_definitions)
-
-        # Add validators for fields that need them
-        for field_name, field_type in data_fields.items():
-            # Add enum validator if needed
-            if (
-                    field_name in type_constraints
-                    and "enum" in type_constraints[field_name]
-            ):
-                enum_values = type_constraints[field_name]["enum"]
-
-                @field_validator(field_name)
-                def validate_enum(value, field):
-                    if value not in enum_values:
-                        raise ValueError(f"{field.name} must be one of {enum_values}")
-                    return value
-
-                setattr(model, f"validate_{field_name}", validate_enum)
-
-            # Add List[Dict] validator if needed
-            if field_type == "List[Dict]" and field_name in type_constraints:
-                rules = type_constraints[field_name]
-                if "item_constraints" in rules:
-                    item_rules = rules["item_constraints"]
-                    required_fields = item_rules.get("required_fields", [])
-                    type_mappings = item_rules.get("type_mappings", {})
-
-                    @field_validator(field_name)
-                    def validate_list_items(value, field):
-                        if not isinstance(value, list):
-                            raise ValueError(f"{field.name} must be a list")
-
-                        for idx, item in enumerate(value):
-                            if not isinstance(item, dict):
-                                raise ValueError(
-                                    f"Item {idx} in {field.name} must be a dictionary"
-                                )
-
-                            missing = [f for f in required_fields if f not in item]
-                            if missing:
-                                raise ValueError(
-                                    f"Missing required fields {missing} in item {idx}"
-                                )
-
-                            for key, expected_type in type_mappings.items():
-                                if key in item:
-                                    val = item[key]
-                                    if expected_type == "datetime":
-                                        if not isinstance(val, (datetime, str)):
-                                            raise ValueError(
-                                                f"Field {key} in item {idx} must be a datetime"
-                                            )
-                                    elif expected_type == "float":
-                                        try:
-                                            item[key] = float(val)
-                                        except (TypeError, ValueError):
-                                            raise ValueError(
-                                                f"Field {key} in item {idx} must be a number"
-                                            )
-                        return value
-
-                    setattr(model, f"validate_{field_name}", validate_list_items)
-
-        return model
+        return create_model("Data", **field_definitions)
 
     def create_dr(self, dr_type: str, initial_data: Dict[str, Any]) -> Dict:
         """Create a new Digital Replica instance and save it in the database"""
-        # Create Pydantic models for sections
-        ProfileModel = self._create_profile_model(dr_type)
-        DataModel = self._create_data_model(dr_type)
+        # Get the Pydantic models for sections
+        ProfileModel, DataModel = self._get_models(dr_type)
 
         # Initialize with required fields and defaults
         dr_dict = {
@@ -223,6 +312,7 @@ class DRFactory:
 
         #save it in the database
         self.save_dr(dr_type, dr_dict)
+        self._notify_listeners("create", dr_type, dr_dict["_id"], dr_dict)
 
         #return it as an object
         return dr_dict
@@ -277,6 +367,8 @@ class DRFactory:
 
             result = collection.insert_one(dr_data)
             return str(dr_data["_id"])
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to save Digital Replica: {str(e)}")
 
@@ -288,17 +380,22 @@ class DRFactory:
         try:
             collection_name = self.db_service.schema_registry.get_collection_name(dr_type)
             return self.db_service.db[collection_name].find_one({"_id": dr_id})
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to get Digital Replica: {str(e)}")
 
-    def query_drs(self, dr_type: str, query: Dict = None) -> List[Dict]:
-        """Gets ALL the digital replicas that respond to the query"""
+    def query_drs(self, dr_type: str, query: Dict = None, projection: Dict = None) -> List[Dict]:
+        """Gets ALL the digital replicas that respond to the query.
+        Pass a projection (ex. {"data.measurements": 0}) to avoid loading the whole history of the DRs"""
         if not self.db_service.is_connected():
             raise ConnectionError("Not connected to MongoDB")
 
         try:
             collection_name = self.db_service.schema_registry.get_collection_name(dr_type)
-            return list(self.db_service.db[collection_name].find(query or {}))
+            return list(self.db_service.db[collection_name].find(query or {}, projection))
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to query Digital Replicas: {str(e)}")
 
@@ -307,14 +404,29 @@ class DRFactory:
     # https://www.mongodb.com/docs/manual/reference/operator/aggregation/set/#overwriting-an-existing-field
     # MAKE SURE TO HAVE ALREADY APPENDED ANY ELEMENTS INTO THE ARRAYS (like measurements[])!
     # THE UPDATE WILL REPLACE THE FIELDS' CONTENT, NOT APPEND IT!
-    def update_dr(self, dr_type: str, dr_id: str, update_data: Dict) -> None:
-        """Updates a Digital Replica data in the database, replacing its field content with those contained in update_data"""
+    def update_dr(self, dr_type: str, dr_id: str, update_data: Dict, trusted: bool = False) -> None:
+        """
+        Updates a Digital Replica data in the database, replacing its field content with those contained in update_data
+
+        Args:
+            dr_type: Type of the DR
+            dr_id: ID of the DR
+            update_data: sections (profile/data/metadata) with the fields to replace
+            trusted: internal writers (ex. the MQTT handler) building the update out of already validated DRs can skip
+                     the python-side validation: if MongoDB validates every write of the collection ("strict", see
+                     _init_dr_collections), the fields get $set directly, without reading back and re-validating the
+                     whole document
+        """
         if not self.db_service.is_connected():
             raise ConnectionError("Not connected to MongoDB")
 
-        # Create Pydantic models for sections
-        ProfileModel = self._create_profile_model(dr_type)
-        DataModel = self._create_data_model(dr_type)
+        if trusted and dr_type in self.strictly_validated_types:
+            self._trusted_update_dr(dr_type, dr_id, update_data)
+            self._notify_listeners("update", dr_type, dr_id, update_data)
+            return
+
+        # Get the Pydantic models for sections
+        ProfileModel, DataModel = self._get_models(dr_type)
 
         try:
             # get the original dr...
@@ -333,9 +445,25 @@ class DRFactory:
 
             if "data" in update_data:
                 current_data = current_dr.get("data", {})
-                data = DataModel(**(current_data | update_data["data"]))
+                new_data = current_data | update_data["data"]
+
+                # callers pass back the whole measurements history with the new items appended...
+                # the stored items were validated when they were written, so if the caller left them untouched
+                # (see _is_append_only) validate just the appended ones.
+                already_validated_items = {}
+                for field_name in self._get_item_adapters(dr_type):
+                    stored_items = current_data.get(field_name)
+                    new_items = new_data.get(field_name)
+                    if self._is_append_only(stored_items, new_items):
+                        already_validated_items[field_name] = new_items[:len(stored_items)]
+                        new_data[field_name] = new_items[len(stored_items):]
+
+                data = DataModel(**new_data)
                 current_dr["data"] = data.model_dump(exclude_unset=True)
 
+                for field_name, validated_items in already_validated_items.items():
+                    current_dr["data"][field_name] = validated_items + current_dr["data"].get(field_name, [])
+
             if "metadata" in update_data:
                 current_dr["metadata"].update(update_data["metadata"])
 
@@ -350,9 +478,181 @@ class DRFactory:
             if result.matched_count == 0:
                 raise ValueError(f"Digital Replica not found: {dr_id}")
 
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to update Digital Replica: {str(e)}")
 
+        self._notify_listeners("update", dr_type, dr_id, update_data)
+
+    def conditional_update_dr(self, dr_type: str, dr_id: str, expected: Dict, update_data: Dict) -> bool:
+        """
+        Compare-and-set update of a Digital Replica: the update_data fields get $set only if the DR currently has
+        the expected field values, in a single atomic write. No python-side validation, use it for internal
+        pointers/flags only.
+
+        Args:
+            dr_type: Type of the DR
+            dr_id: ID of the DR
+            expected: dotted field paths and the values they must have (ex. {"data.current_room_id": None})
+            update_data: sections (profile/data/metadata) with the fields to replace
+
+        Returns:
+            bool: True if the DR matched the expected values and got updated, False otherwise
+        """
+        if not self.db_service.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection_name = self.db_service.schema_registry.get_collection_name(dr_type)
+
+            set_fields = {
+                f"{section}.{field_name}": value
+                for section in ("profile", "data", "metadata")
+                for field_name, value in update_data.get(section, {}).items()
+            }
+            set_fields["metadata.updated_at"] = datetime.utcnow()
+
+            result = self.db_service.db[collection_name].update_one({"_id": dr_id, **expected}, {"$set": set_fields})
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
+        except Exception as e:
+            raise Exception(f"Failed to update Digital Replica: {str(e)}")
+
+        if result.matched_count == 0:
+            return False
+
+        self._notify_listeners("update", dr_type, dr_id, update_data)
+        return True
+
+    def update_dr_set_member(self, dr_type: str, dr_id: str, section: str, field_name: str,
+                             member: Any, present: bool) -> Optional[List]:
+        """
+        Adds ($addToSet) or removes ($pull) a single member of a List field of a Digital Replica, in a single atomic
+        write. No python-side validation, use it for internal sets only.
+
+        Args:
+            dr_type: Type of the DR
+            dr_id: ID of the DR
+            section: section of the field (profile/data)
+            field_name: name of the List field
+            member: element to add/remove
+            present: True to add it, False to remove it
+
+        Returns:
+            Optional[List]: the whole List field after the update, None if the DR doesn't exist
+        """
+        if not self.db_service.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection_name = self.db_service.schema_registry.get_collection_name(dr_type)
+            field_path = f"{section}.{field_name}"
+
+            dr = self.db_service.db[collection_name].find_one_and_update(
+                {"_id": dr_id},
+                {
+                    "$addToSet" if present else "$pull": {field_path: member},
+                    "$set": {"metadata.updated_at": datetime.utcnow()},
+                },
+                projection={field_path: 1},
+                return_document=ReturnDocument.AFTER,
+            )
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
+        except Exception as e:
+            raise Exception(f"Failed to update Digital Replica: {str(e)}")
+
+        if dr is None:
+            return None
+
+        members = (dr.get(section) or {}).get(field_name) or []
+        self._notify_listeners("update", dr_type, dr_id, {section: {field_name: members}})
+        return members
+
+    def bulk_update_drs(self, dr_type: str, updates: Dict[str, Dict]) -> int:
+        """
+        Updates many Digital Replicas of the same type with a single bulk write. No python-side validation, use it
+        for internal writers only (ex. the MQTT handler's catch-up batches).
+
+        Args:
+            dr_type: Type of the DRs
+            updates: dr_id -> {"set": sections with the fields to replace,
+                               "push": sections with the List fields and the items to append to them}
+
+        Returns:
+            int: number of DRs that matched (the missing ones are skipped)
+        """
+        if not self.db_service.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+        if not updates:
+            return 0
+
+        now = datetime.utcnow()
+        operations = []
+        for dr_id, update in updates.items():
+            set_fields = {
+                f"{section}.{field_name}": value
+                for section, fields in (update.get("set") or {}).items()
+                for field_name, value in fields.items()
+            }
+            set_fields["metadata.updated_at"] = now
+            push_fields = {
+                f"{section}.{field_name}": {"$each": items}
+                for section, fields in (update.get("push") or {}).items()
+                for field_name, items in fields.items()
+            }
+            operation = {"$set": set_fields}
+            if push_fields:
+                operation["$push"] = push_fields
+            operations.append(UpdateOne({"_id": dr_id}, operation))
+
+        try:
+            collection_name = self.db_service.schema_registry.get_collection_name(dr_type)
+            result = self.db_service.db[collection_name].bulk_write(operations, ordered=False)
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
+        except Exception as e:
+            raise Exception(f"Failed to bulk update Digital Replicas: {str(e)}")
+
+        # the listeners get the replaced fields only (appended items like measurements aren't part of any state)
+        for dr_id, update in updates.items():
+            self._notify_listeners("update", dr_type, dr_id, update.get("set") or {})
+        return result.matched_count
+
+    def _trusted_update_dr(self, dr_type: str, dr_id: str, update_data: Dict) -> None:
+        """Fast path of update_dr(): a single $set of the dotted field paths, validated by MongoDB's $jsonSchema"""
+        try:
+            collection_name = self.db_service.schema_registry.get_collection_name(dr_type)
+
+            set_fields = {
+                f"{section}.{field_name}": value
+                for section in ("profile", "data", "metadata")
+                for field_name, value in update_data.get(section, {}).items()
+            }
+            set_fields["metadata.updated_at"] = datetime.utcnow()
+
+            result = self.db_service.db[collection_name].update_one({"_id": dr_id}, {"$set": set_fields})
+
+            if result.matched_count == 0:
+                raise ValueError(f"Digital Replica not found: {dr_id}")
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
+        except Exception as e:
+            raise Exception(f"Failed to update Digital Replica: {str(e)}")
+
+    @staticmethod
+    def _is_append_only(stored_items: Any, new_items: Any) -> bool:
+        """True if new_items is stored_items, item by item equal, with some items appended at the end: only then
+        update_dr() skips the validation of the stored prefix. A caller that edits or replaces any stored item gets the
+        whole list validated. The comparison is list equality (C speed dict comparisons, no pydantic), still O(n) but
+        way cheaper than validating the items again"""
+        if not isinstance(stored_items, list) or not isinstance(new_items, list) or not stored_items:
+            return False
+        if len(new_items) < len(stored_items):
+            return False
+        return new_items[:len(stored_items)] == stored_items
+
     def delete_dr(self, dr_type: str, dr_id: str) -> None:
         """Deletes a single DR from the database, based on its ID"""
         if not self.db_service.is_connected():
@@ -364,5 +664,9 @@ class DRFactory:
 
             if result.deleted_count == 0:
                 raise ValueError(f"Digital Replica not found: {dr_id}")
+        except ConnectionFailure:
+            raise  # MongoDB unreachable, the caller may retry
         except Exception as e:
             raise Exception(f"Failed to delete Digital Replica: {str(e)}")
+
+        self._notify_listeners("delete", dr_type, dr_id, None)
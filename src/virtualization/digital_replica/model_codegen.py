@@ -0,0 +1,263 @@
+"""
+Build-time generator of the typed DR models.
+
+Turns the DR templates loaded by the SchemaRegistry into a static python module (generated_models.py, next to this file)
+holding, for each DR type:
+    - the enums of the template as Literal types
+    - the Pydantic models of the profile and data sections: same types (TYPE_HINTS and DRFactory's FIELD_TYPE_MAPPINGS),
+      enums (Literal), optionality and min/max as the ones DRFactory builds with create_model, so running the generator
+      or not doesn't change what create_dr/update_dr accept
+    - the TypedDicts of the List[Dict] items and of the whole DR, to be used for type hints inside the services
+
+DRFactory imports the generated module when it's there and up to date with the templates (see TEMPLATE_HASHES),
+otherwise it keeps building its models dynamically at every start.
+
+Run it again every time a template changes:
+    python -m src.virtualization.digital_replica.model_codegen
+"""
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+from src.virtualization.digital_replica.schema_registry import SchemaRegistry
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+GENERATED_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated_models.py")
+
+# template type -> python type hint, as written inside the generated module (keep it in sync with DRFactory's
+# FIELD_TYPE_MAPPINGS)
+TYPE_HINTS = {
+    "str": "str",
+    "int": "int",
+    "float": "float",
+    "bool": "bool",
+    "datetime": "datetime",
+    "List[str]": "List[str]",
+    "List[Dict]": "List[Dict[str, Any]]",
+}
+
+# the items' timestamps sent by the devices are strings, they get saved as they are
+ITEM_TYPE_HINTS = TYPE_HINTS | {"datetime": "Union[datetime, str]"}
+
+
+def template_hash(raw_schema: Dict) -> str:
+    """Hash of a loaded YAML template, used to find out if the generated models are stale"""
+    canonical = json.dumps(raw_schema, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _class_prefix(dr_type: str) -> str:
+    """smart_home -> SmartHome"""
+    return "".join(part.capitalize() for part in dr_type.split("_"))
+
+
+def _field_args(constraints: Dict, default: str) -> str:
+    """Builds the Field(...) arguments out of the min/max type constraints"""
+    args = [default]
+    if "min" in constraints:
+        args.append(f"ge={constraints['min']!r}")
+    if "max" in constraints:
+        args.append(f"le={constraints['max']!r}")
+    return ", ".join(args)
+
+
+def _generate_dr_type(dr_type: str, raw_schema: Dict) -> List[str]:
+    """Generates the source lines of the models of a single DR type"""
+    schemas = raw_schema["schemas"]
+    validations = schemas.get("validations") or {}
+    mandatory_fields = validations.get("mandatory_fields") or {}
+    type_constraints = validations.get("type_constraints") or {}
+    profile_fields = (schemas.get("common_fields") or {}).get("profile") or {}
+    data_fields = (schemas.get("entity") or {}).get("data") or {}
+
+    prefix = _class_prefix(dr_type)
+    lines = [f"# ---------------- {dr_type} ----------------", ""]
+
+    # enums become Literals, so both pydantic and the type checkers can enforce them
+    enum_hints = {}
+    for field_name in list(profile_fields) + list(data_fields):
+        if "enum" in type_constraints.get(field_name, {}):
+            literal_name = f"{prefix}{_class_prefix(field_name)}"
+            values = ", ".join(repr(value) for value in type_constraints[field_name]["enum"])
+            lines.append(f"{literal_name} = Literal[{values}]")
+            enum_hints[field_name] = literal_name
+    if enum_hints:
+        lines.extend(["", ""])
+
+    def type_hint(field_name: str, field_type: str) -> str:
+        return enum_hints.get(field_name) or TYPE_HINTS.get(field_type, "Any")
+
+    # items of the List[Dict] fields
+    item_classes = {}
+    for field_name, field_type in data_fields.items():
+        item_rules = type_constraints.get(field_name, {}).get("item_constraints")
+        if field_type != "List[Dict]" or not item_rules:
+            continue
+
+        item_class = f"{prefix}{_class_prefix(field_name)}Item"
+        required_fields = item_rules.get("required_fields", [])
+        type_mappings = item_rules.get("type_mappings", {})
+
+        lines.append(f"class {item_class}(TypedDict, total=False):")
+        lines.append('    __pydantic_config__ = ConfigDict(extra="allow")')
+        for key in required_fields:
+            if key not in type_mappings:
+                lines.append(f"    {key}: Required[Any]")
+        for key, expected_type in type_mappings.items():
+            wrapper = "Required" if key in required_fields else "NotRequired"
+            lines.append(f"    {key}: {wrapper}[{ITEM_TYPE_HINTS.get(expected_type, 'Any')}]")
+        lines.append("")
+        lines.append("")
+        lines.append(f"_{dr_type}_{field_name}_items = TypeAdapter(List[{item_class}])")
+        lines.append("")
+        lines.append("")
+        item_classes[field_name] = item_class
+
+    # profile model
+    profile_required = mandatory_fields.get("profile") or []
+    lines.append(f"class {prefix}Profile(BaseModel):")
+    for field_name, field_type in profile_fields.items():
+        constraints = type_constraints.get(field_name, {})
+        if field_name in profile_required:
+            lines.append(f"    {field_name}: {type_hint(field_name, field_type)} = Field({_field_args(constraints, '...')})")
+        else:
+            lines.append(f"    {field_name}: Optional[{type_hint(field_name, field_type)}] = Field({_field_args(constraints, 'None')})")
+    if not profile_fields:
+        lines.append("    pass")
+    lines.append("")
+    lines.append("")
+
+    # data model
+    lines.append(f"class {prefix}Data(BaseModel):")
+    for field_name, field_type in data_fields.items():
+        if field_name in item_classes:
+            lines.append(
+                f"    {field_name}: Annotated[list, AfterValidator(_{dr_type}_{field_name}_items.validate_python)]"
+                f" = Field(default_factory=list)"
+            )
+        elif field_type.startswith("List["):
+            lines.append(f"    {field_name}: {type_hint(field_name, field_type)} = Field(default_factory=list)")
+        else:
+            constraints = type_constraints.get(field_name, {})
+            lines.append(f"    {field_name}: Optional[{type_hint(field_name, field_type)}] = Field({_field_args(constraints, 'None')})")
+    if not data_fields:
+        lines.append("    pass")
+    lines.append("")
+    lines.append("")
+
+    # TypedDicts of the DR documents, for the services
+    lines.append(f"class {prefix}ProfileDict(TypedDict, total=False):")
+    for field_name, field_type in profile_fields.items():
+        lines.append(f"    {field_name}: {type_hint(field_name, field_type)}")
+    if not profile_fields:
+        lines.append("    pass")
+    lines.append("")
+    lines.append("")
+
+    lines.append(f"class {prefix}DataDict(TypedDict, total=False):")
+    for field_name, field_type in data_fields.items():
+        if field_name in item_classes:
+            lines.append(f"    {field_name}: List[{item_classes[field_name]}]")
+        else:
+            lines.append(f"    {field_name}: Optional[{type_hint(field_name, field_type)}]")
+    if not data_fields:
+        lines.append("    pass")
+    lines.append("")
+    lines.append("")
+
+    lines.append(f"class {prefix}DR(TypedDict, total=False):")
+    lines.append("    _id: str")
+    lines.append("    type: str")
+    lines.append(f"    profile: {prefix}ProfileDict")
+    lines.append(f"    data: {prefix}DataDict")
+    lines.append("    metadata: Dict[str, Any]")
+    lines.append("")
+    lines.append("")
+
+    return lines
+
+
+def generate_models_module(schema_registry: SchemaRegistry) -> str:
+    """
+    Generates the source code of the models module
+
+    Args:
+        schema_registry: registry with all the DR templates already loaded
+
+    Returns:
+        str: source code of generated_models.py
+    """
+    lines = [
+        "# AUTOMATICALLY GENERATED by src/virtualization/digital_replica/model_codegen.py, DO NOT EDIT!",
+        "# Run `python -m src.virtualization.digital_replica.model_codegen` again after changing the DR templates.",
+        "from datetime import datetime",
+        "from typing import Any, Dict, List, Optional, Union",
+        "",
+        "from pydantic import AfterValidator, BaseModel, ConfigDict, Field, TypeAdapter",
+        "from typing_extensions import Annotated, Literal, NotRequired, Required, TypedDict",
+        "",
+        "",
+    ]
+
+    models, item_adapters, hashes = [], [], []
+    for dr_type, raw_schema in schema_registry.schemas_yaml.items():
+        lines.extend(_generate_dr_type(dr_type, raw_schema))
+
+        prefix = _class_prefix(dr_type)
+        models.append(f"    {dr_type!r}: ({prefix}Profile, {prefix}Data),")
+        adapters = [
+            f"{field_name!r}: _{dr_type}_{field_name}_items"
+            for field_name, field_type in ((raw_schema["schemas"].get("entity") or {}).get("data") or {}).items()
+            if field_type == "List[Dict]"
+            and "item_constraints" in ((raw_schema["schemas"].get("validations") or {}).get("type_constraints") or {}).get(field_name, {})
+        ]
+        item_adapters.append(f"    {dr_type!r}: {{{', '.join(adapters)}}},")
+        hashes.append(f"    {dr_type!r}: {template_hash(raw_schema)!r},")
+
+    lines.append("# dr_type -> (profile model, data model)")
+    lines.append("MODELS = {")
+    lines.extend(models)
+    lines.append("}")
+    lines.append("")
+    lines.append("# dr_type -> {List[Dict] field -> TypeAdapter of its items}")
+    lines.append("ITEM_ADAPTERS = {")
+    lines.extend(item_adapters)
+    lines.append("}")
+    lines.append("")
+    lines.append("# dr_type -> hash of the template the models were generated from")
+    lines.append("TEMPLATE_HASHES = {")
+    lines.extend(hashes)
+    lines.append("}")
+    lines.append("")
+
+    return "\n".join(lines)
+
+
+def write_models_module(schema_registry: SchemaRegistry, output_path: str = GENERATED_MODULE_PATH) -> str:
+    """Generates the models module and writes it into output_path, returning the path"""
+    source = generate_models_module(schema_registry)
+    compile(source, output_path, "exec")  # never write a broken module, DRFactory would fail importing it
+
+    with open(output_path, "w") as file:
+        file.write(source)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates the typed DR models out of the YAML templates")
+    parser.add_argument("--templates", default=TEMPLATES_DIR, help="directory with the DR templates (<dr_type>.yaml)")
+    parser.add_argument("--output", default=GENERATED_MODULE_PATH, help="path of the generated module")
+    args = parser.parse_args()
+
+    schema_registry = SchemaRegistry()
+    for file_name in sorted(os.listdir(args.templates)):
+        if file_name.endswith(".yaml"):
+            schema_registry.load_schema(file_name[:-len(".yaml")], os.path.join(args.templates, file_name))
+
+    print(f"Generated models of {list(schema_registry.schemas_yaml)} into {write_models_module(schema_registry, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, List
 import yaml
 
 
@@ -28,13 +28,16 @@ class SchemaRegistry:
 
     def _convert_yaml_to_mongodb_schema(self, yaml_schema: Dict) -> Dict:
         """Convert YAML schema format to MongoDB $jsonSchema format"""
+        validations = yaml_schema.get("validations") or {}
+        mandatory_fields = validations.get("mandatory_fields") or {}
+        type_constraints = validations.get("type_constraints") or {}
 
-        def convert_type(yaml_type: str) -> str:
+        def convert_type(yaml_type: str):
             """Convert YAML type to MongoDB BSON type"""
             type_mapping = {
                 "str": "string",
-                "int": "int",
-                "float": "double",
+                "int": ["int", "long"],  # telegram's chat ids don't fit in 32 bits, pymongo saves them as long
+                "float": "number",  # pydantic may hand us ints too (1 instead of 1.0)
                 "bool": "bool",
                 "datetime": "date",
                 "Dict": "object",
@@ -42,41 +45,94 @@ class SchemaRegistry:
             }
             return type_mapping.get(yaml_type, yaml_type)
 
-        def process_field(field_def):
+        def make_nullable(field_schema: Dict) -> Dict:
+            """Non mandatory fields may be saved as None by the DR factory (ex. a door without room assignments)"""
+            bson_type = field_schema["bsonType"]
+            bson_type = list(bson_type) if isinstance(bson_type, list) else [bson_type]
+            field_schema["bsonType"] = bson_type + ["null"]
+            if "enum" in field_schema:
+                field_schema["enum"] = field_schema["enum"] + [None]
+            return field_schema
+
+        def process_list_items(field_name: str) -> Dict:
+            """Process the item_constraints of a List[Dict] field"""
+            item_rules = type_constraints.get(field_name, {}).get("item_constraints")
+            if not item_rules:
+                return {"bsonType": "object"}
+
+            item_properties = {}
+            for key, expected_type in item_rules.get("type_mappings", {}).items():
+                if expected_type == "datetime":
+                    # devices send their timestamps as strings, we save them as they are
+                    item_properties[key] = {"bsonType": ["date", "string"]}
+                else:
+                    item_properties[key] = {"bsonType": convert_type(expected_type)}
+
+            item_schema = {"bsonType": "object", "properties": item_properties}
+            if item_rules.get("required_fields"):
+                item_schema["required"] = list(item_rules["required_fields"])
+            return item_schema
+
+        def process_field(field_name: str, field_def, required: bool = False):
             """Process a field definition from YAML to MongoDB format"""
             if isinstance(field_def, str):
-                return {"bsonType": convert_type(field_def)}
+                if field_def == "List[Dict]":
+                    field_schema = {"bsonType": "array", "items": process_list_items(field_name)}
+                elif field_def.startswith("List[") and field_def.endswith("]"):
+                    field_schema = {"bsonType": "array", "items": {"bsonType": convert_type(field_def[5:-1])}}
+                else:
+                    field_schema = {"bsonType": convert_type(field_def)}
+
+                # add the enum/min/max constraints of the field, if any
+                constraints = type_constraints.get(field_name, {})
+                if "enum" in constraints:
+                    field_schema["enum"] = list(constraints["enum"])
+                if "min" in constraints:
+                    field_schema["minimum"] = constraints["min"]
+                if "max" in constraints:
+                    field_schema["maximum"] = constraints["max"]
+
+                return field_schema if required else make_nullable(field_schema)
             elif isinstance(field_def, dict):
-                return {
+                # sub-documents (profile, metadata, data) get their mandatory fields from validations.mandatory_fields
+                section_required = mandatory_fields.get(field_name) or []
+                section_schema = {
                     "bsonType": "object",
-                    "properties": {k: process_field(v) for k, v in field_def.items()},
+                    "properties": {
+                        k: process_field(k, v, k in section_required) for k, v in field_def.items()
+                    },
                 }
+                if section_required:
+                    section_schema["required"] = list(section_required)
+                return section_schema
             elif isinstance(field_def, list):
                 # Handle List[Dict] case
                 return {"bsonType": "array"}
             return field_def
 
+        root_required = list(mandatory_fields.get("root") or ["_id", "type"])
+
         # Process common fields
         properties = {}
         if "common_fields" in yaml_schema:
             for field_name, field_def in yaml_schema["common_fields"].items():
-                properties[field_name] = process_field(field_def)
+                properties[field_name] = process_field(field_name, field_def, field_name in root_required)
 
         # Process entity fields
         if "entity" in yaml_schema and "data" in yaml_schema["entity"]:
-            properties["data"] = process_field(yaml_schema["entity"]["data"])
+            properties["data"] = process_field("data", yaml_schema["entity"]["data"])
 
-        # Process validations if present
-        required_fields = []
-        if "validations" in yaml_schema:
-            if "required" in yaml_schema["validations"]:
-                required_fields.extend(yaml_schema["validations"]["required"])
+        # the sections with mandatory fields must be there too
+        required_fields = [
+            section for section, fields in mandatory_fields.items()
+            if section != "root" and fields and section not in root_required
+        ]
 
         # Build final schema
         validation_schema = {
             "$jsonSchema": {
                 "bsonType": "object",
-                "required": ["_id", "type"] + required_fields,
+                "required": root_required + required_fields,
                 "properties": {
                     "_id": {"bsonType": "string"},
                     "type": {"bsonType": "string"},
@@ -91,6 +147,10 @@ class SchemaRegistry:
         """Get collection name for schema type"""
         return f"{schema_type}_collection"
 
+    def get_schema_types(self) -> List[str]:
+        """Get all the loaded schema types"""
+        return list(self.schemas.keys())
+
     def get_validation_schema(self, schema_type: str) -> Dict:
         """Get validation schema for type"""
         if schema_type not in self.schemas: